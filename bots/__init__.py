@@ -1,4 +1,4 @@
-from bots.bot import Bot
+from bots.bot import Bot, SearchAborted
 from bots.bot_v1 import BotV1
 from bots.bot_v2_3 import BotV2p3
 from bots.bot_v3_5 import BotV3p5
@@ -10,3 +10,5 @@ from bots.bot_v4_3 import BotV4p3
 from bots.bot_v5 import BotV5
 from bots.bot_v5_1 import BotV5p1
 from bots.bot_v5_4 import BotV5p4
+from bots.engine_worker import EngineWorker
+from bots.lazy_smp import LazySMP
@@ -2,6 +2,10 @@ from abc import ABC, abstractmethod
 from typing import Any
 
 
+class SearchAborted(Exception):
+    """ Raised from inside a search when its deadline passes or it is told to stop, to unwind it at once. """
+
+
 class Bot(ABC):
     @abstractmethod
     def generate_move(self, game_state, allotted_time: float = 3, depth: int = -1) -> tuple[tuple[int, Any], int]:
@@ -11,6 +15,9 @@ class Bot(ABC):
     def clear_cache(self) -> None:
         ...
 
+    def close(self) -> None:
+        """ Release anything the bot holds outside this process. Most bots hold nothing. """
+
     @classmethod
     def get_version(cls):
         return cls.__name__
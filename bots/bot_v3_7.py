@@ -2,8 +2,6 @@ import multiprocessing
 import time
 from typing import Callable
 
-import numpy as np
-
 from game_states import GameStateFormatV2
 from utils import mirror, negate
 from bots.bot import Bot
@@ -217,7 +215,8 @@ class BotV3p7(Bot):
         if (cached_eval := self.eval_lookup.get(hash_state)) is not None:
             return cached_eval
         board: tuple[int, ...] = game_state.board
-        combined: list[tuple[int, ...]] = combined_tables_transition[np.count_nonzero(board not in [0, -1, 1, -6, 6])]
+        # The phase is kept up to date by move(), and promotions can take it past the last table
+        combined: list[tuple[int, ...]] = combined_tables_transition[min(game_state.phase, 29)]
         self.eval_lookup[hash_state] = (
             evaluation := sum([combined[piece + 6][i] for (i, piece) in enumerate(board) if piece]))
         return evaluation
@@ -7,6 +7,7 @@ import numpy as np
 from game_states.game_format_v2 import GameStateFormatV2
 from utils import mirror, negate
 from bots.bot import Bot
+from bots.transposition_table import TranspositionTable
 
 
 def _minimax_worker(bot, game_state, depth, maximizing_player, queue):
@@ -156,18 +157,25 @@ populate_combined_tables()
 
 
 class BotV5(Bot):
-    def __init__(self, transposition_table: dict | None = None, eval_lookup: dict | None = None) -> None:
+    def __init__(self, transposition_table: dict | None = None, eval_lookup: dict | None = None,
+                 tt_size_mb: float = 0) -> None:
         self.transposition_table: dict[
             int, tuple[int, tuple[int, int, int]]] = transposition_table if transposition_table is not None else {}
+        # A bounded table with bound flags, used instead of transposition_table when a size is given
+        self.tt: TranspositionTable | None = TranspositionTable(tt_size_mb) if tt_size_mb > 0 else None
         self.eval_lookup: dict[int, int] = eval_lookup if eval_lookup is not None else {}
         self.loose_transposition_table: dict[int, int] = {}
 
     def generate_move(self, game_state: GameStateFormatV2, allotted_time: float = 3.0, depth: int = -1) -> tuple[
         tuple[int, tuple[int, int, int]], int]:
+        if self.tt is not None:
+            self.tt.new_search()
         return self.iterative_deepening(game_state, game_state.color == 1, allotted_time=allotted_time, depth=depth)
 
     def clear_cache(self) -> None:
         self.transposition_table.clear()
+        if self.tt is not None:
+            self.tt.clear()
         self.eval_lookup.clear()
         self.loose_transposition_table.clear()
 
@@ -222,45 +230,79 @@ class BotV5(Bot):
         return results[-1], completed_depth
 
     def minimax(self, game_state: GameStateFormatV2, depth: int, alpha: int, beta: int, maximizing_player: bool,
-                first_call: bool = True) -> tuple[int, tuple[int, int, int]]:
+                first_call: bool = True) -> tuple[int, tuple[int, int, int] | tuple]:
         if game_state.get_winner() is not None:
             return self.evaluate(game_state), (game_state.last_move if game_state.last_move is not None else (0, 0, 0))
-        state_key: int = hash((game_state.board, game_state.white_queen, game_state.white_king, game_state.black_queen,
-                               game_state.black_king, depth, maximizing_player,
-                               tuple(sorted(game_state.previous_position_count.items()))))
+        # The Zobrist key covers the board, castling rights, en passant file and side to move
+        position: int = game_state.hash_state
+        state_key: int = hash((position, depth, maximizing_player))
         transposition_table: dict[int, tuple[int, tuple[int, int, int]]] = self.transposition_table
-        if (cached := transposition_table.get(state_key)) is not None:
+        tt: TranspositionTable | None = self.tt
+        if tt is not None:
+            if (settled := tt.lookup(state_key, depth, alpha, beta)) is not None:
+                return settled[0], game_state.unpack_move(settled[1]) if settled[1] else ()
+        elif (cached := transposition_table.get(state_key)) is not None:
             return cached
+        # The window the bound of the result is judged against, before the moves below narrow it
+        original_alpha, original_beta = alpha, beta
         moves: tuple[tuple[int, int, int], ...] = tuple(game_state.get_moves() if first_call else
                                                         game_state.get_moves_no_check())
         move_fn: Callable[[tuple[int, int, int]], GameStateFormatV2] = game_state.move
         eval_fn: Callable[[GameStateFormatV2], int] = self.evaluate
         loose_transposition_table: dict[int, int] = self.loose_transposition_table
-        child_data: list[tuple[tuple[int, int, int], GameStateFormatV2, int]] = [
-            (move, child_state := move_fn(move), prev_eval if (prev_eval := loose_transposition_table.get(
-                hash(child_state))) is not None else eval_fn(child_state)) for move in moves]
+        recurse: Callable = self.minimax
 
-        child_data.sort(key=lambda move: move[2], reverse=maximizing_player)
+        # The best move the previous iteration found here is tried before any other child is made, once it is checked
+        # against the moves of this position
+        hash_move: tuple[int, int, int] | tuple = ()
+        previous_key: int = hash((position, depth - 1, maximizing_player))
+        if tt is not None:
+            if (entry := tt.probe(state_key)) is not None and entry[3] or \
+                    (entry := tt.probe(previous_key)) is not None and entry[3]:
+                hash_move = game_state.unpack_move(entry[3])
+        elif (cached := transposition_table.get(previous_key)) is not None:
+            hash_move = cached[1]
 
         best_eval: int = -(1 << 31) if maximizing_player else (1 << 31)
         best_move: tuple[int, int, int] | tuple = ()
-        recurse: Callable = self.minimax
-
-        for move, child, score in child_data:
-            evaluation = score if depth <= 1 else \
+        if hash_move in moves:
+            child: GameStateFormatV2 = move_fn(hash_move)
+            best_eval = (prev_eval if (prev_eval := loose_transposition_table.get(hash(child))) is not None else
+                         eval_fn(child)) if depth <= 1 else \
                 recurse(child, depth - 1, alpha, beta, not maximizing_player, first_call=False)[0]
-
+            best_move = hash_move
             if maximizing_player:
-                if evaluation > best_eval:
+                alpha = max(alpha, best_eval)
+            else:
+                beta = min(beta, best_eval)
+
+        # Only when the hash move does not cut off are the other children made and ordered
+        if beta > alpha:
+            child_data: list[tuple[tuple[int, int, int], GameStateFormatV2, int]] = [
+                (move, child_state := move_fn(move), prev_eval if (prev_eval := loose_transposition_table.get(
+                    hash(child_state))) is not None else eval_fn(child_state)) for move in moves if move != hash_move]
+
+            child_data.sort(key=lambda move: move[2], reverse=maximizing_player)
+
+            for move, child, score in child_data:
+                evaluation = score if depth <= 1 else \
+                    recurse(child, depth - 1, alpha, beta, not maximizing_player, first_call=False)[0]
+
+                if maximizing_player:
+                    if evaluation > best_eval:
+                        best_eval, best_move = evaluation, move
+                        alpha = max(alpha, evaluation)
+                elif evaluation < best_eval:
                     best_eval, best_move = evaluation, move
-                    alpha = max(alpha, evaluation)
-            elif evaluation < best_eval:
-                best_eval, best_move = evaluation, move
-                beta = min(beta, evaluation)
+                    beta = min(beta, evaluation)
 
-            if beta <= alpha:
-                break
+                if beta <= alpha:
+                    break
 
-        transposition_table[state_key] = best_eval, best_move
+        if tt is not None:
+            tt.store_result(state_key, depth, original_alpha, original_beta, best_eval,
+                            game_state.pack_move(best_move) if best_move else 0)
+        else:
+            transposition_table[state_key] = best_eval, best_move
         loose_transposition_table[hash(game_state)] = best_eval
         return best_eval, best_move
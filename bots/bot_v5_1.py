@@ -7,6 +7,7 @@ import numpy as np
 from game_states.game_format_v2 import GameStateFormatV2
 from utils import mirror, negate
 from bots.bot import Bot
+from bots.transposition_table import TranspositionTable
 
 
 def _minimax_worker(bot, game_state, depth, maximizing_player, queue):
@@ -157,18 +158,25 @@ populate_combined_tables()
 
 
 class BotV5p1(Bot):
-    def __init__(self, transposition_table: dict | None = None, eval_lookup: dict | None = None) -> None:
+    def __init__(self, transposition_table: dict | None = None, eval_lookup: dict | None = None,
+                 tt_size_mb: float = 0) -> None:
         self.transposition_table: dict[
             int, tuple[int, tuple[int, int, int]]] = transposition_table if transposition_table is not None else {}
+        # A bounded table with bound flags, used instead of transposition_table when a size is given
+        self.tt: TranspositionTable | None = TranspositionTable(tt_size_mb) if tt_size_mb > 0 else None
         self.eval_lookup: dict[int, int] = eval_lookup if eval_lookup is not None else {}
         self.loose_transposition_table: dict[int, int] = {}
 
     def generate_move(self, game_state: GameStateFormatV2, allotted_time: float = 3.0, depth: int = -1) -> tuple[
         tuple[int, tuple[int, int, int]], int]:
+        if self.tt is not None:
+            self.tt.new_search()
         return self.iterative_deepening(game_state, game_state.color == 1, allotted_time=allotted_time, depth=depth)
 
     def clear_cache(self) -> None:
         self.transposition_table.clear()
+        if self.tt is not None:
+            self.tt.clear()
         self.eval_lookup.clear()
         self.loose_transposition_table.clear()
 
@@ -223,13 +231,19 @@ class BotV5p1(Bot):
         return results[-1], completed_depth
 
     def minimax(self, game_state: GameStateFormatV2, depth: int, alpha: int, beta: int, maximizing_player: bool,
-                first_call: bool = True) -> tuple[int, tuple[int, int, int]]:
+                first_call: bool = True) -> tuple[int, tuple[int, int, int] | tuple]:
         if game_state.get_winner() is not None:
             return self.evaluate(game_state), (game_state.last_move if game_state.last_move is not None else (0, 0, 0))
-        state_key: int = hash((game_state.get_hashable_state(), depth))
+        state_key: int = hash((game_state.hash_state, depth))
         transposition_table: dict[int, tuple[int, tuple[int, int, int]]] = self.transposition_table
-        if (cached := transposition_table.get(state_key)) is not None:
+        tt: TranspositionTable | None = self.tt
+        if tt is not None:
+            if (settled := tt.lookup(state_key, depth, alpha, beta)) is not None:
+                return settled[0], game_state.unpack_move(settled[1]) if settled[1] else ()
+        elif (cached := transposition_table.get(state_key)) is not None:
             return cached
+        # The window the bound of the result is judged against, before the moves below narrow it
+        original_alpha, original_beta = alpha, beta
         moves: tuple[tuple[int, int, int], ...] = tuple(game_state.get_moves() if first_call else
                                                         game_state.get_moves_no_check())
         move_fn: Callable[[tuple[int, int, int]], GameStateFormatV2] = game_state.move
@@ -260,6 +274,10 @@ class BotV5p1(Bot):
             if beta <= alpha:
                 break
 
-        transposition_table[state_key] = best_eval, best_move
+        if tt is not None:
+            tt.store_result(state_key, depth, original_alpha, original_beta, best_eval,
+                            game_state.pack_move(best_move) if best_move else 0)
+        else:
+            transposition_table[state_key] = best_eval, best_move
         loose_transposition_table[hash(game_state)] = best_eval
         return best_eval, best_move
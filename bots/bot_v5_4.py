@@ -1,12 +1,17 @@
 import multiprocessing
+import os
 import time
-from typing import Callable
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Iterator
 
 import numpy as np
 
+from game_states import GameStateV3
 from game_states.game_format_v2 import GameStateFormatV2
 from utils import mirror, negate
-from bots.bot import Bot
+from bots.bot import Bot, SearchAborted
+from bots.engine_worker import PackedState, pack_state, unpack_state
+from bots.transposition_table import TranspositionTable, bound_of, settles
 
 
 def _minimax_worker(bot, game_state, depth, maximizing_player, queue):
@@ -25,6 +30,30 @@ def _drain_queue(q: multiprocessing.Queue, results: list):
 # Use fork context on macOS to avoid spawn from non-main thread
 _ctx = multiprocessing.get_context('fork')
 
+# The copy of the bot each process of a root split searches with, kept with its tables for the life of the pool
+_split_bot: 'BotV5p4 | None' = None
+
+
+def _init_split_worker(bot: 'BotV5p4') -> None:
+    global _split_bot
+    _split_bot = bot
+
+
+def _search_root_move(packed: PackedState, move: tuple[int, int, int], depth: int, alpha: int, beta: int,
+                      maximizing_player: bool, age: int) -> int:
+    # The score of one root move, searched in the window (alpha, beta) by the player after it. The table takes the
+    # age of the bot that split the root, so its slots give way to each new search as they do there.
+    assert _split_bot is not None
+    if _split_bot.tt is not None:
+        _split_bot.tt.age = age
+    return _split_bot.minimax(unpack_state(packed).move(move), depth, alpha, beta, maximizing_player,
+                              first_call=False)[0]
+
+# How many nodes an in-process search visits between looks at the clock and the stop flag
+NODES_PER_CHECK: int = 256
+# The deepest an in-process search with no fixed depth goes before it stops on its own
+MAX_DEPTH: int = 64
+
 piece_values: dict[int, int] = {-6: -9999999,
                                 -5: -900,
                                 -4: -500,
@@ -157,18 +186,55 @@ populate_combined_tables()
 
 
 class BotV5p4(Bot):
-    def __init__(self, transposition_table: dict | None = None, eval_lookup: dict | None = None) -> None:
-        self.transposition_table: dict[
-            int, tuple[int, tuple[int, int, int]]] = transposition_table if transposition_table is not None else {}
+    def __init__(self, transposition_table: dict | None = None, eval_lookup: dict | None = None,
+                 tt_size_mb: float = 0, in_process: bool = False, processes: int = 0) -> None:
+        # Keyed by position alone, with the score, best move, depth and bound of the deepest search of it
+        self.transposition_table: dict[int, tuple[int, tuple[int, int, int] | tuple, int, int]] = \
+            transposition_table if transposition_table is not None else {}
+        # A bounded table with bound flags, used instead of transposition_table when a size is given
+        self.tt: TranspositionTable | None = TranspositionTable(tt_size_mb) if tt_size_mb > 0 else None
         self.eval_lookup: dict[int, int] = eval_lookup if eval_lookup is not None else {}
-
-    def generate_move(self, game_state: GameStateFormatV2, allotted_time: float = 3.0, depth: int = -1) -> tuple[
-        tuple[int, tuple[int, int, int]], int]:
+        # Whether generate_move() searches in this process, keeping the tables warm from one move to the next
+        self.in_process: bool = in_process
+        # When the running search gives up, and anything with an is_set() method that can stop it sooner. These are
+        # the only state a search changes outside the tables, so threads sharing the tables each search with their
+        # own shallow copy of the bot.
+        self.deadline: float = float('inf')
+        self.stop_event: Any = None
+        self.nodes: int = 0
+        # Fixed depths are searched with the root moves split across this many processes when above 1
+        self.processes: int = processes
+        # The pool of the root split, started when first needed, and the process that started it
+        self.executor: ProcessPoolExecutor | None = None
+        self.executor_pid: int = 0
+
+    def generate_move(self, game_state: GameStateFormatV2, allotted_time: float = 3.0, depth: int = -1,
+                      stop_event: Any = None, on_depth: Callable[[int, tuple[int, tuple]], None] | None = None,
+                      start_depth: int = 1) -> tuple[tuple[int, tuple[int, int, int]], int]:
+        """
+        stop_event, on_depth and start_depth are passed on to search(), and only used when the bot searches in process.
+        """
+        if self.tt is not None:
+            self.tt.new_search()
+        if depth > 0 and self.processes > 1:
+            return self.root_split(game_state, depth, game_state.color == 1), depth
+        if self.in_process:
+            return self.search(game_state, game_state.color == 1, allotted_time=allotted_time, depth=depth,
+                               stop_event=stop_event, on_depth=on_depth, start_depth=start_depth)
         return self.iterative_deepening(game_state, game_state.color == 1, allotted_time=allotted_time, depth=depth)
 
     def clear_cache(self) -> None:
         self.transposition_table.clear()
+        if self.tt is not None:
+            self.tt.clear()
         self.eval_lookup.clear()
+        # The pool's copies of the bot have tables of their own
+        self.close()
+
+    def close(self) -> None:
+        if self.executor is not None and self.executor_pid == os.getpid():
+            self.executor.shutdown(cancel_futures=True)
+        self.executor = None
 
     def evaluate(self, game_state: GameStateFormatV2) -> int:
         if game_state.winner is not None:
@@ -220,43 +286,224 @@ class BotV5p4(Bot):
         completed_depth = len(results) - 1
         return results[-1], completed_depth
 
+    def search(self, game_state: GameStateFormatV2, maximizing_player: bool, allotted_time: float = 3.0,
+               depth: int = -1, stop_event: Any = None,
+               on_depth: Callable[[int, tuple[int, tuple]], None] | None = None, start_depth: int = 1) -> tuple[
+        tuple[int, tuple[int, int, int] | tuple], int]:
+        """
+        Iterative deepening in this process, so the tables filled by each depth order the next one and stay filled
+        for the next move of the game.
+
+        Parameters
+        ----------
+        game_state : GameStateFormatV2
+            The position to search.
+        maximizing_player : bool
+            Whether the side to move is white.
+        allotted_time : float, optional
+            The seconds the search may take when depth is not given. Defaults to 3.0.
+        depth : int, optional
+            The depth to search to, ignoring the clock. Defaults to -1, which deepens until the time runs out.
+        stop_event : Any, optional
+            Anything with an is_set() method, such as a threading.Event, that ends the search once set. Defaults to
+            None.
+        on_depth : Callable[[int, tuple[int, tuple]], None] | None, optional
+            Called with each depth as it completes and its score and best move. Defaults to None.
+        start_depth : int, optional
+            The first depth to search, so that searches sharing a table can start out of step. Defaults to 1.
+
+        Returns
+        -------
+        tuple[tuple[int, tuple[int, int, int] | tuple], int]
+            The score and best move of the deepest completed depth, and that depth, which is 0 if none completed.
+        """
+        self.deadline = time.time() + allotted_time if depth <= 0 else float('inf')
+        self.stop_event = stop_event
+        self.nodes = 0
+        result: tuple[int, tuple[int, int, int] | tuple] = (0, game_state.get_moves()[0])
+        completed_depth: int = 0
+        try:
+            max_depth: int = depth if depth > 0 else MAX_DEPTH
+            for current_depth in range(min(start_depth, max_depth), max_depth + 1):
+                result = self.minimax(game_state, current_depth, -(1 << 31), (1 << 31), maximizing_player)
+                completed_depth = current_depth
+                if on_depth is not None:
+                    on_depth(current_depth, result)
+        except SearchAborted:
+            # An unfinished depth stores nothing for the nodes it left, so the tables are still sound
+            pass
+        finally:
+            self.deadline = float('inf')
+            self.stop_event = None
+        return result, completed_depth
+
+    def root_split(self, game_state: GameStateFormatV2, depth: int, maximizing_player: bool) -> tuple[
+        int, tuple[int, int, int] | tuple]:
+        """
+        minimax() to a fixed depth with the root moves searched in parallel.
+
+        The root moves are taken in the order minimax() gives them, and the first is searched here with a full window.
+        Every other move is then searched in the pool with a null window at the best score so far, which only shows
+        whether the move beats it. Each that does is searched again, in root order, with a full window, and when that
+        raises the best score, the null windows not yet started are moved up to it. A move must still score strictly
+        better than every move before it to be played, as in minimax().
+
+        With the same tables, this plays the move minimax() would, with the same score. Each process of the pool keeps
+        tables of its own, though, and a deeper result one of them stored for a transposition can answer a shallower
+        search, so once those tables are warm a root move can score differently than it would in minimax(), and ties
+        between root moves can then go another way.
+        """
+        assert isinstance(game_state, GameStateV3)
+        moves: list[tuple[int, int, int]] = game_state.get_moves()
+        if depth <= 1 or self.processes <= 1 or len(moves) == 1 or game_state.get_winner() is not None:
+            return self.minimax(game_state, depth, -(1 << 31), (1 << 31), maximizing_player)
+        # The root of minimax(): a result the table already settles, or its best move first and then the others
+        hash_move: tuple[int, int, int] | tuple = ()
+        if self.tt is not None:
+            if (entry := self.tt.probe(game_state.hash_state)) is not None:
+                if entry[1] >= depth and settles(entry[0], entry[2], -(1 << 31), (1 << 31)):
+                    return entry[0], game_state.unpack_move(entry[3]) if entry[3] else ()
+                if entry[3]:
+                    hash_move = game_state.unpack_move(entry[3])
+        elif (cached := self.transposition_table.get(game_state.hash_state)) is not None:
+            if cached[2] >= depth and settles(cached[0], cached[3], -(1 << 31), (1 << 31)):
+                return cached[0], cached[1]
+            hash_move = cached[1]
+        ordered: list[tuple[int, int, int]] = [move for move, _, _ in self.order_children(
+            game_state, tuple(moves), hash_move, maximizing_player)]
+        if hash_move in moves:
+            ordered.insert(0, hash_move)
+
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=_ctx, initializer=_init_split_worker,
+                                                initargs=(self,))
+            self.executor_pid = os.getpid()
+        executor: ProcessPoolExecutor = self.executor
+        best_eval: int = self.minimax(game_state.move(ordered[0]), depth - 1, -(1 << 31), (1 << 31),
+                                      not maximizing_player, first_call=False)[0]
+        best_move: tuple[int, int, int] | tuple = ordered[0]
+        packed: PackedState = pack_state(game_state)
+        age: int = self.tt.age if self.tt is not None else 0
+
+        def submit(move: tuple[int, int, int], alpha: int, beta: int) -> Future:
+            return executor.submit(_search_root_move, packed, move, depth - 1, alpha, beta, not maximizing_player,
+                                   age)
+
+        def test(move: tuple[int, int, int], bound: int) -> tuple[Future, int]:
+            # Whether the move scores strictly better than bound, and the bound it was tested against
+            return submit(move, *((bound, bound + 1) if maximizing_player else (bound - 1, bound))), bound
+
+        tests: list[tuple[Future, int]] = [test(move, best_eval) for move in ordered[1:]]
+        for i, move in enumerate(ordered[1:]):
+            future, bound = tests[i]
+            evaluation: int = future.result()
+            if (evaluation > bound if maximizing_player else evaluation < bound) and bound != best_eval:
+                # It beat a score another move has since beaten, so it is tested again against the best one
+                future, bound = test(move, best_eval)
+                evaluation = future.result()
+            if evaluation > bound if maximizing_player else evaluation < bound:
+                # Only a bound, so the move is searched again for its score
+                evaluation = submit(move, *((best_eval, 1 << 31) if maximizing_player else
+                                            (-(1 << 31), best_eval))).result()
+                if evaluation > best_eval if maximizing_player else evaluation < best_eval:
+                    best_eval, best_move = evaluation, move
+                    # The tests the pool has not started yet are moved up to the new best score
+                    for j in range(i + 1, len(tests)):
+                        if tests[j][0].cancel():
+                            tests[j] = test(ordered[j + 1], best_eval)
+        return best_eval, best_move
+
+    def order_children(self, game_state: GameStateFormatV2, moves: tuple[tuple[int, int, int], ...],
+                       hash_move: tuple[int, int, int] | tuple, maximizing_player: bool) -> list[
+        tuple[tuple[int, int, int], GameStateFormatV2, int]]:
+        """
+        The moves other than hash_move with the states they lead to, best first for the player to move by the score
+        the table holds for each state, or its static evaluation when the table holds none.
+        """
+        move_fn: Callable[[tuple[int, int, int]], GameStateFormatV2] = game_state.move
+        eval_fn: Callable[[GameStateFormatV2], int] = self.evaluate
+        # Both tables give back a tuple that starts with the score
+        previous: Callable[[int], tuple | None] = self.transposition_table.get if self.tt is None else self.tt.probe
+        ordered: list[tuple[tuple[int, int, int], GameStateFormatV2, int]] = [
+            (move, child_state := move_fn(move), prev_eval[0] if (prev_eval := previous(
+                child_state.hash_state)) is not None else eval_fn(child_state))
+            for move in moves if move != hash_move]
+        ordered.sort(key=lambda move: move[2], reverse=maximizing_player)
+        return ordered
+
     def minimax(self, game_state: GameStateFormatV2, depth: int, alpha: int, beta: int, maximizing_player: bool,
-                first_call: bool = True) -> tuple[int, tuple[int, int, int]]:
+                first_call: bool = True) -> tuple[int, tuple[int, int, int] | tuple]:
+        self.nodes += 1
+        if not self.nodes % NODES_PER_CHECK and (time.time() >= self.deadline or (
+                self.stop_event is not None and self.stop_event.is_set())):
+            raise SearchAborted
         if game_state.get_winner() is not None:
             return self.evaluate(game_state), (game_state.last_move if game_state.last_move is not None else (0, 0, 0))
-        state_key: int = hash((game_state.get_hashable_state(), depth))
-        transposition_table: dict[int, tuple[int, tuple[int, int, int]]] = self.transposition_table
-        if (cached := transposition_table.get(state_key)) is not None:
-            return cached
-        moves: tuple[tuple[int, int, int], ...] = tuple(game_state.get_moves() if first_call else
-                                                        game_state.get_moves_no_check())
+        # Any search of the position at least this deep can answer, so one entry serves every depth
+        state_key: int = game_state.hash_state
+        transposition_table: dict[int, tuple[int, tuple[int, int, int] | tuple, int, int]] = self.transposition_table
+        tt: TranspositionTable | None = self.tt
+        # The best move of an earlier search of the position, which is tried before any other child is made
+        hash_move: tuple[int, int, int] | tuple = ()
+        if tt is not None:
+            if (entry := tt.probe(state_key)) is not None:
+                if entry[1] >= depth and settles(entry[0], entry[2], alpha, beta):
+                    return entry[0], game_state.unpack_move(entry[3]) if entry[3] else ()
+                if entry[3]:
+                    hash_move = game_state.unpack_move(entry[3])
+        elif (cached := transposition_table.get(state_key)) is not None:
+            if cached[2] >= depth and settles(cached[0], cached[3], alpha, beta):
+                return cached[0], cached[1]
+            hash_move = cached[1]
+        # The window the bound of the result is judged against, before the moves below narrow it
+        original_alpha, original_beta = alpha, beta
         move_fn: Callable[[tuple[int, int, int]], GameStateFormatV2] = game_state.move
         eval_fn: Callable[[GameStateFormatV2], int] = self.evaluate
-        child_data: list[tuple[tuple[int, int, int], GameStateFormatV2, int]] = [
-            (move, child_state := move_fn(move), prev_eval[0] if (prev_eval := transposition_table.get(
-                hash((child_state.get_hashable_state(), depth - 3)))) is not None else eval_fn(child_state)) for move in
-            moves]
-
-        child_data.sort(key=lambda move: move[2], reverse=maximizing_player)
+        recurse: Callable = self.minimax
 
         best_eval: int = -(1 << 31) if maximizing_player else (1 << 31)
         best_move: tuple[int, int, int] | tuple = ()
-        recurse: Callable = self.minimax
-
-        for move, child, score in child_data:
-            evaluation = score if depth <= 1 else \
+        # Entries can come from the pseudo-legal moves of inner nodes, so at the root the move is checked to be legal
+        if hash_move and (not first_call or hash_move in game_state.get_moves()):
+            child: GameStateFormatV2 = move_fn(hash_move)
+            best_eval = eval_fn(child) if depth <= 1 else \
                 recurse(child, depth - 1, alpha, beta, not maximizing_player, first_call=False)[0]
-
+            best_move = hash_move
             if maximizing_player:
-                if evaluation > best_eval:
+                alpha = max(alpha, best_eval)
+            else:
+                beta = min(beta, best_eval)
+
+        # Only when the hash move does not cut off are the other children made and ordered
+        if beta > alpha:
+            moves: tuple[tuple[int, int, int], ...] = tuple(game_state.get_moves() if first_call else
+                                                            game_state.get_moves_no_check())
+            if depth <= 1:
+                # Ordering leaves would cost the same evaluations it could save, so each is made only when reached
+                child_data: Iterator[tuple[tuple[int, int, int], GameStateFormatV2, int]] = (
+                    (move, child_state := move_fn(move), eval_fn(child_state)) for move in moves if move != hash_move)
+            else:
+                child_data = iter(self.order_children(game_state, moves, hash_move, maximizing_player))
+
+            for move, child, score in child_data:
+                evaluation = score if depth <= 1 else \
+                    recurse(child, depth - 1, alpha, beta, not maximizing_player, first_call=False)[0]
+
+                if maximizing_player:
+                    if evaluation > best_eval:
+                        best_eval, best_move = evaluation, move
+                        alpha = max(alpha, evaluation)
+                elif evaluation < best_eval:
                     best_eval, best_move = evaluation, move
-                    alpha = max(alpha, evaluation)
-            elif evaluation < best_eval:
-                best_eval, best_move = evaluation, move
-                beta = min(beta, evaluation)
+                    beta = min(beta, evaluation)
 
-            if beta <= alpha:
-                break
+                if beta <= alpha:
+                    break
 
-        transposition_table[state_key] = best_eval, best_move
+        if tt is not None:
+            tt.store_result(state_key, depth, original_alpha, original_beta, best_eval,
+                            game_state.pack_move(best_move) if best_move else 0)
+        elif (cached := transposition_table.get(state_key)) is None or cached[2] <= depth:
+            transposition_table[state_key] = best_eval, best_move, depth, bound_of(best_eval, original_alpha,
+                                                                                   original_beta)
         return best_eval, best_move
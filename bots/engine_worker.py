@@ -0,0 +1,170 @@
+import multiprocessing
+import threading
+import time
+from multiprocessing.connection import Connection
+from typing import Any, Callable
+
+from game_states import GameStateV3
+from game_states.game_base import PositionHistory
+from bots.bot import Bot
+
+# Use fork context on macOS to avoid spawn from non-main thread
+_ctx = multiprocessing.get_context('fork')
+
+# How long past its allotted time a search may run before the front end tells it to stop
+STOP_MARGIN: float = .05
+
+PackedState = tuple[bytes, int, int, tuple[int, int, int] | None, int, int | None, int, tuple[int, ...]]
+
+
+def pack_state(game_state: GameStateV3) -> PackedState:
+    """
+    The parts of a position a search needs, as a flat tuple that pickles to a small fraction of the state itself,
+    which would bring its cached moves and child states along.
+
+    The board goes as one byte per square, the castling rights as four bits, and the repetition history only as far
+    back as the last pawn move or capture, since nothing before it can repeat.
+    """
+    history: list[int] = []
+    position_history: PositionHistory | None = game_state.position_history
+    while position_history is not None and len(history) < game_state.moves_since_pawn:
+        history.append(position_history[0])
+        position_history = position_history[1]
+    castling: int = (game_state.white_queen | game_state.white_king << 1 | game_state.black_queen << 2 |
+                     game_state.black_king << 3)
+    return (bytes(piece + 6 for piece in game_state.board), game_state.color, castling, game_state.last_move,
+            game_state.turn, game_state.winner, game_state.moves_since_pawn, tuple(history))
+
+
+def unpack_state(packed: PackedState) -> GameStateV3:
+    """ The GameStateV3 pack_state() was given back. """
+    board, color, castling, last_move, turn, winner, moves_since_pawn, history = packed
+    position_history: PositionHistory | None = None
+    for key in reversed(history):
+        position_history = (key, position_history)
+    return GameStateV3(tuple(piece - 6 for piece in board), bool(castling & 1), bool(castling & 2),
+                       bool(castling & 4), bool(castling & 8), last_move, color, turn, winner,
+                       position_history=position_history, moves_since_pawn=moves_since_pawn)
+
+
+def _serve(bot: Bot, connection: Connection, stop_event: Any) -> None:
+    """
+    The loop of the worker process. It takes these messages, one at a time:
+
+    ('go', packed_state, allotted_time, depth, options)
+        Search the position, sending ('info', depth, (score, move)) as each depth completes when the bot searches in
+        process, and then ('done', ((score, move), depth)). options are passed on to the generate_move() of a bot
+        that searches in process, and ignored by the others.
+    ('clear',)
+        Clear the bot's caches.
+    ('quit',)
+        Stop the worker.
+    """
+    in_process: bool = getattr(bot, 'in_process', False)
+
+    def send_depth(depth: int, result: tuple[int, tuple]) -> None:
+        connection.send(('info', depth, result))
+
+    while True:
+        try:
+            message: tuple = connection.recv()
+        except EOFError:
+            break
+        if message[0] == 'go':
+            _, packed, allotted_time, depth, options = message
+            game_state: GameStateV3 = unpack_state(packed)
+            if in_process:
+                result = bot.generate_move(game_state, allotted_time, depth, stop_event=stop_event,  # type: ignore
+                                           on_depth=send_depth, **options)
+            else:
+                result = bot.generate_move(game_state, allotted_time, depth)
+            connection.send(('done', result))
+        elif message[0] == 'clear':
+            bot.clear_cache()
+        elif message[0] == 'quit':
+            break
+    connection.close()
+
+
+class EngineWorker(Bot):
+    """
+    A bot that searches in a process of its own, started once and kept for every move, so nothing is paid to start a
+    process per move and the bot's transposition table and eval cache stay filled from one move to the next.
+
+    generate_move() sends the position over a pipe and waits for the result, so the worker can stand in for the bot
+    it wraps. Positions must be GameStateV3.
+    """
+
+    def __init__(self, bot: Bot, stop_event: Any = None) -> None:
+        """
+        Parameters
+        ----------
+        bot : Bot
+            The bot to search with. One that can search in process, such as BotV5p4, is switched to it, so that its
+            tables live on in the worker and each depth is reported as it completes.
+        stop_event : Any, optional
+            A multiprocessing Event that stops the search, which several workers can share. Defaults to None, which
+            makes one for this worker.
+        """
+        if hasattr(bot, 'in_process'):
+            bot.in_process = True  # type: ignore
+        self.bot: Bot = bot
+        self.stop_event = stop_event if stop_event is not None else _ctx.Event()
+        self.connection, worker_connection = _ctx.Pipe()
+        self.process = _ctx.Process(target=_serve, args=(bot, worker_connection, self.stop_event), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        # Sends can come from both the GUI thread and a search thread, and must not interleave
+        self.send_lock: threading.Lock = threading.Lock()
+        # The score and best move of each depth of the last search, in the order they completed
+        self.depth_results: list[tuple[int, tuple[int, tuple]]] = []
+        # Called with each of depth_results as it arrives
+        self.on_depth: Callable[[int, tuple[int, tuple]], None] | None = None
+
+    def send(self, *message: Any) -> None:
+        with self.send_lock:
+            self.connection.send(message)
+
+    def start_search(self, game_state: GameStateV3, allotted_time: float = 3.0, depth: int = -1,
+                     **options: Any) -> None:
+        """ Start a search without waiting for it, with options for the generate_move() of the bot. """
+        self.depth_results.clear()
+        self.stop_event.clear()
+        self.send('go', pack_state(game_state), allotted_time, depth, options)
+
+    def read_message(self) -> tuple[tuple[int, tuple], int] | None:
+        """ Take one message from the worker, giving back the result of the search if it was the last one. """
+        message: tuple = self.connection.recv()
+        if message[0] == 'done':
+            return message[1]
+        self.depth_results.append((message[1], message[2]))
+        if self.on_depth is not None:
+            self.on_depth(message[1], message[2])
+        return None
+
+    def generate_move(self, game_state: GameStateV3, allotted_time: float = 3.0, depth: int = -1) -> tuple[
+        tuple[int, tuple], int]:
+        self.start_search(game_state, allotted_time, depth)
+        deadline: float | None = time.time() + allotted_time + STOP_MARGIN if depth <= 0 else None
+        while True:
+            if deadline is not None and not self.connection.poll(max(0.0, deadline - time.time())):
+                # A bot that does not check the clock often enough is told to finish with what it has
+                self.stop_event.set()
+                deadline = None
+                continue
+            if (result := self.read_message()) is not None:
+                return result
+
+    def clear_cache(self) -> None:
+        self.send('clear')
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            self.stop_event.set()
+            self.send('quit')
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
+
+    def get_version(self) -> str:  # type: ignore[override]
+        return f'{self.bot.get_version()}W'
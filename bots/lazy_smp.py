@@ -0,0 +1,166 @@
+import copy
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from multiprocessing.synchronize import Event as ProcessEvent
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from multiprocessing.connection import Connection, wait
+from multiprocessing.shared_memory import SharedMemory
+
+from game_states import GameStateV3
+from bots.bot import Bot
+from bots.engine_worker import EngineWorker, STOP_MARGIN, pack_state, unpack_state
+from bots.transposition_table import TranspositionTable, table_bytes
+
+# Use fork context on macOS to avoid spawn from non-main thread
+_ctx = multiprocessing.get_context('fork')
+
+
+def gil_enabled() -> bool:
+    """ Whether only one thread runs Python at a time, as in every build before the free-threaded ones of 3.13. """
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is None or is_gil_enabled()
+
+
+class LazySMP(Bot):
+    """
+    Lazy SMP: several workers search the same position at once, sharing one transposition table, and the deepest depth
+    any of them completes is played.
+
+    The workers do not split the tree between them. Each runs the whole iterative deepening, and what one stores the
+    others find, so between them they cover more of the tree at each depth than one search would. Every other worker
+    starts a depth deeper, so the workers are not all searching the same depth in the same order.
+
+    On a free-threaded build the workers are threads, each with a shallow copy of the bot, so the copies share its
+    tables without any copying or pickling. Otherwise they are processes, with the table in shared memory. The table
+    needs no lock either way: each slot's key is checked against its data, so a slot two workers write at once reads
+    as a miss, and the eval cache only ever gains entries that are the same whoever writes them.
+
+    The bot must keep its table in a tt attribute, like BotV5p4, and positions must be GameStateV3. Threads also need
+    the bot to have search(), as BotV5p4 does.
+    """
+
+    def __init__(self, bot: Bot, workers: int | None = None, tt_size_mb: float = 64,
+                 threads: bool | None = None) -> None:
+        """
+        Parameters
+        ----------
+        bot : Bot
+            The bot each worker searches with, copied into every worker.
+        workers : int | None, optional
+            The number of worker processes. Defaults to None, which uses every CPU.
+        tt_size_mb : float, optional
+            The size of the shared transposition table in megabytes. Defaults to 64.
+        threads : bool | None, optional
+            Whether the workers are threads rather than processes. Defaults to None, which uses threads only when the
+            GIL is disabled.
+        """
+        self.bot: Bot = bot
+        self.threads: bool = not gil_enabled() if threads is None else threads
+        count: int = workers or os.cpu_count() or 1
+        self.shared_memory: SharedMemory | None = None
+        self.workers: list[EngineWorker] = []
+        self.helpers: list[Bot] = []
+        self.executor: ThreadPoolExecutor | None = None
+        # Threads share a threading Event and processes a multiprocessing one, which have the same methods
+        self.stop_event: threading.Event | ProcessEvent
+        if self.threads:
+            self.tt: TranspositionTable = TranspositionTable(tt_size_mb)
+            bot.tt = self.tt  # type: ignore
+            # Each copy keeps its own search state, such as its node count and deadline, and shares the tables
+            self.helpers = [copy.copy(bot) for _ in range(count)]
+            self.executor = ThreadPoolExecutor(count)
+            self.stop_event = threading.Event()
+        else:
+            self.shared_memory = SharedMemory(create=True, size=table_bytes(tt_size_mb))
+            self.tt = TranspositionTable(tt_size_mb, self.shared_memory.buf)
+            bot.tt = self.tt  # type: ignore
+            # One event stops every worker at once
+            self.stop_event = _ctx.Event()
+            self.workers = [EngineWorker(bot, self.stop_event) for _ in range(count)]
+
+    def generate_move(self, game_state: GameStateV3, allotted_time: float = 3.0, depth: int = -1) -> tuple[
+        tuple[int, tuple], int]:
+        if self.threads:
+            return self.generate_move_threads(game_state, allotted_time, depth)
+        for i, worker in enumerate(self.workers):
+            worker.start_search(game_state, allotted_time, depth, start_depth=1 + i % 2)
+        by_connection: dict[Connection, EngineWorker] = {worker.connection: worker for worker in self.workers}
+        best: tuple[tuple[int, tuple], int] | None = None
+        deadline: float | None = time.time() + allotted_time + STOP_MARGIN if depth <= 0 else None
+        while by_connection:
+            ready: list = wait(list(by_connection), None if deadline is None else max(0.0, deadline - time.time()))
+            if not ready:
+                self.stop_event.set()
+                deadline = None
+                continue
+            for connection in ready:
+                ready_worker: EngineWorker = by_connection[connection]
+                result: tuple[tuple[int, tuple], int] | None = ready_worker.read_message()
+                if result is None:
+                    result = ready_worker.depth_results[-1][1], ready_worker.depth_results[-1][0]
+                else:
+                    del by_connection[connection]
+                # Ties go to the worker that got there first
+                if best is None or result[1] > best[1]:
+                    best = result
+                # A fixed depth is done once any worker completes it
+                if 0 < depth <= best[1]:
+                    self.stop_event.set()
+        assert best is not None
+        return best
+
+    def generate_move_threads(self, game_state: GameStateV3, allotted_time: float = 3.0, depth: int = -1) -> tuple[
+        tuple[int, tuple], int]:
+        """ generate_move() with the workers as threads. """
+        assert self.executor is not None
+        lock: threading.Lock = threading.Lock()
+        # Every depth completed by any thread, in the order they completed
+        completed: list[tuple[int, tuple[int, tuple]]] = []
+
+        def on_depth(completed_depth: int, result: tuple[int, tuple]) -> None:
+            with lock:
+                completed.append((completed_depth, result))
+            # A fixed depth is done once any thread completes it
+            if 0 < depth <= completed_depth:
+                self.stop_event.set()
+
+        self.stop_event.clear()
+        self.tt.new_search()
+        # Each thread gets a copy of the root, since states fill in their cached moves as they are searched
+        futures: list[Future] = [
+            self.executor.submit(helper.search, unpack_state(pack_state(game_state)),  # type: ignore
+                                 game_state.color == 1, allotted_time, depth, self.stop_event, on_depth, 1 + i % 2)
+            for i, helper in enumerate(self.helpers)]
+        if wait_futures(futures, allotted_time + STOP_MARGIN if depth <= 0 else None).not_done:
+            self.stop_event.set()
+        results: list[tuple[tuple[int, tuple], int]] = [future.result() for future in futures]
+        if not completed:
+            return results[0]
+        # Ties go to the thread that got there first
+        deepest: int = max(completed_depth for completed_depth, _ in completed)
+        return next(result for completed_depth, result in completed if completed_depth == deepest), deepest
+
+    def clear_cache(self) -> None:
+        if self.threads:
+            self.bot.clear_cache()
+        # Every worker clears its own caches, and with them the shared table
+        for worker in self.workers:
+            worker.clear_cache()
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.stop_event.set()
+            self.executor.shutdown()
+        for worker in self.workers:
+            worker.close()
+        if self.shared_memory is not None:
+            assert isinstance(self.tt.words, memoryview)
+            self.tt.words.release()
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+
+    def get_version(self) -> str:  # type: ignore[override]
+        return f'{self.bot.get_version()}x{len(self.workers or self.helpers)}'
@@ -0,0 +1,158 @@
+from array import array
+from typing import Any
+
+# What a stored score says about the true score. An exact score came from a full window, a lower bound from a search
+# that failed high (a cutoff) and an upper bound from one that failed low, where no move reached alpha.
+LOWER: int = 1
+UPPER: int = 2
+EXACT: int = LOWER | UPPER
+
+# Each slot is two 64-bit words, the key XOR the data and the data. The data holds the packed move in bits 0-15, the
+# bound in bits 16-17, the search age in bits 18-23, the depth in bits 24-30 and the score, offset to stay positive, in
+# bits 31-63.
+BOUND_SHIFT: int = 16
+AGE_SHIFT: int = 18
+DEPTH_SHIFT: int = 24
+SCORE_SHIFT: int = 31
+SCORE_OFFSET: int = 1 << 32
+AGE_MASK: int = 63
+DEPTH_MASK: int = 127
+KEY_MASK: int = (1 << 64) - 1
+# Shared tables are zeroed this many bytes at a time, so clearing one does not need a second copy of it
+CLEAR_CHUNK: int = 1 << 20
+
+# A bucket is two slots: one kept for the deepest result and one that every other result goes into
+BUCKET_WORDS: int = 4
+BUCKET_BYTES: int = 8 * BUCKET_WORDS
+
+
+def table_bytes(size_mb: float) -> int:
+    """ The bytes a table with a budget of size_mb megabytes uses, a power of two number of buckets. """
+    return BUCKET_BYTES << max(0, (int(size_mb * (1 << 20)) // BUCKET_BYTES).bit_length() - 1)
+
+
+def bound_of(score: int, alpha: int, beta: int) -> int:
+    """ The bound a score searched in the window (alpha, beta) gives. """
+    return UPPER if score <= alpha else (LOWER if score >= beta else EXACT)
+
+
+def settles(score: int, bound: int, alpha: int, beta: int) -> bool:
+    """ Whether a stored score answers a search in the window (alpha, beta) without searching again. """
+    return bound == EXACT or (bound == LOWER and score >= beta) or (bound == UPPER and score <= alpha)
+
+
+class TranspositionTable:
+    """
+    A fixed-size transposition table in one flat array of 64-bit words, so its memory use does not grow with the
+    search.
+
+    Keys are reduced to a bucket index, and the whole key is stored so that a probe can tell a hit from another
+    position sharing the bucket. It is stored XORed with the data, so when processes share the table and one reads a
+    slot another is halfway through writing, the key does not match and the slot reads as empty. The first slot of a
+    bucket only gives way to results at least as deep, or to any result once its own is from an older search, and the
+    second slot always takes what the first turns away.
+    """
+    __slots__ = ('words', 'bucket_mask', 'age')
+
+    def __init__(self, size_mb: float = 16, buffer: Any = None) -> None:
+        """
+        Parameters
+        ----------
+        size_mb : float, optional
+            The memory budget in megabytes, rounded down to a power of two number of buckets. Defaults to 16.
+        buffer : Any, optional
+            A zeroed, writable buffer of table_bytes(size_mb) bytes to keep the table in instead of a new array, such as
+            the buf of a multiprocessing.shared_memory.SharedMemory, so that processes can share the table. Defaults to
+            None.
+        """
+        size: int = table_bytes(size_mb)
+        self.words: array | memoryview = array('Q', bytes(size)) if buffer is None else \
+            memoryview(buffer)[:size].cast('Q')
+        self.bucket_mask: int = size // BUCKET_BYTES - 1
+        self.age: int = 0
+
+    def clear(self) -> None:
+        # Zeroed in place, so every process sharing the table sees it cleared
+        with memoryview(self.words).cast('B') as view:
+            for start in range(0, len(view), CLEAR_CHUNK):
+                view[start:start + CLEAR_CHUNK] = bytes(min(CLEAR_CHUNK, len(view) - start))
+        self.age = 0
+
+    def new_search(self) -> None:
+        """ Mark every stored entry as from an older search, so the depth-preferred slots can be replaced again. """
+        self.age = (self.age + 1) & AGE_MASK
+
+    def probe(self, key: int) -> tuple[int, int, int, int] | None:
+        """
+        Look a position up.
+
+        Returns
+        -------
+        tuple[int, int, int, int] | None
+            The score, depth, bound and packed move of the entry for key, or None if there is none.
+        """
+        key &= KEY_MASK
+        words: array | memoryview = self.words
+        index: int = (key & self.bucket_mask) * BUCKET_WORDS
+        data: int = words[index + 1]
+        if not data or words[index] ^ data != key:
+            index += 2
+            data = words[index + 1]
+            if not data or words[index] ^ data != key:
+                return None
+        return ((data >> SCORE_SHIFT) - SCORE_OFFSET, data >> DEPTH_SHIFT & DEPTH_MASK, data >> BOUND_SHIFT & 3,
+                data & 0xFFFF)
+
+    def lookup(self, key: int, depth: int, alpha: int, beta: int) -> tuple[int, int] | None:
+        """
+        The score and packed move of an entry for key that settles a search to depth in the window (alpha, beta).
+
+        An entry searched at least as deep settles the search when it is exact, when it is a lower bound at or above
+        beta, or when it is an upper bound at or below alpha.
+        """
+        entry: tuple[int, int, int, int] | None = self.probe(key)
+        if entry is None:
+            return None
+        score, entry_depth, bound, packed_move = entry
+        if entry_depth >= depth and settles(score, bound, alpha, beta):
+            return score, packed_move
+        return None
+
+    def store(self, key: int, depth: int, bound: int, score: int, packed_move: int = 0) -> None:
+        """ Save a search result, where packed_move is 0 when there is no best move to keep. """
+        key &= KEY_MASK
+        words: array | memoryview = self.words
+        index: int = (key & self.bucket_mask) * BUCKET_WORDS
+        data: int = words[index + 1]
+        stored_key: int = words[index] ^ data
+        if stored_key == key or words[index + 2] ^ words[index + 3] == key:
+            if stored_key != key:
+                index += 2
+                data = words[index + 1]
+                stored_key = key
+            # A shallower result for the same position in the same search would only lose information
+            if data >> DEPTH_SHIFT & DEPTH_MASK > depth and data >> AGE_SHIFT & AGE_MASK == self.age:
+                return
+        elif data and data >> DEPTH_SHIFT & DEPTH_MASK > depth and data >> AGE_SHIFT & AGE_MASK == self.age:
+            index += 2
+            data = words[index + 1]
+            stored_key = words[index] ^ data
+        # A result without a move keeps the one already known for the position
+        if not packed_move and stored_key == key:
+            packed_move = data & 0xFFFF
+        data = ((score + SCORE_OFFSET) << SCORE_SHIFT | min(depth, DEPTH_MASK) << DEPTH_SHIFT |
+                self.age << AGE_SHIFT | bound << BOUND_SHIFT | packed_move)
+        words[index] = key ^ data
+        words[index + 1] = data
+
+    def store_result(self, key: int, depth: int, alpha: int, beta: int, score: int, packed_move: int = 0) -> None:
+        """ store() a score searched in the window (alpha, beta), with the bound that window gives it. """
+        self.store(key, depth, bound_of(score, alpha, beta), score, packed_move)
+
+    def hashfull(self) -> int:
+        """ How many of the first thousand slots are used by the current search, per mille. """
+        words: array | memoryview = self.words
+        slots: int = min(1000, len(words) // 2)
+        age: int = self.age
+        return sum(1 for i in range(1, 2 * slots, 2) if words[i] and words[i] >> AGE_SHIFT & AGE_MASK == age) * 1000 \
+            // slots
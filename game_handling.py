@@ -35,6 +35,9 @@ images = [
 
 
 def display_board(screen, game_state: GameStateBase, selected_square=(), offset=0):
+    if isinstance(game_state, GameStateBitboardsV3):
+        # Every state made from this one keeps the mailbox too, so later frames start with it
+        game_state.track_pieces()
     for i in range(8):
         for j in range(8):
             if selected_square == (i, j):
@@ -46,7 +49,11 @@ def display_board(screen, game_state: GameStateBase, selected_square=(), offset=
             if isinstance(game_state, GameState) or isinstance(game_state, GameStateFormatV2):
                 if game_state.board[i * 8 + j] != 0:
                     screen.blit(images[game_state.board[i * 8 + j] + 6], (j * 60 + offset, i * 60))
-            elif isinstance(game_state, GameStateBitboardsV2) or isinstance(game_state, GameStateBitboardsV3):
+            elif isinstance(game_state, GameStateBitboardsV3):
+                # A single read, from the mailbox
+                if (piece := game_state.piece_at(i * 8 + j)) != 0:
+                    screen.blit(images[piece + 6], (j * 60 + offset, i * 60))
+            elif isinstance(game_state, GameStateBitboardsV2):
                 piece = 0
                 piece_mask = 1 << (63 - (i * 8 + j))
                 if not piece_mask & (game_state.white_pieces | game_state.black_pieces):
@@ -331,6 +338,8 @@ def game_loop() -> None:
         BotV4,
         BotV4p2,
         BotV4p3,
+        lambda: EngineWorker(BotV5p4(tt_size_mb=64)),
+        lambda: LazySMP(BotV5p4()),
     )
     bot_idxs: list[int] = [3, 1]
     bots: list[Bot] = [bot_options[bot_idxs[0]](), bot_options[bot_idxs[1]]()]
@@ -412,10 +421,12 @@ def game_loop() -> None:
                     options_buttons[1].text = "Test" if test_mode else "Normal"
                 elif options_buttons[2].check_hover(pos):
                     bot_idxs[0] = (bot_idxs[0] + 1) % len(bot_options)
+                    bots[0].close()
                     bots[0] = bot_options[bot_idxs[0]]()
                     options_buttons[2].text = bots[0].get_version()
                 elif options_buttons[3].check_hover(pos):
                     bot_idxs[1] = (bot_idxs[1] + 1) % len(bot_options)
+                    bots[1].close()
                     bots[1] = bot_options[bot_idxs[1]]()
                     options_buttons[3].text = bots[1].get_version()
 
@@ -513,5 +524,7 @@ def game_loop() -> None:
 
         pygame.display.flip()
 
+    bots[0].close()
+    bots[1].close()
     pygame.quit()
     sys.exit()
@@ -745,9 +745,9 @@ class GameStateCorrect(GameStateFormatV2):
                     moves.append((h, h + 16, piece))
                 # En Passant
                 if last_move_local is not None and i == last_move_local[1] // 8:
-                    if 7 != j == last_move_local[1] % 8 + 1:
+                    if j == last_move_local[1] % 8 + 1:
                         moves.append((-2, -1, h))
-                    elif 0 != j == last_move_local[1] % 8 - 1:
+                    elif j == last_move_local[1] % 8 - 1:
                         moves.append((-2, 1, h))
         return moves
 
@@ -303,9 +303,9 @@ class GameState(GameStateBase):
                 if (last_move_local is not None and board_local[
                     last_move_local[2] * 8 + last_move_local[3]] == -color_local and abs(
                     last_move_local[2] - last_move_local[0]) == 2 and i == last_move_local[2]):
-                    if 7 != j == last_move_local[3] + 1:
+                    if j == last_move_local[3] + 1:
                         moves.append((-2, -1, i, j))
-                    elif 0 != j == last_move_local[3] - 1:
+                    elif j == last_move_local[3] - 1:
                         moves.append((-2, 1, i, j))
         return moves
 
@@ -483,6 +483,13 @@ class GameState(GameStateBase):
                                   self.color, self.turn, self.winner, self.previous_position_count,
                                   self.moves_since_pawn)
 
+    def en_passant_move(self) -> tuple[int, int, int] | None:
+        """ The last double push as the bitboard engines keep it, with the masks and one more than the file. """
+        if self.last_move is None:
+            return None
+        r0, c0, r1, c1 = self.last_move
+        return 1 << (63 - r0 * 8 - c0), 1 << (63 - r1 * 8 - c1), c1 + 1
+
     def to_bitboards_v2(self) -> GameStateBitboardsV2:
         pawns: int = 0
         knights: int = 0
@@ -514,7 +521,8 @@ class GameState(GameStateBase):
             elif piece_type == 6:
                 kings |= piece_mask
         return GameStateBitboardsV2(white, black, kings, queens, rooks, bishops, knights, pawns, self.white_queen,
-                                    self.white_king, self.black_queen, self.black_king, color=self.color,
+                                    self.white_king, self.black_queen, self.black_king,
+                                    last_move=self.en_passant_move(), color=self.color,
                                     turn=self.turn, winner=self.winner, moves_since_pawn=self.moves_since_pawn,
                                     previous_position_count=self.previous_position_count)
 
@@ -548,10 +556,11 @@ class GameState(GameStateBase):
                 queens |= piece_mask
             elif piece_type == 6:
                 kings |= piece_mask
+        # The repetition history is keyed by Zobrist keys there, so the counts here cannot carry over
         return GameStateBitboardsV3(white, black, kings, queens, rooks, bishops, knights, pawns, self.white_queen,
-                                    self.white_king, self.black_queen, self.black_king, color=self.color,
-                                    turn=self.turn, winner=self.winner, moves_since_pawn=self.moves_since_pawn,
-                                    previous_position_count=self.previous_position_count)
+                                    self.white_king, self.black_queen, self.black_king,
+                                    last_move=self.en_passant_move(), color=self.color,
+                                    turn=self.turn, winner=self.winner, moves_since_pawn=self.moves_since_pawn)
 
     def to_v2(self) -> GameStateV2:
         return GameStateV2(self.board, self.white_queen, self.white_king, self.black_queen, self.black_king,
@@ -559,9 +568,13 @@ class GameState(GameStateBase):
                            self.moves_since_pawn)
 
     def to_v3(self) -> GameStateV3:
+        # The repetition history is keyed by Zobrist keys there, so the counts here cannot carry over
+        last_move: tuple[int, int, int] | None = None
+        if self.last_move is not None:
+            last_move = (self.last_move[0] * 8 + self.last_move[1], self.last_move[2] * 8 + self.last_move[3],
+                         -self.color)
         return GameStateV3(self.board, self.white_queen, self.white_king, self.black_queen, self.black_king,
-                           None, self.color, self.turn, self.winner, copy(self.previous_position_count),
-                           self.moves_since_pawn)
+                           last_move, self.color, self.turn, self.winner, moves_since_pawn=self.moves_since_pawn)
 
     def to_v3_list(self) -> GameStateV3List:
         return GameStateV3List(list(self.board), self.white_queen, self.white_king, self.black_queen, self.black_king,
@@ -1,7 +1,31 @@
 from typing import Any
 
+# The position keys of a game so far, newest first, as (key, rest of the history) links. A move adds one link on top
+# of its parent's history, so every state in a search tree shares the links of the moves that led to it.
+PositionHistory = tuple[int, 'PositionHistory | None']
+
+
+def repetition_count(position_history: PositionHistory | None, key: int, limit: int) -> int:
+    """
+    Count how many times key appears in the newest limit entries of position_history.
+
+    Positions from before the last irreversible move can never come back, so callers pass the number of entries made
+    since then as limit, which keeps the scan as short as the halfmove clock.
+    """
+    count: int = 0
+    while position_history is not None and limit > 0:
+        if position_history[0] == key:
+            count += 1
+        position_history = position_history[1]
+        limit -= 1
+    return count
+
 
 class GameStateBase:
+    # Whether states count earlier positions in previous_position_count, which those that keep a position_history
+    # instead leave out
+    keeps_position_count: bool = True
+
     def __init__(self, white_queen: bool = True, white_king: bool = True,
                  black_queen: bool = True, black_king: bool = True,
                  color: int = 1, turn: int = 0, winner: int | None = None,
@@ -13,8 +37,9 @@ class GameStateBase:
         self.black_king: bool = black_king
         self.turn: int = turn
         self.winner: int | None = winner
-        self.previous_position_count: dict[
-            int, int] = previous_position_count if previous_position_count is not None else {}
+        if self.keeps_position_count:
+            self.previous_position_count: dict[
+                int, int] = previous_position_count if previous_position_count is not None else {}
         self.moves_since_pawn: int = moves_since_pawn
 
     def get_hashable_state(self) -> Any:
@@ -41,6 +66,15 @@ class GameStateBase:
     def are_captures(self) -> bool:
         raise NotImplementedError
 
+    def is_square_attacked(self, square: int, by_color: int) -> bool:
+        """ Whether any piece of by_color attacks the square, with squares indexed from a8 = 0 to h1 = 63. """
+        raise NotImplementedError
+
+    @property
+    def in_check(self) -> bool:
+        """ Whether the king of the player to move is attacked. """
+        raise NotImplementedError
+
     def move(self, move: Any) -> 'GameStateBase':
         """
         Make a move on the board.
@@ -288,14 +288,14 @@ class GameStateBitboardsV2(GameStateBase):
                 # Double push
                 if color_local == 1:
                     if i == 6 and not (pieces & (dest_square_mask | (dest_square_mask << 8))):
-                        moves.append((mask, (dest_square_mask << 8), j))
+                        moves.append((mask, (dest_square_mask << 8), j + 1))
                 elif i == 1 and not (pieces & (dest_square_mask | (dest_square_mask >> 8))):
-                    moves.append((mask, (dest_square_mask >> 8), j))
-                # En Passant
-                if last_move_local is not None and (i == 3 or i == 4):
-                    if 7 != j == last_move_local[2] + 1:
+                    moves.append((mask, (dest_square_mask >> 8), j + 1))
+                # En Passant, where last_move[2] is one more than the file so that the a file is not 0
+                if last_move_local is not None and i == (3 if color_local == 1 else 4):
+                    if j == last_move_local[2]:
                         moves.append((-2, -1, mask))
-                    elif 0 != j == last_move_local[2] - 1:
+                    elif j == last_move_local[2] - 2:
                         moves.append((-2, 1, mask))
             elif kings & mask:
                 if (((color_local == 1 and self.white_king) or (
@@ -418,8 +418,9 @@ class GameStateBitboardsV2(GameStateBase):
                     new_rooks = ((
                                              new_rooks & ~0b0000_0001_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
                                  0b0000_0100_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
-                new_kings = ((new_kings & ~0b0000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
-                             0b0000_0010_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
+                    new_kings = ((
+                                             new_kings & ~0b0000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
+                                 0b0000_0010_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
             return GameStateBitboardsV2(new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks,
                                         new_bishops,
                                         new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
@@ -471,6 +472,11 @@ class GameStateBitboardsV2(GameStateBase):
             else:
                 new_black_pieces = (new_black_pieces & ~move_2) | new_piece_mask
                 new_white_pieces &= ~new_piece_mask
+            # Clear the taken piece from whichever bitboard holds it
+            new_rooks &= ~new_piece_mask
+            new_queens &= ~new_piece_mask
+            new_bishops &= ~new_piece_mask
+            new_knights &= ~new_piece_mask
             new_pawns &= ~move_2
             if move_0 == -7:
                 new_queens |= new_piece_mask
@@ -486,27 +492,16 @@ class GameStateBitboardsV2(GameStateBase):
                                         new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
                                         color=-color_local, turn=self.turn + 1, winner=self.winner)
 
-        # ========================================================================
-        # This is wierd below. Double check when revisiting
-        # ========================================================================
-        condition2: int = (new_kings | new_rooks) & move_0
-        if (new_rooks | move_0) or condition2:
-            # if move_2 == 7 and not move_3:
-            if move_1 == 0b1000_0000:
-                white_queen = False
-            if move_1 == 1:
-                white_king = False
-            if move_1 == 0b10000000_00000000_00000000_00000000_00000000_00000000_00000000_00000000:
-                black_queen = False
-            if move_1 == 0b00000001_00000000_00000000_00000000_00000000_00000000_00000000_00000000:
-                black_king = False
-        if condition2:
-            if move_1 == 0b0000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000:
-                black_queen = False
-                black_king = False
-            if move_1 == 0b0000_1000:
-                white_queen = False
-                white_king = False
+        # Moving the king or a rook off its square, or taking a rook on its square, gives up castling on that side
+        touched: int = move_0 | move_1
+        if touched & 0b1000_1000:
+            white_queen = False
+        if touched & 0b0000_1001:
+            white_king = False
+        if touched & 0b1000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000:
+            black_queen = False
+        if touched & 0b0000_1001_00000000_00000000_00000000_00000000_00000000_00000000_00000000:
+            black_king = False
 
         if self.pawns & move_0:
             new_moves_since_pawn = 0
@@ -1,4 +1,10 @@
-from game_states.game_base import GameStateBase
+from typing import Callable, Iterator
+
+from game_states.game_base import GameStateBase, PositionHistory, repetition_count
+from game_states.material import piece_deltas
+from game_states.move_encoding import NORMAL, DOUBLE_PUSH, CASTLE, EN_PASSANT, PROMOTION, encode_move, \
+    decode_move
+from game_states.zobrist import piece_square_keys, state_key
 
 # Precompute index-to-coordinate mapping for faster lookups
 index_to_coord: list[tuple[int, int]] = [(h // 8, h % 8) for h in range(64)]
@@ -15,12 +21,135 @@ promotion_taking: tuple[tuple[int, int], ...] = ((-7, 1), (-6, 1), (-5, 1), (-4,
 # Precomputed bit mask for each square
 bit_masks: list[int] = [1 << (63 - h) for h in range(64)]
 
+full_board: int = (1 << 64) - 1
+
+# Magic bitboard tables for sliding pieces. For square h, the blockers on the relevant squares are
+# multiplied by the magic number and shifted down to index the table of attack sets for that square.
+rook_masks: tuple[int, ...]
+bishop_masks: tuple[int, ...]
+rook_shifts: tuple[int, ...]
+bishop_shifts: tuple[int, ...]
+rook_attack_table: tuple[tuple[int, ...], ...]
+bishop_attack_table: tuple[tuple[int, ...], ...]
+
+# Attack sets of the non-sliding pieces as single masks
+knight_attack_masks: tuple[int, ...]
+king_attack_masks: tuple[int, ...]
+white_pawn_attacks: tuple[int, ...]
+black_pawn_attacks: tuple[int, ...]
+# between_masks[a][b] holds the squares strictly between a and b and line_masks[a][b] the whole line through them,
+# both 0 when a and b do not share a rank, file or diagonal
+between_masks: tuple[tuple[int, ...], ...]
+line_masks: tuple[tuple[int, ...], ...]
+
+not_a_file: int = 0x7F7F_7F7F_7F7F_7F7F
+not_h_file: int = 0xFEFE_FEFE_FEFE_FEFE
+
+# Generated with find_magic (seed 0) for this square ordering, where h = 0 is a8 and is stored in the highest bit
+rook_magics: tuple[int, ...] = (
+    0x8000082086410402, 0x200A504201008804, 0x140900080400020B, 0x0081000268001005,
+    0x020204A088100101, 0x0402102000090041, 0x0104192281004001, 0x10101080006101C5,
+    0x8120089410410200, 0x00510002000C0500, 0x0004008002000480, 0x0000800400080080,
+    0x0008210050010900, 0x0200801200402200, 0x2109104000208100, 0x0060208001004B00,
+    0x012C010040820004, 0x1000421011140088, 0x0411504440080120, 0x4084004080080800,
+    0x0010008100080800, 0x0080100020008080, 0x0040400020008080, 0x0840204000808000,
+    0x0C01204102000084, 0x0022000100408040, 0x2484001002020008, 0x9000110005004800,
+    0x0000800800801000, 0xC082200041001500, 0x0000816303004000, 0x0020800101002040,
+    0x2000140200008051, 0x0010880400500102, 0x1340020080040080, 0x0008008080080401,
+    0x0142001200084220, 0x0580100080802000, 0x0020100040004020, 0x1020400480248000,
+    0x2C02020000408431, 0x002044002508109A, 0x0004008002000480, 0x0304008004080082,
+    0x2080848010000800, 0x3920004010080042, 0x2160008020401080, 0x0040008010802040,
+    0x023A000100408422, 0x0401010002000401, 0x0008802200800400, 0x0000800400080080,
+    0x0000800800801000, 0x0002801000200080, 0x0004402000401000, 0x8060800020400086,
+    0x0200020040289401, 0x0200040081285200, 0xA500080201004400, 0x0480080002840080,
+    0x0080080080100004, 0x2080081000802001, 0x4040002000401004, 0x0480002250844000,
+)
+bishop_magics: tuple[int, ...] = (
+    0x00404800B10A0221, 0x1000401001810100, 0x0100000820082080, 0x00404800B10A0221,
+    0x010400020C208818, 0x00000C0900880400, 0xB428150400840400, 0x010C240602102200,
+    0x0410040904103000, 0x1449510908010050, 0x00004028211900C2, 0x1812211202020400,
+    0x00000020C2088100, 0x2581020042080800, 0x28804A0084201800, 0x004108082C940000,
+    0x000484820A080840, 0x080538008400C500, 0x2022140802021820, 0x0000204200807411,
+    0x0000304208004080, 0x0222002824000801, 0x0010A80402161030, 0x0002021040010404,
+    0x1408020080004848, 0x0022040040042200, 0x0081300080050800, 0x0890008200002200,
+    0x8140202020080080, 0x40C4004110080200, 0x0000882009080200, 0x0010080401881103,
+    0x2E010028A0420800, 0x0004004503091010, 0x0110004082080200, 0x004884000281A000,
+    0x1010040018440008, 0x2011040140404A00, 0x0022090220013400, 0x22020A0020085001,
+    0x200A504201008804, 0x0001000058181400, 0x0090400201100101, 0x0010802404A04800,
+    0x2010284104008000, 0x0148001000401020, 0x0010080401881103, 0x0040000822049406,
+    0xB428150400840400, 0x01800A2804020910, 0x0028084110108000, 0x0042111040007100,
+    0x1081092401012101, 0x0000104420444088, 0xC000484840908E00, 0x1000401001810100,
+    0x010C240602102200, 0x004108082C940000, 0x00108220208E0108, 0x0002021040010404,
+    0x0028084110108000, 0x0008020062010010, 0x0410040904103000, 0x00404800B10A0221,
+)
+
+
+def ray_attacks(rays: tuple[tuple[int, ...], ...], occupancy: int) -> int:
+    """ Attack set of a slider walking each ray until it reaches the first occupied square. """
+    attacks: int = 0
+    for ray in rays:
+        for target_mask in ray:
+            attacks |= target_mask
+            if target_mask & occupancy:
+                break
+    return attacks
+
+
+def relevant_occupancy(rays: tuple[tuple[int, ...], ...]) -> int:
+    """ Squares whose occupancy can change a slider's attack set, that is each ray without its edge square. """
+    mask: int = 0
+    for ray in rays:
+        for target_mask in ray[:-1]:
+            mask |= target_mask
+    return mask
+
+
+def occupancy_subsets(mask: int) -> list[int]:
+    """ Every subset of the bits in mask, starting with the empty set. """
+    subsets: list[int] = []
+    subset: int = 0
+    while True:
+        subsets.append(subset)
+        subset = (subset - mask) & mask
+        if not subset:
+            return subsets
+
+
+def find_magic(rays: tuple[tuple[int, ...], ...], seed: int = 0) -> int:
+    """
+    Search for a magic number that perfectly hashes every blocker set of a slider to its attack set.
+
+    Only needed to regenerate rook_magics and bishop_magics, e.g.
+    ``[find_magic(rook_rays[h]) for h in range(64)]``.
+    """
+    import random
+    rng: random.Random = random.Random(seed)
+    mask: int = relevant_occupancy(rays)
+    shift: int = 64 - mask.bit_count()
+    occupancies: list[int] = occupancy_subsets(mask)
+    attacks: list[int] = [ray_attacks(rays, occupancy) for occupancy in occupancies]
+    while True:
+        magic: int = rng.getrandbits(64) & rng.getrandbits(64) & rng.getrandbits(64)
+        if ((mask * magic) & 0xFF00_0000_0000_0000).bit_count() < 6:
+            continue
+        table: dict[int, int] = {}
+        for occupancy, attack in zip(occupancies, attacks):
+            idx: int = ((occupancy * magic) & full_board) >> shift
+            if table.setdefault(idx, attack) != attack:
+                break
+        else:
+            return magic
+
 
 def populate_precomputed_tables() -> None:
     global knight_targets
     global king_targets
     global rook_rays
     global bishop_diagonals
+    global rook_masks, rook_shifts, rook_attack_table
+    global bishop_masks, bishop_shifts, bishop_attack_table
+    global knight_attack_masks, king_attack_masks, white_pawn_attacks, black_pawn_attacks
+    global between_masks, line_masks
     temp_knight: list[tuple[int, ...]] = []
     temp_king: list[tuple[int, ...]] = []
     temp_rook: list[tuple[tuple[int, ...], tuple[int, ...],
@@ -94,9 +223,99 @@ def populate_precomputed_tables() -> None:
     rook_rays = tuple(temp_rook)
     bishop_diagonals = tuple(temp_bishop)
 
+    rook_masks, rook_shifts, rook_attack_table = build_magic_tables(rook_rays, rook_magics)
+    bishop_masks, bishop_shifts, bishop_attack_table = build_magic_tables(bishop_diagonals, bishop_magics)
+
+    knight_attack_masks = tuple(sum(targets) for targets in knight_targets)
+    king_attack_masks = tuple(sum(targets) - bit_masks[h] for h, targets in enumerate(king_targets))
+    white_pawn_attacks = tuple((bit_masks[h] & not_a_file) << 9 & full_board | (bit_masks[h] & not_h_file) << 7
+                               for h in range(64))
+    black_pawn_attacks = tuple((bit_masks[h] & not_h_file) >> 9 | (bit_masks[h] & not_a_file) >> 7
+                               for h in range(64))
+
+    temp_between: list[tuple[int, ...]] = []
+    temp_line: list[tuple[int, ...]] = []
+    for a in range(64):
+        curr_between: list[int] = []
+        curr_line: list[int] = []
+        for b in range(64):
+            ends: int = bit_masks[a] | bit_masks[b]
+            if a != b and rook_attacks(a, 0) & bit_masks[b]:
+                curr_between.append(rook_attacks(a, bit_masks[b]) & rook_attacks(b, bit_masks[a]))
+                curr_line.append(rook_attacks(a, 0) & rook_attacks(b, 0) | ends)
+            elif a != b and bishop_attacks(a, 0) & bit_masks[b]:
+                curr_between.append(bishop_attacks(a, bit_masks[b]) & bishop_attacks(b, bit_masks[a]))
+                curr_line.append(bishop_attacks(a, 0) & bishop_attacks(b, 0) | ends)
+            else:
+                curr_between.append(0)
+                curr_line.append(0)
+        temp_between.append(tuple(curr_between))
+        temp_line.append(tuple(curr_line))
+    between_masks = tuple(temp_between)
+    line_masks = tuple(temp_line)
+
+
+def build_magic_tables(all_rays: tuple[tuple[tuple[int, ...], ...], ...], magics: tuple[int, ...]
+                       ) -> tuple[tuple[int, ...], tuple[int, ...], tuple[tuple[int, ...], ...]]:
+    """ Build the relevant occupancy masks, shifts and attack tables for one kind of slider. """
+    masks: list[int] = []
+    shifts: list[int] = []
+    tables: list[tuple[int, ...]] = []
+    for rays, magic in zip(all_rays, magics):
+        mask: int = relevant_occupancy(rays)
+        shift: int = 64 - mask.bit_count()
+        table: list[int] = [0] * (1 << mask.bit_count())
+        for occupancy in occupancy_subsets(mask):
+            table[((occupancy * magic) & full_board) >> shift] = ray_attacks(rays, occupancy)
+        masks.append(mask)
+        shifts.append(shift)
+        tables.append(tuple(table))
+    return tuple(masks), tuple(shifts), tuple(tables)
+
+
+def rook_attacks(h: int, occupancy: int) -> int:
+    """ Squares attacked by a rook on square h, including the first blocker along each ray. """
+    return rook_attack_table[h][((occupancy & rook_masks[h]) * rook_magics[h] & full_board) >> rook_shifts[h]]
+
+
+def bishop_attacks(h: int, occupancy: int) -> int:
+    """ Squares attacked by a bishop on square h, including the first blocker along each diagonal. """
+    return bishop_attack_table[h][((occupancy & bishop_masks[h]) * bishop_magics[h] & full_board) >>
+                                  bishop_shifts[h]]
+
+
+def attackers_to(h: int, occupancy: int, attacker_mask: int, attacker_color: int, kings: int, queens: int, rooks: int,
+                 bishops: int, knights: int, pawns: int) -> int:
+    """ Pieces in attacker_mask, belonging to attacker_color, that attack square h given the occupied squares. """
+    pawn_sources: int = black_pawn_attacks[h] if attacker_color == 1 else white_pawn_attacks[h]
+    return attacker_mask & (knight_attack_masks[h] & knights | king_attack_masks[h] & kings | pawn_sources & pawns |
+                            rook_attacks(h, occupancy) & (rooks | queens) |
+                            bishop_attacks(h, occupancy) & (bishops | queens))
+
+
+def bitboards_key(white_pieces: int, kings: int, queens: int, rooks: int, bishops: int, knights: int,
+                  pawns: int) -> int:
+    """ The piece placement part of the Zobrist key, the same key GameStateV3 gives the matching board. """
+    keys: tuple[tuple[int, ...], ...] = piece_square_keys
+    key: int = 0
+    for piece_type, bitboard in ((6, kings), (5, queens), (4, rooks), (3, bishops), (2, knights), (1, pawns)):
+        while bitboard:
+            piece_mask: int = bitboard & -bitboard
+            key ^= keys[6 + piece_type if piece_mask & white_pieces else 6 - piece_type][64 - piece_mask.bit_length()]
+            bitboard ^= piece_mask
+    return key
+
 
 populate_precomputed_tables()
 
+# Everything make_move changes that unmake_move cannot work out from the move itself: the bitboards before the move,
+# castling rights, last move, moves since pawn, hash, winner, cached moves, the position history and the mailbox
+UndoEntry = tuple[tuple[int, int, int, int, int, int, int, int], bool, bool, bool, bool, tuple[int, int, int] | None,
+                  int, int, int | None, list[tuple[int, int, int]] | None, PositionHistory | None, bytearray | None]
+# What get_check_info finds about the king of the player to move: its square, the player's kings, the checkers, the
+# squares a non-king move has to land on, the pinned pieces and the squares attacked with the king lifted off the board
+CheckInfo = tuple[int, int, int, int, int, int]
+
 start_white_pieces = 0b00000000_00000000_00000000_00000000_00000000_00000000_11111111_11111111
 start_black_pieces = 0b11111111_11111111_00000000_00000000_00000000_00000000_00000000_00000000
 start_kings = 0b00001000_00000000_00000000_00000000_00000000_00000000_00000000_00001000
@@ -110,14 +329,18 @@ start_pawns = 0b00000000_11111111_00000000_00000000_00000000_00000000_11111111_0
 class GameStateBitboardsV3(GameStateBase):
     __slots__ = ('white_pieces', 'black_pieces', 'kings', 'queens', 'rooks', 'bishops', 'knights', 'pawns',
                  'color', 'white_queen', 'white_king', 'black_queen', 'black_king', 'last_move', 'turn',
-                 'winner', 'previous_position_count', 'moves_since_pawn', 'moves', 'hash_state')
+                 'winner', 'moves_since_pawn', 'moves', 'hash_state', 'undo_stack', 'position_history', 'checked',
+                 'mailbox')
+    # Repetitions are found in position_history
+    keeps_position_count: bool = False
 
     def __init__(self, white_pieces: int | None = None, black_pieces: int | None = None, kings: int | None = None,
                  queens: int | None = None, rooks: int | None = None, bishops: int | None = None,
                  knights: int | None = None, pawns: int | None = None, white_queen: bool = True,
                  white_king: bool = True, black_queen: bool = True, black_king: bool = True,
                  last_move: tuple[int, int, int] | None = None, color=1, turn=0, winner: int | None = None,
-                 previous_position_count: dict[int, int] | None = None, moves_since_pawn: int = 0) -> None:
+                 position_history: PositionHistory | None = None, moves_since_pawn: int = 0,
+                 hash_state: int | None = None, mailbox: bytearray | None = None) -> None:
         """
         Initialize a GameStateBitboardsV3 object.
 
@@ -151,6 +374,14 @@ class GameStateBitboardsV3(GameStateBase):
             The last move made, as a tuple of two tuples. Defaults to None.
         color : int, optional
             The color of the current player (1 for white, -1 for black). Defaults to 1.
+        position_history : PositionHistory | None, optional
+            The board keys the repetition rule counts, shared with the states before this one. Defaults to None.
+        hash_state : int | None, optional
+            The Zobrist key of the position, which move() passes on after updating it. Computed from the bitboards
+            when None. Defaults to None.
+        mailbox : bytearray | None, optional
+            The piece on each square plus 6, indexed like GameStateV3, which move() passes on after updating it. Not
+            kept when None. Defaults to None.
         """
         self.white_pieces: int = start_white_pieces if white_pieces is None else white_pieces
         self.black_pieces: int = start_black_pieces if black_pieces is None else black_pieces
@@ -162,8 +393,93 @@ class GameStateBitboardsV3(GameStateBase):
         self.pawns: int = start_pawns if pawns is None else pawns
         self.last_move: tuple[int, int, int] | None = last_move
         self.moves: list[tuple[int, int, int]] | None = None
+        # Only created once make_move is used, so states from move() stay as light as before
+        self.undo_stack: list[UndoEntry] | None = None
+        self.position_history: PositionHistory | None = position_history
+        # Whether the player to move is in check, worked out the first time in_check or get_check_info() needs it
+        self.checked: bool | None = None
+        # Only kept once track_pieces is called, so the states of a search stay as light as before
+        self.mailbox: bytearray | None = mailbox
         super().__init__(white_queen, white_king, black_queen, black_king, color, turn, winner,
-                         previous_position_count, moves_since_pawn)
+                         moves_since_pawn=moves_since_pawn)
+        self.hash_state: int = hash_state if hash_state is not None else (
+                bitboards_key(self.white_pieces, self.kings, self.queens, self.rooks, self.bishops, self.knights,
+                              self.pawns) ^
+                state_key(color, white_queen, white_king, black_queen, black_king,
+                          -1 if last_move is None else last_move[2] - 1))
+
+    def piece_at(self, h: int) -> int:
+        """ The piece on square h, indexed like GameStateV3, or 0 if it is empty. """
+        if self.mailbox is not None:
+            return self.mailbox[h] - 6
+        piece_mask: int = bit_masks[h]
+        if piece_mask & self.white_pieces:
+            color: int = 1
+        elif piece_mask & self.black_pieces:
+            color = -1
+        else:
+            return 0
+        if piece_mask & self.pawns:
+            return color
+        if piece_mask & self.knights:
+            return 2 * color
+        if piece_mask & self.bishops:
+            return 3 * color
+        if piece_mask & self.rooks:
+            return 4 * color
+        if piece_mask & self.queens:
+            return 5 * color
+        return 6 * color
+
+    def track_pieces(self) -> None:
+        """
+        Start keeping the mailbox, a bytearray of the piece on each square, for this state and every state made from it
+        with move() or make_move(). piece_at() then reads one byte instead of testing each bitboard.
+        """
+        if self.mailbox is None:
+            self.mailbox = bytearray(self.piece_at(h) + 6 for h in range(64))
+
+    def moved_mailbox(self, move: tuple[int, int, int]) -> bytearray | None:
+        """ A copy of the mailbox with a move of this state made on it, or None if no mailbox is kept. """
+        if self.mailbox is None:
+            return None
+        mailbox: bytearray = bytearray(self.mailbox)
+        move_0, move_1, move_2 = move
+        if move_0 == -1:  # Castle
+            king_idx: int = 64 - move_2.bit_length()
+            rook_idx: int = king_idx + (3 if move_1 == 1 else -4)
+            mailbox[king_idx + 2 * move_1] = mailbox[king_idx]
+            mailbox[king_idx + move_1] = mailbox[rook_idx]
+            mailbox[king_idx] = mailbox[rook_idx] = 6
+            return mailbox
+        if move_0 < 0:
+            from_idx: int = 64 - move_2.bit_length()
+            to_idx: int = from_idx - 8 * self.color + (0 if move_0 == -3 else move_1)
+            if move_0 == -2:  # En Passant
+                mailbox[to_idx] = mailbox[from_idx]
+                mailbox[from_idx + move_1] = 6
+            else:  # Promotion, possibly while taking
+                mailbox[to_idx] = 6 + (move_1 if move_0 == -3 else (-2 - move_0) * self.color)
+        else:
+            from_idx = 64 - move_0.bit_length()
+            mailbox[64 - move_1.bit_length()] = mailbox[from_idx]
+        mailbox[from_idx] = 6
+        return mailbox
+
+    def moved_piece_boards(self, move_0: int, move_1: int) -> tuple[int, int, list[int]]:
+        """
+        The piece an ordinary move from move_0 to move_1 moves, the piece it takes there or 0, and the bitboard of
+        each piece type after the move, from pawns at 1 to kings at 6. Both pieces come from piece_at(), so they are
+        one read each when the mailbox is kept.
+        """
+        moving_piece: int = self.piece_at(64 - move_0.bit_length())
+        captured_piece: int = self.piece_at(64 - move_1.bit_length())
+        piece_boards: list[int] = [0, self.pawns, self.knights, self.bishops, self.rooks, self.queens, self.kings]
+        # An empty square clears the unused first entry
+        piece_boards[abs(captured_piece)] &= ~move_1
+        moving_type: int = abs(moving_piece)
+        piece_boards[moving_type] = (piece_boards[moving_type] & ~move_0) | move_1
+        return moving_piece, captured_piece, piece_boards
 
     def get_hashable_state(self) -> tuple[int, int, int, int, int, int, int, int, int, bool, bool, bool, bool,
     tuple[int, int, int] | None]:
@@ -173,13 +489,15 @@ class GameStateBitboardsV3(GameStateBase):
                 self.last_move)
 
     def __hash__(self) -> int:
-        return hash((self.white_pieces, self.kings, self.queens, self.rooks, self.bishops,
-                     self.knights, self.pawns, self.color, self.white_queen, self.white_king, self.black_queen,
-                     self.black_king, self.last_move, self.turn))
+        return self.hash_state
 
     def get_moves(self) -> list[tuple[int, int, int]]:
         """
-        Get all the possible moves for the current player.
+        Get all the legal moves for the current player.
+
+        Checkers and pinned pieces are found once for the position, so each pseudo-legal move is kept or dropped with a
+        few mask tests instead of being played out and rescanned. Only en passant, which can uncover a check along the
+        rank of both pawns, is played out on the board.
 
         Returns
         -------
@@ -187,270 +505,579 @@ class GameStateBitboardsV3(GameStateBase):
             A list of tuples, each representing a move in the format (start_row, start_col, end_row, end_col).
         """
         if self.moves is not None: return self.moves
-        moves: list[tuple[int, int, int]] = self.get_moves_no_check()
+        pseudo_moves: list[tuple[int, int, int]] = self.get_moves_no_check()
+        check_info: CheckInfo | None = self.get_check_info()
+        if check_info is None:
+            self.moves = pseudo_moves
+            return pseudo_moves
+        moves: list[tuple[int, int, int]] = self.filter_legal(pseudo_moves, check_info)
         self.moves = moves
-        pop_idx_base: int = len(moves) - 1
-        color_local = self.color
-        bishop_diagonals_local: tuple[tuple[tuple[int, ...], tuple[int, ...],
-        tuple[int, ...], tuple[int, ...]], ...] = bishop_diagonals
-        rook_rays_local: tuple[tuple[tuple[int, ...], tuple[int, ...],
-        tuple[int, ...], tuple[int, ...]], ...] = rook_rays
-        knight_targets_local: tuple[tuple[int, ...], ...] = knight_targets
-        king_targets_local: tuple[tuple[int, ...], ...] = king_targets
-        king_mask: int = self.kings & (self.white_pieces if color_local == 1 else self.black_pieces)
-        coords_local: list[tuple[int, int]] = index_to_coord
-        for i, move in enumerate(reversed(moves)):
-            white_pieces, black_pieces, kings, queens, rooks, bishops, knights, pawns = self.move_only_board(move)
-            bishops |= queens
-            rooks |= queens
-            pieces: int = white_pieces | black_pieces
-            opponent_mask: int = black_pieces if color_local == 1 else white_pieces
-            illegal: bool = False
-            if move[0] == -1:  # Castle
-                check_mask: int = king_mask | (king_mask >> 1 | king_mask >> 2 if move[1] == 1 else
-                                               king_mask << 1 | king_mask << 2)
-                pieces |= king_mask
-                piece_mask = 1 << 64
-                for h in range(64):
-                    piece_mask >>= 1
-                    if not piece_mask & opponent_mask: continue
-                    if piece_mask & bishops:
-                        for diagonal in bishop_diagonals_local[h]:
-                            for target_mask in diagonal:
-                                if not target_mask & pieces:
-                                    continue
-                                if target_mask & check_mask:
-                                    illegal = True
-                                break
-                            if illegal:
-                                break
-                        if illegal:
-                            moves.pop(pop_idx_base - i)
-                            break
-                    if piece_mask & rooks:  # and
-                        # (coords_local[check_square][0] == coords_local[h][0] or
-                        #  coords_local[check_square][1] == coords_local[h][1])):
-                        for ray in rook_rays_local[h]:
-                            for target_mask in ray:
-                                if not target_mask & pieces:
-                                    continue
-                                if target_mask & check_mask:
-                                    illegal = True
-                                break
-                            if illegal:
-                                break
-                        if illegal:
-                            moves.pop(pop_idx_base - i)
-                            break
-                    elif piece_mask & kings:
-                        for target_mask in king_targets_local[h]:
-                            if target_mask & check_mask:
-                                break
-                        else:
-                            continue
-                        moves.pop(pop_idx_base - i)
-                        break
-                    elif piece_mask & knights:
-                        for target_mask in knight_targets_local[h]:
-                            if target_mask & check_mask:
-                                break
-                        else:
-                            continue
-                        moves.pop(pop_idx_base - i)
-                        break
-                    elif piece_mask & pawns:
-                        forward_mask = piece_mask << 8 if color_local == -1 else piece_mask >> 8
-                        if ((forward_mask >> 1 & check_mask and coords_local[h][1] != 7) or
-                                (forward_mask << 1 & check_mask and coords_local[h][1])):
-                            moves.pop(pop_idx_base - i)
-                            break
-            else:
-                check_square: int = kings & (white_pieces if color_local == 1 else black_pieces)
-                check_square_idx: int = 64 - check_square.bit_length()
-                piece_mask = 1 << 64
-                for h in range(64):
-                    piece_mask >>= 1
-                    if not piece_mask & opponent_mask: continue
-                    if piece_mask & bishops:
-                        for diagonal in bishop_diagonals_local[h]:
-                            for target_mask in diagonal:
-                                if not target_mask & pieces:
-                                    continue
-                                if target_mask == check_square:
-                                    illegal = True
-                                break
-                            if illegal:
-                                break
-                        if illegal:
-                            moves.pop(pop_idx_base - i)
-                            break
-                    if piece_mask & pawns:
-                        forward_mask = piece_mask << 8 if color_local == -1 else piece_mask >> 8
-                        if ((forward_mask >> 1 == check_square and coords_local[h][1] != 7) or
-                                (forward_mask << 1 == check_square and coords_local[h][1])):
-                            moves.pop(pop_idx_base - i)
-                            break
-                    elif (piece_mask & rooks and
-                        (coords_local[check_square_idx][0] == coords_local[h][0] or
-                         coords_local[check_square_idx][1] == coords_local[h][1])):
-                        # (bitboard_to_coord_local[check_square][0] == coords_local[h][0] or
-                        #  bitboard_to_coord_local[check_square][1] == coords_local[h][1])):
-                        for ray in rook_rays_local[h]:
-                            for target_mask in ray:
-                                if not target_mask & pieces:
-                                    continue
-                                if target_mask == check_square:
-                                    illegal = True
-                                break
-                            if illegal:
-                                break
-                        if illegal:
-                            moves.pop(pop_idx_base - i)
-                            break
-                    elif piece_mask & kings:
-                        for target_mask in king_targets_local[h]:
-                            if target_mask == check_square:
-                                break
-                        else:
-                            continue
-                        moves.pop(pop_idx_base - i)
-                        break
-                    elif piece_mask & knights:
-                        for target_mask in knight_targets_local[h]:
-                            if target_mask == check_square:
-                                break
-                        else:
-                            continue
-                        moves.pop(pop_idx_base - i)
-                        break
-
-        if len(moves) == 0 and pop_idx_base > -1:
-            game_state: GameStateBitboardsV3 = GameStateBitboardsV3(self.white_pieces, self.black_pieces, self.kings,
-                                                                    self.queens, self.rooks, self.bishops, self.knights,
-                                                                    self.pawns, False, False, False,
-                                                                    False, color=-color_local)
-            for _, dest_mask, _ in game_state.get_moves_no_check():
-                if dest_mask == king_mask:
-                    self.winner = -color_local
-                    return moves
-            self.winner = 0
-            return moves
+
+        if len(moves) == 0 and pseudo_moves:
+            self.winner = -self.color if self.in_check else 0
         elif self.moves_since_pawn >= 100:
             self.winner = 0
         return moves
 
+    def get_check_info(self) -> CheckInfo | None:
+        """
+        Find the pieces checking the king of the player to move, the pieces pinned to it and the squares it may not
+        step to.
+
+        Returns
+        -------
+        CheckInfo | None
+            The king square, the player's kings, the checkers, the squares a non-king move has to land on, the pinned
+            pieces and the squares attacked with the king lifted off the board. None if the player has no king.
+        """
+        color_local: int = self.color
+        color_mask: int = self.white_pieces if color_local == 1 else self.black_pieces
+        opponent_mask: int = self.black_pieces if color_local == 1 else self.white_pieces
+        own_kings: int = self.kings & color_mask
+        if not own_kings:
+            return None
+        # Only the first king is guarded against checks if there are several, the others only avoid attacked squares
+        king_idx: int = 64 - own_kings.bit_length()
+        pieces: int = color_mask | opponent_mask
+        queens: int = self.queens
+        orthagonal_sliders: int = (self.rooks | queens) & opponent_mask
+        diagonal_sliders: int = (self.bishops | queens) & opponent_mask
+        between_local: tuple[int, ...] = between_masks[king_idx]
+
+        checkers: int = attackers_to(king_idx, pieces, opponent_mask, -color_local, self.kings, queens, self.rooks,
+                                     self.bishops, self.knights, self.pawns)
+        self.checked = checkers != 0
+        # Non-king moves must capture the checker or block its line, and no such move escapes a double check
+        evasion_mask: int = full_board
+        if checkers & (checkers - 1):
+            evasion_mask = 0
+        elif checkers:
+            evasion_mask = checkers | between_local[64 - checkers.bit_length()]
+
+        # A piece is pinned when it is the only piece between the king and an opposing slider on the same line
+        pinned: int = 0
+        pinners: int = rook_attacks(king_idx, 0) & orthagonal_sliders | bishop_attacks(king_idx, 0) & diagonal_sliders
+        while pinners:
+            pinner: int = pinners & -pinners
+            pinners ^= pinner
+            blockers: int = between_local[64 - pinner.bit_length()] & pieces
+            if blockers & color_mask and not blockers & (blockers - 1):
+                pinned |= blockers
+
+        # Squares the king may not step to, found with the king itself lifted off the board
+        danger: int = self.attacked_squares(-color_local, pieces ^ bit_masks[king_idx])
+        return king_idx, own_kings, checkers, evasion_mask, pinned, danger
+
+    def is_square_attacked(self, square: int, by_color: int) -> bool:
+        """ Whether any piece of by_color attacks the square, looked up from the square's own attack masks. """
+        return attackers_to(square, self.white_pieces | self.black_pieces,
+                            self.white_pieces if by_color == 1 else self.black_pieces, by_color, self.kings,
+                            self.queens, self.rooks, self.bishops, self.knights, self.pawns) != 0
+
+    @property
+    def in_check(self) -> bool:
+        """ Whether the first king of the player to move is attacked. Always False without a king. """
+        if self.checked is None:
+            own_kings: int = self.kings & (self.white_pieces if self.color == 1 else self.black_pieces)
+            self.checked = own_kings != 0 and self.is_square_attacked(64 - own_kings.bit_length(), -self.color)
+        return self.checked
+
+    @property
+    def phase(self) -> int:
+        """ The number of knights, bishops, rooks and queens on the board. """
+        return (self.knights | self.bishops | self.rooks | self.queens).bit_count()
+
+    @property
+    def piece_counts(self) -> int:
+        """ The piece counts, phase and material of game_states.material, counted from the bitboards. """
+        piece_counts: int = 0
+        for piece_type, bitboard in enumerate((self.pawns, self.knights, self.bishops, self.rooks, self.queens,
+                                               self.kings), 1):
+            piece_counts += ((bitboard & self.white_pieces).bit_count() * piece_deltas[6 + piece_type] +
+                             (bitboard & self.black_pieces).bit_count() * piece_deltas[6 - piece_type])
+        return piece_counts
+
+    def filter_legal(self, pseudo_moves: list[tuple[int, int, int]],
+                     check_info: CheckInfo) -> list[tuple[int, int, int]]:
+        """ Keep the pseudo-legal moves that do not leave the king in check, using the result of get_check_info(). """
+        color_local: int = self.color
+        king_idx, own_kings, checkers, evasion_mask, pinned, danger = check_info
+        king_mask: int = bit_masks[king_idx]
+        line_local: tuple[int, ...] = line_masks[king_idx]
+        opponent_mask: int = self.black_pieces if color_local == 1 else self.white_pieces
+        pieces: int = self.white_pieces | self.black_pieces
+        moves: list[tuple[int, int, int]] = []
+        for move in pseudo_moves:
+            move_0, move_1, move_2 = move
+            if move_0 > 0:
+                from_mask: int = move_0
+                to_mask: int = move_1
+            elif move_0 == -1:  # Castle
+                if not checkers and not danger & ((king_mask >> 1 | king_mask >> 2) if move_1 == 1 else
+                                                  (king_mask << 1 | king_mask << 2)):
+                    moves.append(move)
+                continue
+            elif move_0 == -2:  # En Passant
+                white_pieces, black_pieces, kings, queens, rooks, bishops, knights, pawns = self.move_only_board(move)
+                if not attackers_to(king_idx, white_pieces | black_pieces,
+                                    black_pieces if color_local == 1 else white_pieces, -color_local,
+                                    kings, queens, rooks, bishops, knights, pawns):
+                    moves.append(move)
+                continue
+            elif move_0 == -3:  # Promotion
+                from_mask = move_2
+                to_mask = move_2 << 8 if color_local == 1 else move_2 >> 8
+            else:  # Promotion while taking
+                from_mask = move_2
+                to_mask = (move_2 << 8 - move_1) if color_local == 1 else (move_2 >> 8 + move_1)
+            if from_mask == king_mask:
+                if not to_mask & danger:
+                    moves.append(move)
+            elif from_mask & own_kings:
+                if not attackers_to(64 - to_mask.bit_length(), pieces ^ from_mask, opponent_mask, -color_local,
+                                    self.kings, self.queens, self.rooks, self.bishops, self.knights, self.pawns):
+                    moves.append(move)
+            elif to_mask & evasion_mask and (not from_mask & pinned or
+                                             to_mask & line_local[64 - from_mask.bit_length()]):
+                moves.append(move)
+        return moves
+
+    def get_captures(self) -> list[tuple[int, int, int]]:
+        """ Get the legal moves that take a piece, including en passant and promotions while taking. """
+        if self.moves is not None:
+            return [move for move in self.moves if self.is_capture(move)]
+        return self.get_legal_stage(True, self.get_check_info())
+
+    def get_evasions(self) -> list[tuple[int, int, int]]:
+        """
+        Get the legal moves while in check. Only the king moves and the moves to the squares that take the checker or
+        block its line are generated, and just the king moves in a double check. Out of check, this is get_moves().
+        """
+        if self.moves is not None:
+            return self.moves
+        check_info: CheckInfo | None = self.get_check_info()
+        if check_info is None or not check_info[2]:
+            return self.get_moves()
+        return self.filter_legal(self.generate_moves(destination_mask=check_info[3]), check_info)
+
+    def iter_moves(self, stage_hint: tuple[int, int, int] | None = None) -> Iterator[tuple[int, int, int]]:
+        """
+        Yield the legal moves one stage at a time: stage_hint first, then the captures, then the quiet moves.
+
+        A stage is only generated when the consumer asks for its first move, so a search that cuts off on the hint or a
+        capture never generates the quiet moves. The hint is usually the best move stored for this position in a
+        transposition table, and is only yielded if it is legal here. Unlike get_moves(), nothing is cached and the
+        winner is not set.
+
+        Parameters
+        ----------
+        stage_hint : tuple[int, int, int] | None, optional
+            A move to try before any other. Defaults to None.
+        """
+        if self.moves is not None:
+            moves: list[tuple[int, int, int]] = self.moves
+            if stage_hint is not None and stage_hint in moves:
+                yield stage_hint
+            for move in moves:
+                if move != stage_hint and self.is_capture(move):
+                    yield move
+            for move in moves:
+                if move != stage_hint and not self.is_capture(move):
+                    yield move
+            return
+        check_info: CheckInfo | None = self.get_check_info()
+        captures: list[tuple[int, int, int]] | None = None
+        quiets: list[tuple[int, int, int]] | None = None
+        if stage_hint is not None:
+            # The hint is checked against the legal moves of its own stage, which is generated early for it
+            if self.is_capture(stage_hint):
+                captures = self.get_legal_stage(True, check_info)
+                if stage_hint in captures:
+                    yield stage_hint
+            else:
+                quiets = self.get_legal_stage(False, check_info)
+                if stage_hint in quiets:
+                    yield stage_hint
+        for move in captures if captures is not None else self.get_legal_stage(True, check_info):
+            if move != stage_hint:
+                yield move
+        for move in quiets if quiets is not None else self.get_legal_stage(False, check_info):
+            if move != stage_hint:
+                yield move
+
+    def get_legal_stage(self, captures: bool, check_info: CheckInfo | None) -> list[tuple[int, int, int]]:
+        """ The legal captures, or the legal quiet moves, given the result of get_check_info(). """
+        pseudo_moves: list[tuple[int, int, int]] = self.generate_moves(captures, not captures)
+        return pseudo_moves if check_info is None else self.filter_legal(pseudo_moves, check_info)
+
+    def is_capture(self, move: tuple[int, int, int]) -> bool:
+        """ Whether a move of this state takes a piece, counting en passant. """
+        move_0: int = move[0]
+        if move_0 > 0:
+            return bool(move[1] & (self.black_pieces if self.color == 1 else self.white_pieces))
+        return move_0 == -2 or move_0 <= -4
+
+    def attacked_squares(self, color: int, occupancy: int) -> int:
+        """ Every square attacked by the pieces of color, with sliders stopped by the squares in occupancy. """
+        attacker_mask: int = self.white_pieces if color == 1 else self.black_pieces
+        pawns: int = self.pawns & attacker_mask
+        if color == 1:
+            attacks: int = ((pawns & not_a_file) << 9 | (pawns & not_h_file) << 7) & full_board
+        else:
+            attacks = (pawns & not_h_file) >> 9 | (pawns & not_a_file) >> 7
+        knights: int = self.knights & attacker_mask
+        while knights:
+            piece_mask: int = knights & -knights
+            attacks |= knight_attack_masks[64 - piece_mask.bit_length()]
+            knights ^= piece_mask
+        orthagonal_sliders: int = (self.rooks | self.queens) & attacker_mask
+        while orthagonal_sliders:
+            piece_mask = orthagonal_sliders & -orthagonal_sliders
+            attacks |= rook_attacks(64 - piece_mask.bit_length(), occupancy)
+            orthagonal_sliders ^= piece_mask
+        diagonal_sliders: int = (self.bishops | self.queens) & attacker_mask
+        while diagonal_sliders:
+            piece_mask = diagonal_sliders & -diagonal_sliders
+            attacks |= bishop_attacks(64 - piece_mask.bit_length(), occupancy)
+            diagonal_sliders ^= piece_mask
+        kings: int = self.kings & attacker_mask
+        while kings:
+            piece_mask = kings & -kings
+            attacks |= king_attack_masks[64 - piece_mask.bit_length()]
+            kings ^= piece_mask
+        return attacks
+
     def get_moves_no_check(self) -> list[tuple[int, int, int]]:
+        """ Get the pseudo-legal moves for the current player, which may leave their king in check. """
+        return self.generate_moves()
+
+    def generate_moves(self, captures: bool = True, quiets: bool = True,
+                       destination_mask: int = full_board) -> list[tuple[int, int, int]]:
+        """
+        Get the pseudo-legal captures, quiet moves or both for the current player.
+
+        Each kind of piece is walked with its own bitboard, taking the lowest set bit each time, so the cost follows
+        the number of pieces rather than the 64 squares. En passant and promotions while taking count as captures,
+        castling and the other promotions as quiet moves.
+
+        Parameters
+        ----------
+        captures : bool, optional
+            Whether to generate the moves that take a piece. Defaults to True.
+        quiets : bool, optional
+            Whether to generate the moves that do not. Defaults to True.
+        destination_mask : int, optional
+            The squares the pieces other than kings may move to, such as the squares that answer a check. Castling is
+            left out unless every square is allowed. Defaults to every square.
+        """
         moves: list[tuple[int, int, int]] = []
+        append: Callable[[tuple[int, int, int]], None] = moves.append
         # Local binds for speed
         color_local: int = self.color
         last_move_local: tuple[int, int, int] | None = self.last_move
-        coords_local: list[tuple[int, int]] = index_to_coord
-        knight_targets_local: tuple[tuple[int, ...], ...] = knight_targets
-        king_targets_local: tuple[tuple[int, ...], ...] = king_targets
-        rook_rays_local: tuple[tuple[tuple[int, ...], tuple[int, ...],
-        tuple[int, ...], tuple[int, ...]], ...] = rook_rays
-        bishop_diagonals_local: tuple[tuple[tuple[int, ...], tuple[int, ...],
-        tuple[int, ...], tuple[int, ...]], ...] = bishop_diagonals
-        masks_local: list[int] = bit_masks
-        color_mask: int = self.white_pieces if self.color == 1 else self.black_pieces
-        opponent_mask: int = self.black_pieces if self.color == 1 else self.white_pieces
-        kings: int = self.kings
-        colored_rooks: int = self.rooks & color_mask
-        orthagonal_sliders: int = self.rooks | self.queens
-        diagonal_sliders: int = self.bishops | self.queens
-        knights: int = self.knights
-        pawns: int = self.pawns
+        color_mask: int = self.white_pieces if color_local == 1 else self.black_pieces
+        opponent_mask: int = self.black_pieces if color_local == 1 else self.white_pieces
         pieces: int = (color_mask | opponent_mask)
-        mask: int = 1 << 64
-        for h in range(64):
-            mask >>= 1
-            if not color_mask & mask:
-                continue
-            i, j = coords_local[h]
-            if mask & pawns:
-                dest_square_mask = masks_local[h - 8 * color_local]
-                # Forward
-                if not pieces & dest_square_mask:
-                    if 7 != i - color_local != 0:
-                        moves.append((mask, dest_square_mask, 0))
-                    else:  # Promotion
-                        for move_id, promotion_piece in promotion_forward:
-                            moves.append((move_id, promotion_piece * color_local, mask))
-                # Right capture
-                if 8 > (j + 1) and opponent_mask & (dest_square_mask >> 1):
-                    if 7 != i - color_local != 0:
-                        moves.append((mask, (dest_square_mask >> 1), 0))
-                    else:  # Promotion
-                        for promotion_piece, direction in promotion_taking:
-                            moves.append((promotion_piece, direction, mask))
-                # Left capture
-                if (j - 1) >= 0 and opponent_mask & (dest_square_mask << 1):
-                    if 7 != i - color_local != 0:
-                        moves.append((mask, (dest_square_mask << 1), 0))
-                    else:  # Promotion
-                        for promotion_piece, direction in promotion_taking:
-                            moves.append((promotion_piece, -direction, mask))
-                # Double push
+        empty: int = ~pieces & full_board
+        # The squares the kings may move to in the stages asked for, and those the knights and sliders may move to
+        not_color_mask: int = (opponent_mask if captures else 0) | (empty if quiets else 0)
+        piece_targets: int = not_color_mask & destination_mask
+
+        # Pawns are moved all at once by shifting the whole bitboard, then each target is traced back to its pawn
+        pawns: int = self.pawns & color_mask
+        if pawns:
+            if not quiets:
+                empty = 0
+            if not captures:
+                opponent_mask = 0
+            if color_local == 1:
+                single_pushes: int = pawns << 8 & empty
+                double_pushes: int = (single_pushes & 0xFF_0000) << 8 & empty
+                right_captures: int = (pawns & not_h_file) << 7 & opponent_mask
+                left_captures: int = (pawns & not_a_file) << 9 & opponent_mask
+                promotion_rank: int = 0xFF << 56
+            else:
+                single_pushes = pawns >> 8 & empty
+                double_pushes = (single_pushes & 0xFF << 40) >> 8 & empty
+                right_captures = (pawns & not_h_file) >> 9 & opponent_mask
+                left_captures = (pawns & not_a_file) >> 7 & opponent_mask
+                promotion_rank = 0xFF
+            if destination_mask != full_board:
+                single_pushes &= destination_mask
+                double_pushes &= destination_mask
+                right_captures &= destination_mask
+                left_captures &= destination_mask
+
+            targets: int = single_pushes & ~promotion_rank
+            while targets:
+                target_mask: int = targets & -targets
+                append((target_mask >> 8 if color_local == 1 else target_mask << 8, target_mask, 0))
+                targets ^= target_mask
+            targets = double_pushes
+            while targets:
+                target_mask = targets & -targets
+                append((target_mask >> 16 if color_local == 1 else target_mask << 16, target_mask,
+                        (64 - target_mask.bit_length()) % 8 + 1))
+                targets ^= target_mask
+            targets = right_captures & ~promotion_rank
+            while targets:
+                target_mask = targets & -targets
+                append((target_mask >> 7 if color_local == 1 else target_mask << 9, target_mask, 0))
+                targets ^= target_mask
+            targets = left_captures & ~promotion_rank
+            while targets:
+                target_mask = targets & -targets
+                append((target_mask >> 9 if color_local == 1 else target_mask << 7, target_mask, 0))
+                targets ^= target_mask
+
+            if (single_pushes | right_captures | left_captures) & promotion_rank:
+                targets = single_pushes & promotion_rank
+                while targets:
+                    target_mask = targets & -targets
+                    from_mask: int = target_mask >> 8 if color_local == 1 else target_mask << 8
+                    for move_id, promotion_piece in promotion_forward:
+                        append((move_id, promotion_piece * color_local, from_mask))
+                    targets ^= target_mask
+                targets = right_captures & promotion_rank
+                while targets:
+                    target_mask = targets & -targets
+                    from_mask = target_mask >> 7 if color_local == 1 else target_mask << 9
+                    for promotion_piece, direction in promotion_taking:
+                        append((promotion_piece, direction, from_mask))
+                    targets ^= target_mask
+                targets = left_captures & promotion_rank
+                while targets:
+                    target_mask = targets & -targets
+                    from_mask = target_mask >> 9 if color_local == 1 else target_mask << 7
+                    for promotion_piece, direction in promotion_taking:
+                        append((promotion_piece, -direction, from_mask))
+                    targets ^= target_mask
+
+            if last_move_local is not None and captures:
+                # The pawns beside the one that just moved two squares attack the square it passed over
+                en_passant_file: int = last_move_local[2] - 1
                 if color_local == 1:
-                    if i == 6 and not (pieces & (dest_square_mask | (dest_square_mask << 8))):
-                        moves.append((mask, (dest_square_mask << 8), j + 1))
-                elif i == 1 and not (pieces & (dest_square_mask | (dest_square_mask >> 8))):
-                    moves.append((mask, (dest_square_mask >> 8), j + 1))
-                # En Passant
-                if last_move_local is not None and ((i == 3 and color_local == 1) or (i == 4 and color_local == -1)):
-                    if 7 != j == last_move_local[2]:
-                        moves.append((-2, -1, mask))
-                    elif 0 != j == last_move_local[2] - 2:
-                        moves.append((-2, 1, mask))
-            elif kings & mask:
-                if (((color_local == 1 and self.white_king) or (
-                        color_local == -1 and self.black_king)) and colored_rooks &
-                        (mask >> 3) and not (pieces & ((mask >> 1) | (mask >> 2)))):
-                    moves.append((-1, 1, mask))
-                if (((color_local == 1 and self.white_queen) or (
-                        color_local == -1 and self.black_queen)) and colored_rooks &
-                        (mask << 4) and not (pieces & ((mask << 1) | (mask << 2) | (mask << 3)))):
-                    moves.append((-1, -1, mask))
-                for target_mask in king_targets_local[h]:
-                    if not target_mask & color_mask:
-                        moves.append((mask, target_mask, 0))
-            elif mask & orthagonal_sliders:
-                for ray in rook_rays_local[h]:
-                    for target_mask in ray:
-                        if not target_mask & pieces:
-                            moves.append((mask, target_mask, 0))
-                            continue
-                        if target_mask & opponent_mask:
-                            moves.append((mask, target_mask, 0))
-                        break
-            if mask & diagonal_sliders:
-                for diagonal in bishop_diagonals_local[h]:
-                    for target_mask in diagonal:
-                        if not target_mask & pieces:
-                            moves.append((mask, target_mask, 0))
-                            continue
-                        if target_mask & opponent_mask:
-                            moves.append((mask, target_mask, 0))
-                        break
-            elif mask & knights:
-                for target_mask in knight_targets_local[h]:
-                    if not target_mask & color_mask:
-                        moves.append((mask, target_mask, 0))
+                    capturers: int = black_pawn_attacks[16 + en_passant_file] & pawns
+                else:
+                    capturers = white_pawn_attacks[40 + en_passant_file] & pawns
+                while capturers:
+                    from_mask = capturers & -capturers
+                    append((-2, en_passant_file - (64 - from_mask.bit_length()) % 8, from_mask))
+                    capturers ^= from_mask
+
+        knights: int = self.knights & color_mask
+        while knights:
+            mask: int = knights & -knights
+            knights ^= mask
+            targets = knight_attack_masks[64 - mask.bit_length()] & piece_targets
+            while targets:
+                target_mask = targets & -targets
+                append((mask, target_mask, 0))
+                targets ^= target_mask
+
+        sliders: int = (self.bishops | self.queens) & color_mask
+        if sliders:
+            bishop_masks_local: tuple[int, ...] = bishop_masks
+            bishop_magics_local: tuple[int, ...] = bishop_magics
+            bishop_shifts_local: tuple[int, ...] = bishop_shifts
+            bishop_table_local: tuple[tuple[int, ...], ...] = bishop_attack_table
+            while sliders:
+                mask = sliders & -sliders
+                sliders ^= mask
+                h: int = 64 - mask.bit_length()
+                targets = bishop_table_local[h][((pieces & bishop_masks_local[h]) * bishop_magics_local[h] &
+                                                 full_board) >> bishop_shifts_local[h]] & piece_targets
+                while targets:
+                    target_mask = targets & -targets
+                    append((mask, target_mask, 0))
+                    targets ^= target_mask
+
+        sliders = (self.rooks | self.queens) & color_mask
+        if sliders:
+            rook_masks_local: tuple[int, ...] = rook_masks
+            rook_magics_local: tuple[int, ...] = rook_magics
+            rook_shifts_local: tuple[int, ...] = rook_shifts
+            rook_table_local: tuple[tuple[int, ...], ...] = rook_attack_table
+            while sliders:
+                mask = sliders & -sliders
+                sliders ^= mask
+                h = 64 - mask.bit_length()
+                targets = rook_table_local[h][((pieces & rook_masks_local[h]) * rook_magics_local[h] &
+                                               full_board) >> rook_shifts_local[h]] & piece_targets
+                while targets:
+                    target_mask = targets & -targets
+                    append((mask, target_mask, 0))
+                    targets ^= target_mask
+
+        kings: int = self.kings & color_mask
+        if kings:
+            colored_rooks: int = self.rooks & color_mask
+            king_side: bool = self.white_king if color_local == 1 else self.black_king
+            queen_side: bool = self.white_queen if color_local == 1 else self.black_queen
+            if not quiets or destination_mask != full_board:
+                king_side = queen_side = False
+            while kings:
+                mask = kings & -kings
+                kings ^= mask
+                if king_side and colored_rooks & (mask >> 3) and not (pieces & ((mask >> 1) | (mask >> 2))):
+                    append((-1, 1, mask))
+                if (queen_side and colored_rooks & (mask << 4) and
+                        not (pieces & ((mask << 1) | (mask << 2) | (mask << 3)))):
+                    append((-1, -1, mask))
+                targets = king_attack_masks[64 - mask.bit_length()] & not_color_mask
+                while targets:
+                    target_mask = targets & -targets
+                    append((mask, target_mask, 0))
+                    targets ^= target_mask
         return moves
 
     def are_captures(self) -> bool:
-        moves: list[tuple[int, int, int]] = self.get_moves()
-        empty_count: int = self.count_zero_bits(self.white_pieces | self.black_pieces)
-        for move in moves:
-            white_pieces, black_pieces, *_ = self.move_only_board(move)
-            if self.count_zero_bits(white_pieces | black_pieces) != empty_count:
-                return True
-        return False
+        """ Whether the player to move has a legal capture, stopping at the first one found. """
+        return self.count_captures(1) > 0
+
+    def count_captures(self, limit: int = 1 << 30) -> int:
+        """
+        Count the legal captures, each promotion while taking counting once per piece. The attack masks of each kind
+        of piece are intersected with the opponent's pieces and the check and pin masks and then counted, so no move
+        list is built unless get_moves() already cached one.
+
+        Parameters
+        ----------
+        limit : int, optional
+            Stop counting once this many are found. Defaults to no limit.
+        """
+        if self.moves is not None:
+            return sum(1 for move in self.moves if self.is_capture(move))
+        color_local: int = self.color
+        color_mask: int = self.white_pieces if color_local == 1 else self.black_pieces
+        opponent_mask: int = self.black_pieces if color_local == 1 else self.white_pieces
+        pieces: int = color_mask | opponent_mask
+        check_info: CheckInfo | None = self.get_check_info()
+        king_idx: int = -1
+        own_kings: int = 0
+        evasion_mask: int = full_board
+        pinned: int = 0
+        danger: int = 0
+        if check_info is not None:
+            king_idx, own_kings, _, evasion_mask, pinned, danger = check_info
+        # Only a pinned piece's captures along the line to its king are legal
+        line_local: tuple[int, ...] = line_masks[king_idx] if king_idx != -1 else ()
+        # Non-king captures have to take the checker
+        targets: int = opponent_mask & evasion_mask
+
+        count: int = 0
+        if own_kings:
+            count = (king_attack_masks[king_idx] & opponent_mask & ~danger).bit_count()
+            other_kings: int = own_kings ^ bit_masks[king_idx]
+            while other_kings:
+                from_mask: int = other_kings & -other_kings
+                other_kings ^= from_mask
+                king_targets: int = king_attack_masks[64 - from_mask.bit_length()] & opponent_mask
+                while king_targets:
+                    to_mask: int = king_targets & -king_targets
+                    king_targets ^= to_mask
+                    if not attackers_to(64 - to_mask.bit_length(), pieces ^ from_mask, opponent_mask, -color_local,
+                                        self.kings, self.queens, self.rooks, self.bishops, self.knights, self.pawns):
+                        count += 1
+        if count >= limit or not targets and not self.last_move:
+            return count
+
+        pawns: int = self.pawns & color_mask
+        free_pawns: int = pawns & ~pinned
+        if color_local == 1:
+            captured: tuple[int, int] = ((free_pawns & not_h_file) << 7 & targets,
+                                         (free_pawns & not_a_file) << 9 & targets)
+            promotion_rank: int = 0xFF << 56
+        else:
+            captured = ((free_pawns & not_h_file) >> 9 & targets, (free_pawns & not_a_file) >> 7 & targets)
+            promotion_rank = 0xFF
+        for side_captures in captured:
+            count += (side_captures & ~promotion_rank).bit_count() + 4 * (side_captures & promotion_rank).bit_count()
+        pinned_pawns: int = pawns & pinned
+        while pinned_pawns:
+            from_mask = pinned_pawns & -pinned_pawns
+            pinned_pawns ^= from_mask
+            h: int = 64 - from_mask.bit_length()
+            side_captures = ((white_pawn_attacks if color_local == 1 else black_pawn_attacks)[h] & targets &
+                             line_local[h])
+            count += (side_captures & ~promotion_rank).bit_count() + 4 * (side_captures & promotion_rank).bit_count()
+        if count >= limit:
+            return count
+
+        if self.last_move is not None:
+            # With no destinations allowed only en passant and the king captures are generated, and the kings are
+            # already counted
+            en_passant_moves: list[tuple[int, int, int]] = [
+                move for move in self.generate_moves(True, False, 0) if move[0] == -2]
+            count += len(en_passant_moves if check_info is None else self.filter_legal(en_passant_moves, check_info))
+
+        # Pinned knights can never move, and pinned sliders only along the line to their king
+        knights: int = self.knights & color_mask & ~pinned
+        while knights and count < limit:
+            from_mask = knights & -knights
+            knights ^= from_mask
+            count += (knight_attack_masks[64 - from_mask.bit_length()] & targets).bit_count()
+        sliders: int = (self.bishops | self.queens) & color_mask
+        while sliders and count < limit:
+            from_mask = sliders & -sliders
+            sliders ^= from_mask
+            h = 64 - from_mask.bit_length()
+            count += (bishop_attacks(h, pieces) & targets & (line_local[h] if from_mask & pinned else full_board)
+                      ).bit_count()
+        sliders = (self.rooks | self.queens) & color_mask
+        while sliders and count < limit:
+            from_mask = sliders & -sliders
+            sliders ^= from_mask
+            h = 64 - from_mask.bit_length()
+            count += (rook_attacks(h, pieces) & targets & (line_local[h] if from_mask & pinned else full_board)
+                      ).bit_count()
+        return count
 
     @staticmethod
     def count_zero_bits(x: int) -> int:
         return 64 - (x & ((1 << 64) - 1)).bit_count()
 
+    def pack_move(self, move: tuple[int, int, int]) -> int:
+        """ Pack a move of this state into the int encoding of game_states.move_encoding. """
+        move_0, move_1, move_2 = move
+        if move_0 > 0:
+            return encode_move(64 - move_0.bit_length(), 64 - move_1.bit_length(), DOUBLE_PUSH if move_2 else NORMAL)
+        from_idx: int = 64 - move_2.bit_length()
+        if move_0 == -1:  # Castle
+            return encode_move(from_idx, from_idx + 2 * move_1, CASTLE)
+        if move_0 == -2:  # En Passant
+            return encode_move(from_idx, from_idx - 8 * self.color + move_1, EN_PASSANT)
+        if move_0 == -3:  # Promotion
+            return encode_move(from_idx, from_idx - 8 * self.color, PROMOTION - 2 + abs(move_1))
+        # Promotion while taking
+        return encode_move(from_idx, from_idx - 8 * self.color + move_1, PROMOTION - 4 - move_0)
+
+    def unpack_move(self, packed: int) -> tuple[int, int, int]:
+        """ Turn a packed move back into the tuple that get_moves() gives for this state. """
+        from_idx, to_idx, flag = decode_move(packed)
+        from_mask: int = bit_masks[from_idx]
+        if flag == NORMAL:
+            return from_mask, bit_masks[to_idx], 0
+        if flag == DOUBLE_PUSH:
+            return from_mask, bit_masks[to_idx], from_idx % 8 + 1
+        if flag == CASTLE:
+            return -1, 1 if to_idx > from_idx else -1, from_mask
+        direction: int = to_idx - from_idx + 8 * self.color
+        if flag == EN_PASSANT:
+            return -2, direction, from_mask
+        if direction:  # Promotion while taking
+            return PROMOTION - 4 - flag, direction, from_mask
+        return -3, (flag - 2) * self.color, from_mask
+
+    def get_moves_packed(self) -> list[int]:
+        """ The legal moves of get_moves(), packed into ints. """
+        pack_move: Callable[[tuple[int, int, int]], int] = self.pack_move
+        return [pack_move(move) for move in self.get_moves()]
+
+    def move_packed(self, packed: int) -> 'GameStateBitboardsV3':
+        """ Make a packed move, the same as move(unpack_move(packed)). """
+        return self.move(self.unpack_move(packed))
+
     def move(self, move: tuple[int, int, int]) -> 'GameStateBitboardsV3':
         """
         Make a move on the board.
@@ -484,6 +1111,13 @@ class GameStateBitboardsV3(GameStateBase):
         new_moves_since_pawn: int = self.moves_since_pawn + 1
         color_local: int = self.color
         move_0, move_1, move_2 = move  # type: int, int, int
+        new_mailbox: bytearray | None = self.moved_mailbox(move)
+
+        # The Zobrist key without the side to move, castling rights and en passant file, updated piece by piece
+        last_move_local: tuple[int, int, int] | None = self.last_move
+        board_key: int = self.hash_state ^ state_key(color_local, white_queen, white_king, black_queen, black_king,
+                                                     -1 if last_move_local is None else last_move_local[2] - 1)
+        keys: tuple[tuple[int, ...], ...] = piece_square_keys
 
         if move_0 == -1:  # Castle
             if color_local == 1:
@@ -517,38 +1151,64 @@ class GameStateBitboardsV3(GameStateBase):
                     new_rooks = ((
                                          new_rooks & ~0b0000_0001_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
                                  0b0000_0100_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
-                new_kings = ((new_kings & ~0b0000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
-                             0b0000_0010_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
+                    new_kings = ((
+                                         new_kings & ~0b0000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
+                                 0b0000_0010_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
+            king_idx: int = 60 if color_local == 1 else 4
+            rook_idx: int = king_idx + (3 if move_1 == 1 else -4)
+            board_key ^= (keys[6 + 6 * color_local][king_idx] ^ keys[6 + 6 * color_local][king_idx + 2 * move_1] ^
+                          keys[6 + 4 * color_local][rook_idx] ^ keys[6 + 4 * color_local][king_idx + move_1])
             return GameStateBitboardsV3(new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks,
                                         new_bishops,
                                         new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
                                         moves_since_pawn=new_moves_since_pawn,
-                                        color=-color_local, turn=self.turn + 1, winner=self.winner)
+                                        color=-color_local, turn=self.turn + 1, winner=self.winner, mailbox=new_mailbox,
+                                        hash_state=board_key ^ state_key(-color_local, white_queen, white_king,
+                                                                         black_queen, black_king))
 
         if move_0 == -2:  # En Passant
             if color_local == 1:
                 dest_square = (move_2 << 8 - move_1)
+                captured_square = dest_square >> 8
                 new_white_pieces = (new_white_pieces & ~move_2) | dest_square
-                new_black_pieces &= ~(dest_square >> 8)
-                new_pawns = (new_pawns & ~move_2 & ~(dest_square >> 8)) | dest_square
+                new_black_pieces &= ~captured_square
             else:
                 dest_square = (move_2 >> 8 + move_1)
+                captured_square = dest_square << 8
                 new_black_pieces = (new_black_pieces & ~move_2) | dest_square
-                new_white_pieces &= ~(dest_square << 8)
-                new_pawns = (new_pawns & ~move_2 & ~(dest_square << 8)) | dest_square
+                new_white_pieces &= ~captured_square
+            new_pawns = (new_pawns & ~move_2 & ~captured_square) | dest_square
+            board_key ^= (keys[6 + color_local][64 - move_2.bit_length()] ^
+                          keys[6 + color_local][64 - dest_square.bit_length()] ^
+                          keys[6 - color_local][64 - captured_square.bit_length()])
             return GameStateBitboardsV3(new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks,
                                         new_bishops,
                                         new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
-                                        color=-color_local, turn=self.turn + 1, winner=self.winner)
+                                        color=-color_local, turn=self.turn + 1, winner=self.winner, mailbox=new_mailbox,
+                                        hash_state=board_key ^ state_key(-color_local, white_queen, white_king,
+                                                                         black_queen, black_king))
 
-        if move_0 == -3:  # Promotion
-            new_piece_mask = move_2 << 8 if color_local == 1 else move_2 >> 8
+        if move_0 <= -3:  # Promotion, possibly while taking
+            if move_0 == -3:
+                promotion_piece: int = move_1
+                new_piece_mask = move_2 << 8 if color_local == 1 else move_2 >> 8
+            else:
+                promotion_piece = (-2 - move_0) * color_local
+                new_piece_mask = (move_2 << 8 - move_1) if color_local == 1 else (move_2 >> 8 + move_1)
+                # One read when the mailbox is kept
+                captured_piece: int = self.piece_at(64 - new_piece_mask.bit_length())
+                piece_boards: list[int] = [0, new_pawns, new_knights, new_bishops, new_rooks, new_queens, new_kings]
+                piece_boards[abs(captured_piece)] &= ~new_piece_mask
+                _, new_pawns, new_knights, new_bishops, new_rooks, new_queens, new_kings = piece_boards
+                board_key ^= keys[6 + captured_piece][64 - new_piece_mask.bit_length()]
             if color_local == 1:
                 new_white_pieces = (new_white_pieces & ~move_2) | new_piece_mask
+                new_black_pieces &= ~new_piece_mask
             else:
                 new_black_pieces = (new_black_pieces & ~move_2) | new_piece_mask
+                new_white_pieces &= ~new_piece_mask
             new_pawns &= ~move_2
-            promotion_piece_type: int = abs(move_1)
+            promotion_piece_type: int = abs(promotion_piece)
             if promotion_piece_type == 2:
                 new_knights |= new_piece_mask
             elif promotion_piece_type == 3:
@@ -557,34 +1217,15 @@ class GameStateBitboardsV3(GameStateBase):
                 new_rooks |= new_piece_mask
             elif promotion_piece_type == 5:
                 new_queens |= new_piece_mask
+            board_key ^= (keys[6 + color_local][64 - move_2.bit_length()] ^
+                          keys[6 + promotion_piece][64 - new_piece_mask.bit_length()])
 
             return GameStateBitboardsV3(new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks,
                                         new_bishops,
                                         new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
-                                        color=-color_local, turn=self.turn + 1, winner=self.winner)
-
-        if move_0 <= -4:  # Promotion while taking
-            new_piece_mask = (move_2 << 8 - move_1) if color_local == 1 else (move_2 >> 8 + move_1)
-            if color_local == 1:
-                new_white_pieces = (new_white_pieces & ~move_2) | new_piece_mask
-                new_black_pieces &= ~new_piece_mask
-            else:
-                new_black_pieces = (new_black_pieces & ~move_2) | new_piece_mask
-                new_white_pieces &= ~new_piece_mask
-            new_pawns &= ~move_2
-            if move_0 == -7:
-                new_queens |= new_piece_mask
-            elif move_0 == -4:
-                new_knights |= new_piece_mask
-            elif move_0 == -5:
-                new_bishops |= new_piece_mask
-            elif move_0 == -6:
-                new_rooks |= new_piece_mask
-
-            return GameStateBitboardsV3(new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks,
-                                        new_bishops,
-                                        new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
-                                        color=-color_local, turn=self.turn + 1, winner=self.winner)
+                                        color=-color_local, turn=self.turn + 1, winner=self.winner, mailbox=new_mailbox,
+                                        hash_state=board_key ^ state_key(-color_local, white_queen, white_king,
+                                                                         black_queen, black_king))
 
         # ========================================================================
         # This is wierd below. Double check when revisiting
@@ -611,77 +1252,224 @@ class GameStateBitboardsV3(GameStateBase):
             new_moves_since_pawn = 0
 
         new_winner: int | None = self.winner
+        to_idx: int = 64 - move_1.bit_length()
         if color_local == 1:
             new_white_pieces = (new_white_pieces & ~move_0) | move_1
             new_black_pieces &= ~move_1
-            if new_black_pieces != self.black_pieces:
-                if new_pawns & move_1:
-                    new_pawns &= ~move_1
-                elif new_rooks & move_1:
-                    new_rooks &= ~move_1
-                elif new_queens & move_1:
-                    new_queens &= ~move_1
-                elif new_bishops & move_1:
-                    new_bishops &= ~move_1
-                elif new_knights & move_1:
-                    new_knights &= ~move_1
-                else:
-                    new_winner = 1
-                    new_kings &= ~move_1
         else:
             new_black_pieces = (new_black_pieces & ~move_0) | move_1
             new_white_pieces &= ~move_1
-            if new_white_pieces != self.white_pieces:
-                if new_pawns & move_1:
-                    new_pawns &= ~move_1
-                elif new_rooks & move_1:
-                    new_rooks &= ~move_1
-                elif new_queens & move_1:
-                    new_queens &= ~move_1
-                elif new_bishops & move_1:
-                    new_bishops &= ~move_1
-                elif new_knights & move_1:
-                    new_knights &= ~move_1
-                else:
-                    new_winner = -1
-                    new_kings &= ~move_1
-
-        if new_pawns & move_0:
-            new_pawns &= ~move_0
-            new_pawns |= move_1
-        elif new_rooks & move_0:
-            new_rooks &= ~move_0
-            new_rooks |= move_1
-        elif new_queens & move_0:
-            new_queens &= ~move_0
-            new_queens |= move_1
-        elif new_bishops & move_0:
-            new_bishops &= ~move_0
-            new_bishops |= move_1
-        elif new_knights & move_0:
-            new_knights &= ~move_0
-            new_knights |= move_1
-        else:
-            new_kings &= ~move_0
-            new_kings |= move_1
-
-        new_previous_position_count = dict(self.previous_position_count)
-        if (hash_state := hash((new_white_pieces, new_kings, new_queens, new_rooks, new_bishops,
-                                new_knights, new_pawns))) in new_previous_position_count:
-            new_previous_position_count[hash_state] += 1
-            if new_previous_position_count[hash_state] >= 3:
-                return GameStateBitboardsV3(new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks,
-                                            new_bishops,
-                                            new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
-                                            color=-self.color, turn=self.turn + 1, winner=0)
-        else:
-            new_previous_position_count[hash_state] = 1
+        moving_piece, captured_piece, piece_boards = self.moved_piece_boards(move_0, move_1)
+        _, new_pawns, new_knights, new_bishops, new_rooks, new_queens, new_kings = piece_boards
+        if captured_piece:
+            board_key ^= keys[6 + captured_piece][to_idx]
+            if captured_piece == -6 * color_local:
+                new_winner = color_local
+        board_key ^= keys[6 + moving_piece][64 - move_0.bit_length()] ^ keys[6 + moving_piece][to_idx]
+
+        # The history starts again at each pawn move with the board it leaves, so one more entry than the clock
+        if repetition_count(self.position_history, board_key, self.moves_since_pawn + 1) >= 2:
+            return GameStateBitboardsV3(new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks,
+                                        new_bishops,
+                                        new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
+                                        color=-self.color, turn=self.turn + 1, winner=0, mailbox=new_mailbox)
         last_move: tuple[int, int, int] | None = move if move_2 else None
         return GameStateBitboardsV3(new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks, new_bishops,
                                     new_knights, new_pawns, white_queen, white_king, black_queen, black_king,
                                     last_move=last_move, color=-self.color, turn=self.turn + 1, winner=new_winner,
-                                    moves_since_pawn=new_moves_since_pawn,
-                                    previous_position_count=new_previous_position_count)
+                                    moves_since_pawn=new_moves_since_pawn, mailbox=new_mailbox,
+                                    position_history=(board_key, self.position_history),
+                                    hash_state=board_key ^ state_key(-color_local, white_queen, white_king,
+                                                                     black_queen, black_king,
+                                                                     -1 if last_move is None else move_2 - 1))
+
+    def make_move(self, move: tuple[int, int, int]) -> None:
+        """
+        Make a move on this state in place, for search that walks the tree on one object.
+
+        Does the same as move() without allocating a new state. Each call pushes an entry onto the undo stack, which
+        unmake_move pops to restore the state exactly as it was.
+
+        Parameters
+        ----------
+        move : tuple[int, int, int]
+            A move from get_moves() or get_moves_no_check() of this state.
+        """
+        new_white_pieces: int = self.white_pieces
+        new_black_pieces: int = self.black_pieces
+        new_kings: int = self.kings
+        new_queens: int = self.queens
+        new_rooks: int = self.rooks
+        new_bishops: int = self.bishops
+        new_knights: int = self.knights
+        new_pawns: int = self.pawns
+        white_queen: bool = self.white_queen
+        white_king: bool = self.white_king
+        black_queen: bool = self.black_queen
+        black_king: bool = self.black_king
+        new_moves_since_pawn: int = self.moves_since_pawn + 1
+        new_winner: int | None = self.winner
+        new_last_move: tuple[int, int, int] | None = None
+        position_history: PositionHistory | None = self.position_history
+        new_position_history: PositionHistory | None = None
+        color_local: int = self.color
+        last_move_local: tuple[int, int, int] | None = self.last_move
+        undo_stack: list[UndoEntry] | None = self.undo_stack
+        if undo_stack is None:
+            undo_stack = self.undo_stack = []
+
+        board_key: int = self.hash_state ^ state_key(color_local, white_queen, white_king, black_queen, black_king,
+                                                     -1 if last_move_local is None else last_move_local[2] - 1)
+        keys: tuple[tuple[int, ...], ...] = piece_square_keys
+
+        move_0, move_1, move_2 = move  # type: int, int, int
+        if move_0 == -1:  # Castle
+            # The king and rook squares of the side castling, with the rook on the a or h file
+            king_mask: int = 0b0000_1000 if color_local == 1 else 0b0000_1000 << 56
+            rook_mask: int = king_mask >> 3 if move_1 == 1 else king_mask << 4
+            king_dest: int = king_mask >> 2 if move_1 == 1 else king_mask << 2
+            rook_dest: int = king_mask >> 1 if move_1 == 1 else king_mask << 1
+            if color_local == 1:
+                white_queen = False
+                white_king = False
+                new_white_pieces = (new_white_pieces & ~(king_mask | rook_mask)) | king_dest | rook_dest
+            else:
+                black_queen = False
+                black_king = False
+                new_black_pieces = (new_black_pieces & ~(king_mask | rook_mask)) | king_dest | rook_dest
+            new_rooks = (new_rooks & ~rook_mask) | rook_dest
+            new_kings = (new_kings & ~king_mask) | king_dest
+            king_idx: int = 60 if color_local == 1 else 4
+            rook_idx: int = king_idx + (3 if move_1 == 1 else -4)
+            board_key ^= (keys[6 + 6 * color_local][king_idx] ^ keys[6 + 6 * color_local][king_idx + 2 * move_1] ^
+                          keys[6 + 4 * color_local][rook_idx] ^ keys[6 + 4 * color_local][king_idx + move_1])
+        elif move_0 == -2:  # En Passant
+            if color_local == 1:
+                dest_square: int = (move_2 << 8 - move_1)
+                captured_square: int = dest_square >> 8
+                new_white_pieces = (new_white_pieces & ~move_2) | dest_square
+                new_black_pieces &= ~captured_square
+            else:
+                dest_square = (move_2 >> 8 + move_1)
+                captured_square = dest_square << 8
+                new_black_pieces = (new_black_pieces & ~move_2) | dest_square
+                new_white_pieces &= ~captured_square
+            new_pawns = (new_pawns & ~move_2 & ~captured_square) | dest_square
+            new_moves_since_pawn = 0
+            board_key ^= (keys[6 + color_local][64 - move_2.bit_length()] ^
+                          keys[6 + color_local][64 - dest_square.bit_length()] ^
+                          keys[6 - color_local][64 - captured_square.bit_length()])
+        elif move_0 <= -3:  # Promotion, possibly while taking
+            if move_0 == -3:
+                promotion_piece: int = move_1
+                new_piece_mask: int = move_2 << 8 if color_local == 1 else move_2 >> 8
+            else:
+                promotion_piece = (-2 - move_0) * color_local
+                new_piece_mask = (move_2 << 8 - move_1) if color_local == 1 else (move_2 >> 8 + move_1)
+                # One read when the mailbox is kept
+                captured_piece: int = self.piece_at(64 - new_piece_mask.bit_length())
+                piece_boards: list[int] = [0, new_pawns, new_knights, new_bishops, new_rooks, new_queens, new_kings]
+                piece_boards[abs(captured_piece)] &= ~new_piece_mask
+                _, new_pawns, new_knights, new_bishops, new_rooks, new_queens, new_kings = piece_boards
+                board_key ^= keys[6 + captured_piece][64 - new_piece_mask.bit_length()]
+            if color_local == 1:
+                new_white_pieces = (new_white_pieces & ~move_2) | new_piece_mask
+                new_black_pieces &= ~new_piece_mask
+            else:
+                new_black_pieces = (new_black_pieces & ~move_2) | new_piece_mask
+                new_white_pieces &= ~new_piece_mask
+            new_pawns &= ~move_2
+            promotion_piece_type: int = abs(promotion_piece)
+            if promotion_piece_type == 2:
+                new_knights |= new_piece_mask
+            elif promotion_piece_type == 3:
+                new_bishops |= new_piece_mask
+            elif promotion_piece_type == 4:
+                new_rooks |= new_piece_mask
+            elif promotion_piece_type == 5:
+                new_queens |= new_piece_mask
+            new_moves_since_pawn = 0
+            board_key ^= (keys[6 + color_local][64 - move_2.bit_length()] ^
+                          keys[6 + promotion_piece][64 - new_piece_mask.bit_length()])
+        else:
+            if new_rooks & move_0:
+                if move_0 == 0b1000_0000:
+                    white_queen = False
+                elif move_0 == 1:
+                    white_king = False
+                elif move_0 == 0b10000000_00000000_00000000_00000000_00000000_00000000_00000000_00000000:
+                    black_queen = False
+                elif move_0 == 0b00000001_00000000_00000000_00000000_00000000_00000000_00000000_00000000:
+                    black_king = False
+            elif new_kings & move_0:
+                if move_0 == 0b0000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000:
+                    black_queen = False
+                    black_king = False
+                elif move_0 == 0b0000_1000:
+                    white_queen = False
+                    white_king = False
+
+            to_idx: int = 64 - move_1.bit_length()
+            if color_local == 1:
+                new_white_pieces = (new_white_pieces & ~move_0) | move_1
+                new_black_pieces &= ~move_1
+            else:
+                new_black_pieces = (new_black_pieces & ~move_0) | move_1
+                new_white_pieces &= ~move_1
+            moving_piece, captured_piece, piece_boards = self.moved_piece_boards(move_0, move_1)
+            _, new_pawns, new_knights, new_bishops, new_rooks, new_queens, new_kings = piece_boards
+            if captured_piece:
+                board_key ^= keys[6 + captured_piece][to_idx]
+                if captured_piece == -6 * color_local:
+                    new_winner = color_local
+            if moving_piece == color_local:
+                new_moves_since_pawn = 0
+            board_key ^= keys[6 + moving_piece][64 - move_0.bit_length()] ^ keys[6 + moving_piece][to_idx]
+            new_position_history = (board_key, position_history)
+            if repetition_count(position_history, board_key, self.moves_since_pawn + 1) >= 2:
+                new_winner = 0
+            if move_2:
+                new_last_move = move
+
+        undo_stack.append(((self.white_pieces, self.black_pieces, self.kings, self.queens, self.rooks, self.bishops,
+                            self.knights, self.pawns), self.white_queen, self.white_king, self.black_queen,
+                           self.black_king, last_move_local, self.moves_since_pawn, self.hash_state, self.winner,
+                           self.moves, position_history, self.mailbox))
+        self.mailbox = self.moved_mailbox(move)
+        self.white_pieces = new_white_pieces
+        self.black_pieces = new_black_pieces
+        self.kings = new_kings
+        self.queens = new_queens
+        self.rooks = new_rooks
+        self.bishops = new_bishops
+        self.knights = new_knights
+        self.pawns = new_pawns
+        self.white_queen = white_queen
+        self.white_king = white_king
+        self.black_queen = black_queen
+        self.black_king = black_king
+        self.last_move = new_last_move
+        self.moves_since_pawn = new_moves_since_pawn
+        self.position_history = new_position_history
+        self.winner = new_winner
+        self.color = -color_local
+        self.turn += 1
+        self.moves = None
+        self.checked = None
+        self.hash_state = board_key ^ state_key(-color_local, white_queen, white_king, black_queen, black_king,
+                                                -1 if new_last_move is None else move_2 - 1)
+
+    def unmake_move(self) -> None:
+        """ Take back the last move made with make_move. """
+        undo_stack: list[UndoEntry] | None = self.undo_stack
+        assert undo_stack, "unmake_move called without a move to take back"
+        ((self.white_pieces, self.black_pieces, self.kings, self.queens, self.rooks, self.bishops, self.knights,
+          self.pawns), self.white_queen, self.white_king, self.black_queen, self.black_king, self.last_move,
+         self.moves_since_pawn, self.hash_state, self.winner, self.moves, self.position_history,
+         self.mailbox) = undo_stack.pop()
+        self.color = -self.color
+        self.turn -= 1
+        self.checked = None
 
     def move_only_board(self, move: tuple[int, int, int]) -> tuple[int, int, int, int, int, int, int, int]:
         """
@@ -740,8 +1528,9 @@ class GameStateBitboardsV3(GameStateBase):
                     new_rooks = ((new_rooks &
                                   ~0b0000_0001_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
                                  0b0000_0100_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
-                new_kings = ((new_kings & ~0b0000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
-                             0b0000_0010_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
+                    new_kings = ((new_kings &
+                                  ~0b0000_1000_00000000_00000000_00000000_00000000_00000000_00000000_00000000) |
+                                 0b0000_0010_00000000_00000000_00000000_00000000_00000000_00000000_00000000)
             return (new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks, new_bishops, new_knights,
                     new_pawns)
 
@@ -803,55 +1592,11 @@ class GameStateBitboardsV3(GameStateBase):
         if color_local == 1:
             new_white_pieces = (new_white_pieces & ~move_0) | move_1
             new_black_pieces &= ~move_1
-            if new_black_pieces != self.black_pieces:
-                if new_pawns & move_1:
-                    new_pawns &= ~move_1
-                elif new_rooks & move_1:
-                    new_rooks &= ~move_1
-                elif new_queens & move_1:
-                    new_queens &= ~move_1
-                elif new_bishops & move_1:
-                    new_bishops &= ~move_1
-                elif new_knights & move_1:
-                    new_knights &= ~move_1
-                else:
-                    new_kings &= ~move_1
         else:
             new_black_pieces = (new_black_pieces & ~move_0) | move_1
             new_white_pieces &= ~move_1
-            if new_white_pieces != self.white_pieces:
-                if new_pawns & move_1:
-                    new_pawns &= ~move_1
-                elif new_rooks & move_1:
-                    new_rooks &= ~move_1
-                elif new_queens & move_1:
-                    new_queens &= ~move_1
-                elif new_bishops & move_1:
-                    new_bishops &= ~move_1
-                elif new_knights & move_1:
-                    new_knights &= ~move_1
-                else:
-                    new_kings &= ~move_1
-
-        if new_pawns & move_0:
-            new_pawns &= ~move_0
-            new_pawns |= move_1
-        elif new_rooks & move_0:
-            new_rooks &= ~move_0
-            new_rooks |= move_1
-        elif new_queens & move_0:
-            new_queens &= ~move_0
-            new_queens |= move_1
-        elif new_bishops & move_0:
-            new_bishops &= ~move_0
-            new_bishops |= move_1
-        elif new_knights & move_0:
-            new_knights &= ~move_0
-            new_knights |= move_1
-        else:
-            new_kings &= ~move_0
-            new_kings |= move_1
-
+        _, new_pawns, new_knights, new_bishops, new_rooks, new_queens, new_kings = self.moved_piece_boards(
+            move_0, move_1)[2]
         return (new_white_pieces, new_black_pieces, new_kings, new_queens, new_rooks, new_bishops, new_knights,
                 new_pawns)
 
@@ -889,7 +1634,7 @@ class GameStateBitboardsV3(GameStateBase):
           color={self.color},
           turn={self.turn},
           winner={self.winner},
-          previous_position_count={self.previous_position_count},
+          position_history={self.position_history},
           moves={self.moves},
           moves_since_pawn={self.moves_since_pawn})"""
 
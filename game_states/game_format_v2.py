@@ -13,6 +13,9 @@ start_board: tuple[int, ...] = (
 
 
 class GameStateFormatV2(GameStateBase):
+    # Zobrist key of the position, set by subclasses that keep one up to date in move()
+    hash_state: int
+
     def __init__(self, board: tuple[int, ...] | None = None, white_queen: bool = True, white_king: bool = True,
                  black_queen: bool = True, black_king: bool = True,
                  last_move: tuple[int, int, int] | None = None,
@@ -59,6 +62,11 @@ class GameStateFormatV2(GameStateBase):
     def get_moves(self) -> list[tuple[int, int, int]]:
         raise NotImplementedError
 
+    @property
+    def phase(self) -> int:
+        """ The number of knights, bishops, rooks and queens on the board, which tapered evaluation blends by. """
+        return sum(1 for piece in self.board if 2 <= abs(piece) <= 5)
+
     def get_moves_new(self) -> list[tuple[tuple[int, int, int], 'GameStateFormatV2']]:
         raise NotImplementedError
 
@@ -71,5 +79,13 @@ class GameStateFormatV2(GameStateBase):
     def move(self, move: tuple[int, int, int]) -> 'GameStateFormatV2':
         raise NotImplementedError
 
+    def pack_move(self, move: tuple[int, int, int]) -> int:
+        """ The move as a 16-bit int of game_states.move_encoding, which is never 0. """
+        raise NotImplementedError
+
+    def unpack_move(self, packed: int) -> tuple[int, int, int]:
+        """ The move of this position that pack_move() gave packed for. """
+        raise NotImplementedError
+
     def get_winner(self) -> int | None:
         raise NotImplementedError
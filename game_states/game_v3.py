@@ -1,4 +1,10 @@
+from typing import Callable, Iterator
+
 from game_states import GameStateFormatV2
+from game_states.game_base import PositionHistory, repetition_count
+from game_states.move_encoding import DOUBLE_PUSH, CASTLE, EN_PASSANT, PROMOTION, encode_move, decode_move
+from game_states.material import piece_deltas, board_piece_counts, piece_count, game_phase, only_kings
+from game_states.zobrist import piece_square_keys, state_key, board_key
 from utils import split_table
 
 # Precompute index-to-coordinate mapping for faster lookups
@@ -11,6 +17,8 @@ tuple[int, ...], tuple[int, ...]], ...]
 bishop_diagonals: tuple[tuple[tuple[int, ...], tuple[int, ...],
 tuple[int, ...], tuple[int, ...]], ...]
 promotion_pieces: tuple[int, ...] = (5, 4, 3, 2)
+# What generate_moves() allows pieces to move to when it is given no destinations
+every_square: tuple[bool, ...] = (True,) * 64
 
 
 def populate_precomputed_tables() -> None:
@@ -93,15 +101,65 @@ def populate_precomputed_tables() -> None:
 
 populate_precomputed_tables()
 
+# Everything make_move changes that unmake_move cannot work out from the move itself: the board before the move,
+# castling rights, last move, moves since pawn, hash, winner, cached moves, the position history and the piece counts
+UndoEntry = tuple[tuple[int, ...], bool, bool, bool, bool, tuple[int, int, int] | None, int, int, int | None,
+                  list[tuple[int, int, int]] | None, PositionHistory | None, int]
+
+# What get_check_info finds about the king of the player to move: its square, the number of checks, the squares that
+# answer a single check and the squares along which each pinned piece may move
+CheckInfo = tuple[int, int, tuple[int, ...], dict[int, tuple[int, ...]]]
+
+
+def square_attacked(board: tuple[int, ...] | list[int], h: int, attacker_color: int, ignore_idx: int = -1) -> bool:
+    """
+    Whether any piece of attacker_color attacks square h, scanning outward from h. The square at ignore_idx is treated
+    as empty, which lets a king test a destination without blocking rays with its own starting square.
+    """
+    for ray in rook_rays[h]:
+        for ray_idx in ray:
+            piece: int = board[ray_idx]
+            if piece == 0 or ray_idx == ignore_idx:
+                continue
+            if piece * attacker_color == 4 or piece * attacker_color == 5:
+                return True
+            break
+    for diagonal in bishop_diagonals[h]:
+        for diagonal_idx in diagonal:
+            piece = board[diagonal_idx]
+            if piece == 0 or diagonal_idx == ignore_idx:
+                continue
+            if piece * attacker_color == 3 or piece * attacker_color == 5:
+                return True
+            break
+    for target_idx in knight_targets[h]:
+        if board[target_idx] * attacker_color == 2:
+            return True
+    for target_idx in king_targets[h]:
+        if board[target_idx] * attacker_color == 6 and target_idx != h:
+            return True
+    j: int = h % 8
+    pawn_idx: int = h + 8 * attacker_color
+    if 0 <= pawn_idx < 64:
+        if j != 7 and board[pawn_idx + 1] == attacker_color:
+            return True
+        if j != 0 and board[pawn_idx - 1] == attacker_color:
+            return True
+    return False
+
 
 class GameStateV3(GameStateFormatV2):
     __slots__ = ('board', 'color', 'white_queen', 'white_king', 'black_queen', 'black_king', 'last_move', 'turn',
-                 'winner', 'previous_position_count', 'moves_since_pawn', 'moves', 'moves_and_states')
+                 'winner', 'moves_since_pawn', 'moves', 'moves_and_states', 'hash_state', 'undo_stack',
+                 'position_history', 'checked', 'piece_counts')
+    # Repetitions are found in position_history
+    keeps_position_count: bool = False
 
     def __init__(self, board: tuple[int, ...] | None = None, white_queen: bool = True, white_king: bool = True,
                  black_queen: bool = True, black_king: bool = True, last_move: tuple[int, int, int] | None = None,
                  color: int = 1, turn: int = 0, winner: int | None = None,
-                 previous_position_count: dict[int, int] | None = None, moves_since_pawn: int = 0) -> None:
+                 position_history: PositionHistory | None = None, moves_since_pawn: int = 0,
+                 hash_state: int | None = None, piece_counts: int | None = None) -> None:
         """
         Initialize a GameStateV3 object.
 
@@ -125,14 +183,29 @@ class GameStateV3(GameStateFormatV2):
             The turn number. Defaults to 0.
         winner : int | None, optional
             The winner of the game (1 for white, -1 for black, 0 for draw). Defaults to None.
-        previous_position_count : dict[int, int] | None, optional
-            A dictionary of previous positions and their counts. Defaults to None.
+        position_history : PositionHistory | None, optional
+            The board keys the repetition rule counts, shared with the states before this one. Defaults to None.
         moves_since_pawn : int, optional
             The number of moves since the last pawn move. Defaults to 0.
+        hash_state : int | None, optional
+            The Zobrist key of the position, which move() passes on after updating it. Computed from the board when
+            None. Defaults to None.
+        piece_counts : int | None, optional
+            The piece counts, phase and material of game_states.material, which move() also passes on. Computed from
+            the board when None. Defaults to None.
         """
         self.moves_and_states: list[tuple[tuple[int, int, int], GameStateV3]] | None = None
+        # Only created once make_move is used, so states from move() stay as light as before
+        self.undo_stack: list[UndoEntry] | None = None
+        self.position_history: PositionHistory | None = position_history
+        # Whether the player to move is in check, worked out the first time in_check or get_check_info() needs it
+        self.checked: bool | None = None
         super().__init__(board, white_queen, white_king, black_queen, black_king, last_move,
-                         color, turn, winner, previous_position_count, moves_since_pawn)
+                         color, turn, winner, moves_since_pawn=moves_since_pawn)
+        self.hash_state: int = hash_state if hash_state is not None else (
+                board_key(self.board) ^ state_key(color, white_queen, white_king, black_queen, black_king,
+                                                  -1 if last_move is None else last_move[1] % 8))
+        self.piece_counts: int = piece_counts if piece_counts is not None else board_piece_counts(self.board)
 
     def get_hashable_state(self) -> tuple[tuple[int, ...], int, bool, bool, bool, bool,
     tuple[int, int, int] | None, int]:
@@ -141,12 +214,15 @@ class GameStateV3(GameStateFormatV2):
                 self.last_move, self.turn)
 
     def __hash__(self) -> int:
-        return hash((self.board, self.color, self.white_queen, self.white_king, self.black_queen, self.black_king,
-                     self.last_move, self.turn))
+        return self.hash_state
 
     def get_moves(self) -> list[tuple[int, int, int]]:
         """
-        Get all the possible moves for the current player.
+        Get all the legal moves for the current player.
+
+        Checking pieces and pinned pieces are found in one scan outward from the king, after which each pseudo-legal
+        move is kept or dropped without being played out. King moves and castling test the squares the king lands on or
+        crosses, and only en passant is played out on a board.
 
         Returns
         -------
@@ -154,153 +230,197 @@ class GameStateV3(GameStateFormatV2):
             A list of tuples, each representing a move in the format (start_row, start_col, end_row, end_col).
         """
         if self.moves is not None: return self.moves
-        moves: list[tuple[int, int, int]] = self.get_moves_no_check()
+        pseudo_moves: list[tuple[int, int, int]] = self.get_moves_no_check()
+        check_info: CheckInfo | None = self.get_check_info()
+        if check_info is None:
+            self.moves = pseudo_moves
+            if self.moves_since_pawn >= 100:
+                self.winner = 0
+            return pseudo_moves
+        moves: list[tuple[int, int, int]] = self.filter_legal(pseudo_moves, check_info)
         self.moves = moves
-        pop_idx_base: int = len(moves) - 1
-        color_local = self.color
-        bishop_diagonals_local: tuple[tuple[tuple[int, ...], tuple[int, ...],
-        tuple[int, ...], tuple[int, ...]], ...] = bishop_diagonals
-        rook_rays_local: tuple[tuple[tuple[int, ...], tuple[int, ...],
-        tuple[int, ...], tuple[int, ...]], ...] = rook_rays
-        knight_targets_local: tuple[tuple[int, ...], ...] = knight_targets
-        king_targets_local: tuple[tuple[int, ...], ...] = king_targets
-        king_idx: int = -1
-        coords_local: list[tuple[int, int]] = index_to_coord
-        for i, piece in enumerate(self.board):
-            if piece * color_local == 6:
-                king_idx = i
-                break
-        for i, move in enumerate(reversed(moves)):
-            board_local: list[int] = self.move_only_board(move)
-            illegal: bool = False
-            if move[0] == -1:  # Castle
-                cs0, cs1, cs2 = king_idx, king_idx + move[1], king_idx + move[1] * 2  # type: int, int, int
-                for h, piece in enumerate(board_local):
-                    piece_type = color_local * piece
-                    if piece_type >= 0: continue
-                    if piece_type == -3 or piece_type == -5:
-                        for diagonal in bishop_diagonals_local[h]:
-                            for diagonal_idx in diagonal:
-                                if diagonal_idx == cs0 or diagonal_idx == cs1 or diagonal_idx == cs2:
-                                    illegal = True
-                                    break
-                                if board_local[diagonal_idx]:
-                                    break
-                            if illegal:
-                                break
-                        if illegal:
-                            moves.pop(pop_idx_base - i)
-                            break
-                    if (piece_type == -4 or piece_type == -5) and (coords_local[cs0][0] == coords_local[h][0] or
-                                                                   coords_local[cs0][1] == coords_local[h][1] or
-                                                                   coords_local[cs1][0] == coords_local[h][0] or
-                                                                   coords_local[cs1][1] == coords_local[h][1] or
-                                                                   coords_local[cs2][0] == coords_local[h][0] or
-                                                                   coords_local[cs2][1] == coords_local[h][1]):
-                        for ray in rook_rays_local[h]:
-                            for ray_idx in ray:
-                                if ray_idx == cs0 or ray_idx == cs1 or ray_idx == cs2:
-                                    illegal = True
-                                    break
-                                if board_local[ray_idx]:
-                                    break
-                            if illegal:
-                                break
-                        if illegal:
-                            moves.pop(pop_idx_base - i)
-                            break
-                    elif piece_type == -6:
-                        for target_idx in king_targets_local[h]:
-                            if target_idx == cs0 or target_idx == cs1 or target_idx == cs2:
-                                break
-                        else:
-                            continue
-                        moves.pop(pop_idx_base - i)
-                        break
-                    elif piece_type == -2:
-                        for target_idx in knight_targets_local[h]:
-                            if target_idx == cs0 or target_idx == cs1 or target_idx == cs2:
-                                break
-                        else:
-                            continue
-                        moves.pop(pop_idx_base - i)
-                        break
-                    elif piece_type == -1:
-                        forward_idx = h + color_local * 8
-                        if forward_idx + 1 == cs0 or forward_idx + 1 == cs1 or forward_idx + 1 == cs2 or \
-                                forward_idx - 1 == cs0 or forward_idx - 1 == cs1 or forward_idx - 1 == cs2:
-                            moves.pop(pop_idx_base - i)
-                            break
-            else:
-                check_square: int = move[1] if move[2] == 6 or move[2] == -6 else king_idx
-                for h, piece in enumerate(board_local):
-                    piece_type = color_local * piece
-                    if piece_type >= 0: continue
-                    if piece_type == -3 or piece_type == -5 and (
-                            check_square % 9 == h % 9 or check_square % 7 == h % 7):
-                        for diagonal in bishop_diagonals_local[h]:
-                            for diagonal_idx in diagonal:
-                                if board_local[diagonal_idx] == 0:
-                                    continue
-                                if diagonal_idx == check_square:
-                                    illegal = True
-                                break
-                            if illegal:
-                                break
-                        if illegal:
-                            moves.pop(pop_idx_base - i)
-                            break
-                    if ((piece_type == -4 or piece_type == -5) and
-                            (coords_local[check_square][0] == coords_local[h][0] or
-                             coords_local[check_square][1] == coords_local[h][1])):
-                        for ray in rook_rays_local[h]:
-                            for ray_idx in ray:
-                                if board_local[ray_idx] == 0:
-                                    continue
-                                if ray_idx == check_square:
-                                    illegal = True
-                                break
-                            if illegal:
-                                break
-                        if illegal:
-                            moves.pop(pop_idx_base - i)
-                            break
-                    elif piece_type == -6:
-                        for target_idx in king_targets_local[h]:
-                            if target_idx == check_square:
-                                break
-                        else:
-                            continue
-                        moves.pop(pop_idx_base - i)
-                        break
-                    elif piece_type == -2:
-                        for target_idx in knight_targets_local[h]:
-                            if target_idx == check_square:
-                                break
-                        else:
-                            continue
-                        moves.pop(pop_idx_base - i)
-                        break
-                    elif piece_type == -1:
-                        forward_idx = h + color_local * 8
-                        if ((forward_idx + 1 == check_square and coords_local[h][1] != 7) or
-                            (forward_idx - 1 == check_square and coords_local[h][1] != 0)):
-                            moves.pop(pop_idx_base - i)
-                            break
 
-        if len(moves) == 0 and pop_idx_base > -1:
-            game_state: GameStateV3 = GameStateV3(self.board, False, False, False,
-                                                False, color=-self.color)
-            for _, dest_idx, _ in game_state.get_moves_no_check():
-                if dest_idx == king_idx:
-                    self.winner = -self.color
-                    return moves
-            self.winner = 0
-            return moves
+        if len(moves) == 0 and pseudo_moves:
+            self.winner = -self.color if self.in_check else 0
         elif self.moves_since_pawn >= 100:
             self.winner = 0
         return moves
 
+    def get_check_info(self) -> CheckInfo | None:
+        """
+        Scan outward from the king of the player to move for the pieces checking it and the pieces pinned to it.
+
+        Returns
+        -------
+        CheckInfo | None
+            The king square, the number of checks, the squares a non-king move has to land on to answer a single check
+            and, for each pinned piece, the squares it may move along. None if the player has no king.
+        """
+        color_local: int = self.color
+        board_local: tuple[int, ...] = self.board
+        if 6 * color_local not in board_local:
+            return None
+        king_idx: int = board_local.index(6 * color_local)
+
+        # Squares a non-king move has to land on while in check, and the squares each pinned piece may move along
+        checks: int = 0
+        evasion_squares: tuple[int, ...] = ()
+        pin_lines: dict[int, tuple[int, ...]] = {}
+        for lines, slider_type in ((rook_rays[king_idx], -4), (bishop_diagonals[king_idx], -3)):
+            for line in lines:
+                blocker_idx: int = -1
+                for k, line_idx in enumerate(line):
+                    piece_type: int = board_local[line_idx] * color_local
+                    if piece_type == 0:
+                        continue
+                    if piece_type > 0:
+                        if blocker_idx != -1:
+                            break
+                        blocker_idx = line_idx
+                        continue
+                    if piece_type == slider_type or piece_type == -5:
+                        if blocker_idx == -1:
+                            checks += 1
+                            evasion_squares = line[:k + 1]
+                        else:
+                            pin_lines[blocker_idx] = line[:k + 1]
+                    break
+        for target_idx in knight_targets[king_idx]:
+            if board_local[target_idx] * color_local == -2:
+                checks += 1
+                evasion_squares = (target_idx,)
+        for target_idx in king_targets[king_idx]:
+            if board_local[target_idx] * color_local == -6:
+                checks += 1
+                evasion_squares = (target_idx,)
+        pawn_idx: int = king_idx - 8 * color_local
+        if 0 <= pawn_idx < 64:
+            if king_idx % 8 != 7 and board_local[pawn_idx + 1] == -color_local:
+                checks += 1
+                evasion_squares = (pawn_idx + 1,)
+            if king_idx % 8 != 0 and board_local[pawn_idx - 1] == -color_local:
+                checks += 1
+                evasion_squares = (pawn_idx - 1,)
+        self.checked = checks > 0
+        return king_idx, checks, evasion_squares, pin_lines
+
+    def is_square_attacked(self, square: int, by_color: int) -> bool:
+        """ Whether any piece of by_color attacks the square, found by looking outward from the square. """
+        return square_attacked(self.board, square, by_color)
+
+    @property
+    def in_check(self) -> bool:
+        """ Whether the king of the player to move is attacked. Always False without a king. """
+        if self.checked is None:
+            king: int = 6 * self.color
+            self.checked = king in self.board and square_attacked(self.board, self.board.index(king), -self.color)
+        return self.checked
+
+    @property
+    def phase(self) -> int:
+        """ The number of knights, bishops, rooks and queens on the board, read from the piece counts. """
+        return game_phase(self.piece_counts)
+
+    def filter_legal(self, pseudo_moves: list[tuple[int, int, int]],
+                     check_info: CheckInfo) -> list[tuple[int, int, int]]:
+        """ Keep the pseudo-legal moves that do not leave the king in check, using the result of get_check_info(). """
+        color_local: int = self.color
+        board_local: tuple[int, ...] = self.board
+        king_idx, checks, evasion_squares, pin_lines = check_info
+        moves: list[tuple[int, int, int]] = []
+        for move in pseudo_moves:
+            move_0, move_1, move_2 = move
+            if move_0 == -1:  # Castle
+                if (not checks and not square_attacked(board_local, king_idx + move_1, -color_local) and
+                        not square_attacked(board_local, king_idx + 2 * move_1, -color_local)):
+                    moves.append(move)
+            elif move_0 == -2:  # En Passant
+                if not square_attacked(self.move_only_board(move), king_idx, -color_local):
+                    moves.append(move)
+            elif move_2 == 6 or move_2 == -6:
+                if not square_attacked(board_local, move_1, -color_local, move_0):
+                    moves.append(move)
+            elif checks < 2 and (not checks or move_1 in evasion_squares) and (
+                    move_0 not in pin_lines or move_1 in pin_lines[move_0]):
+                moves.append(move)
+        return moves
+
+    def get_captures(self) -> list[tuple[int, int, int]]:
+        """ Get the legal moves that take a piece, including en passant and promotions while taking. """
+        if self.moves is not None:
+            return [move for move in self.moves if self.is_capture(move)]
+        return self.get_legal_stage(True, self.get_check_info())
+
+    def get_evasions(self) -> list[tuple[int, int, int]]:
+        """
+        Get the legal moves while in check. Only the king moves and the moves to the squares that take the checker or
+        block its line are generated, and just the king moves in a double check. Out of check, this is get_moves().
+        """
+        if self.moves is not None:
+            return self.moves
+        check_info: CheckInfo | None = self.get_check_info()
+        if check_info is None or not check_info[1]:
+            return self.get_moves()
+        return self.filter_legal(self.generate_moves(destinations=check_info[2] if check_info[1] == 1 else ()),
+                                 check_info)
+
+    def iter_moves(self, stage_hint: tuple[int, int, int] | None = None) -> Iterator[tuple[int, int, int]]:
+        """
+        Yield the legal moves one stage at a time: stage_hint first, then the captures, then the quiet moves.
+
+        A stage is only generated when the consumer asks for its first move, so a search that cuts off on the hint or a
+        capture never generates the quiet moves. The hint is usually the best move stored for this position in a
+        transposition table, and is only yielded if it is legal here. Unlike get_moves(), nothing is cached and the
+        winner is not set.
+
+        Parameters
+        ----------
+        stage_hint : tuple[int, int, int] | None, optional
+            A move to try before any other. Defaults to None.
+        """
+        if self.moves is not None:
+            moves: list[tuple[int, int, int]] = self.moves
+            if stage_hint is not None and stage_hint in moves:
+                yield stage_hint
+            for move in moves:
+                if move != stage_hint and self.is_capture(move):
+                    yield move
+            for move in moves:
+                if move != stage_hint and not self.is_capture(move):
+                    yield move
+            return
+        check_info: CheckInfo | None = self.get_check_info()
+        captures: list[tuple[int, int, int]] | None = None
+        quiets: list[tuple[int, int, int]] | None = None
+        if stage_hint is not None:
+            # The hint is checked against the legal moves of its own stage, which is generated early for it
+            if self.is_capture(stage_hint):
+                captures = self.get_legal_stage(True, check_info)
+                if stage_hint in captures:
+                    yield stage_hint
+            else:
+                quiets = self.get_legal_stage(False, check_info)
+                if stage_hint in quiets:
+                    yield stage_hint
+        for move in captures if captures is not None else self.get_legal_stage(True, check_info):
+            if move != stage_hint:
+                yield move
+        for move in quiets if quiets is not None else self.get_legal_stage(False, check_info):
+            if move != stage_hint:
+                yield move
+
+    def get_legal_stage(self, captures: bool, check_info: CheckInfo | None) -> list[tuple[int, int, int]]:
+        """ The legal captures, or the legal quiet moves, given the result of get_check_info(). """
+        pseudo_moves: list[tuple[int, int, int]] = self.generate_moves(captures, not captures)
+        return pseudo_moves if check_info is None else self.filter_legal(pseudo_moves, check_info)
+
+    def is_capture(self, move: tuple[int, int, int]) -> bool:
+        """ Whether a move of this state takes a piece, counting en passant. """
+        move_0: int = move[0]
+        if move_0 == -2:
+            return True
+        return move_0 != -1 and self.board[move[1]] != 0
+
     def get_moves_new_a(self) -> list[tuple[int, int, int]]:
         """
         Get all the possible moves for the current player.
@@ -445,13 +565,7 @@ class GameStateV3(GameStateFormatV2):
                             break
 
         if len(moves) == 0 and pop_idx_base > -1:
-            game_state: GameStateV3 = GameStateV3(self.board, False, False, False,
-                                                False, color=-self.color)
-            for _, dest_idx, _ in game_state.get_moves_no_check():
-                if dest_idx == king_idx:
-                    self.winner = -self.color
-                    return moves
-            self.winner = 0
+            self.winner = -self.color if self.in_check else 0
             return moves
         elif self.moves_since_pawn >= 100:
             self.winner = 0
@@ -600,16 +714,7 @@ class GameStateV3(GameStateFormatV2):
 
         self.moves_and_states = moves_and_states
         if len(moves) == 0 and pop_idx_base > -1:
-            game_state: GameStateV3 = GameStateV3(self.board, self.white_queen, self.white_king,
-                                                  self.black_queen, self.black_king,
-                                                  color=-self.color, turn=self.turn, winner=self.winner)
-            for move in game_state.get_moves_no_check():
-                if (winner := game_state.move(move).get_winner()) == -1 or winner == 1:
-                    break
-            else:
-                self.winner = 0
-                return moves_and_states
-            self.winner = winner
+            self.winner = -self.color if self.in_check else 0
         elif self.moves_since_pawn >= 100:
             self.winner = 0
         return moves_and_states
@@ -652,114 +757,168 @@ class GameStateV3(GameStateFormatV2):
             else:
                 moves_and_states.append((move, state))
         if len(moves) == 0 and pop_idx_base > -1:
-            game_state: GameStateV3 = GameStateV3(self.board, self.white_queen, self.white_king,
-                                                  self.black_queen, self.black_king,
-                                                  color=-color_local, turn=self.turn, winner=self.winner)
-            for move in game_state.get_moves_no_check():
-                if (winner := game_state.move(move).get_winner()) == -1 or winner == 1:
-                    break
-            else:
-                self.winner = 0
-                self.moves = moves
-                return moves_and_states
-            self.winner = winner
+            self.winner = -color_local if self.in_check else 0
         elif self.moves_since_pawn >= 100:
             self.winner = 0
         self.moves = moves
         return moves_and_states
 
     def get_moves_no_check(self) -> list[tuple[int, int, int]]:
+        """ Get the pseudo-legal moves for the current player, which may leave their king in check. """
+        return self.generate_moves()
+
+    def generate_moves(self, captures: bool = True, quiets: bool = True,
+                       destinations: tuple[int, ...] | None = None) -> list[tuple[int, int, int]]:
+        """
+        Get the pseudo-legal captures, quiet moves or both, without walking to the squares of the other kind.
+
+        Captures include en passant and promotions while taking, and quiet moves include castling and promotions by
+        pushing. The moves come square by square, in the same order whichever kinds are asked for.
+
+        Parameters
+        ----------
+        captures : bool, optional
+            Whether to generate the moves that take a piece. Defaults to True.
+        quiets : bool, optional
+            Whether to generate the moves that do not. Defaults to True.
+        destinations : tuple[int, ...] | None, optional
+            The squares the pieces other than kings may move to, such as the squares that answer a check. Castling is
+            left out when they are given. Defaults to None, which allows every square.
+        """
         moves: list[tuple[int, int, int]] = []
-        # Local binds for speed
+        append: Callable[[tuple[int, int, int]], None] = moves.append
+        # A target square is wanted when the piece on it, seen by the player to move, is within these bounds
+        lowest: int = -6 if captures else 0
+        highest: int = 0 if quiets else -1
+        allowed: tuple[bool, ...] = every_square if destinations is None else tuple(
+            h in destinations for h in range(64))
         color_local: int = self.color
         board_local: tuple[int, ...] = self.board
         last_move_local: tuple[int, int, int] | None = self.last_move
-        coords_local: list[tuple[int, int]] = index_to_coord
-        knight_targets_local: tuple[tuple[int, ...], ...] = knight_targets
-        king_targets_local: tuple[tuple[int, ...], ...] = king_targets
-        rook_rays_local: tuple[tuple[tuple[int, ...], tuple[int, ...],
-        tuple[int, ...], tuple[int, ...]], ...] = rook_rays
-        bishop_diagonals_local: tuple[tuple[tuple[int, ...], tuple[int, ...],
-        tuple[int, ...], tuple[int, ...]], ...] = bishop_diagonals
-        for h, (piece, (i, j)) in enumerate(zip(board_local, coords_local)):
+        for h, piece in enumerate(board_local):
             piece_type: int = piece * color_local
             if piece_type <= 0: continue
-            if piece_type == 6:  # King
-                row_base: int = h - j
-                if (((color_local == 1 and self.white_king) or (color_local == -1 and self.black_king)) and
-                        board_local[row_base + 7] == 4 * color_local
-                        and board_local[row_base + 5] == board_local[row_base + 6] == 0):
-                    moves.append((-1, 1, h))
-                if (((color_local == 1 and self.white_queen) or (color_local == -1 and self.black_queen)) and
-                        board_local[row_base] == 4 * color_local
-                        and board_local[row_base + 1] == board_local[row_base + 2] == board_local[row_base + 3] == 0):
-                    moves.append((-1, -1, h))
-                for target_idx in king_targets_local[h]:
-                    if board_local[target_idx] * color_local <= 0:
-                        moves.append((h, target_idx, piece))
-            elif piece_type == 4 or piece_type == 5:  # Rook and Queen
-                for ray in rook_rays_local[h]:
-                    for ray_idx in ray:
-                        if board_local[ray_idx] * color_local <= 0:
-                            moves.append((h, ray_idx, piece))
-                        if board_local[ray_idx] == 0:
-                            continue
-                        break
-            if piece_type == 3 or piece_type == 5:  # Bishop and Queen
-                for diagonal in bishop_diagonals_local[h]:
-                    for diagonal_idx in diagonal:
-                        if board_local[diagonal_idx] == 0:
-                            moves.append((h, diagonal_idx, piece))
-                            continue
-                        if board_local[diagonal_idx] * color_local < 0:
-                            moves.append((h, diagonal_idx, piece))
-                        break
-            elif piece_type == 2:  # Knight
-                for target_idx in knight_targets_local[h]:
-                    if board_local[target_idx] * color_local <= 0:
-                        moves.append((h, target_idx, piece))
-            elif piece_type == 1:
+            if piece_type == 1:
+                i, j = index_to_coord[h]
                 dest_square: int = h - color_local * 8
-                if board_local[dest_square] == 0:
-                    if 7 != i - color_local != 0:
-                        moves.append((h, dest_square, piece))
-                    else:
-                        for promotion_piece in promotion_pieces:
-                            moves.append((h, dest_square, promotion_piece * color_local))
-                if 8 > (j + 1) and 0 > board_local[dest_square + 1] * color_local:
-                    if 7 != i - color_local != 0:
-                        moves.append((h, dest_square + 1, piece))
-                    else:  # Promotion
+                promotes: bool = not 7 != i - color_local != 0
+                pushes: bool = quiets and board_local[dest_square] == 0
+                if pushes and allowed[dest_square]:
+                    if promotes:
                         for promotion_piece in promotion_pieces:
-                            moves.append((h, dest_square + 1, promotion_piece * color_local))
-                if (j - 1) >= 0 > board_local[dest_square - 1] * color_local:
-                    if 7 != i - color_local != 0:
-                        moves.append((h, dest_square - 1, piece))
-                    else:  # Promotion
-                        for promotion_piece in promotion_pieces:
-                            moves.append((h, dest_square - 1, promotion_piece * color_local))
-                if color_local == 1:
-                    if i == 6 and board_local[4 * 8 + j] == 0 == board_local[5 * 8 + j]:
-                        moves.append((h, h - 16, piece))  # TODO: Make this count toward 50 move rule
-                elif i == 1 and board_local[3 * 8 + j] == 0 == board_local[2 * 8 + j]:
-                    moves.append((h, h + 16, piece))
-                # En Passant
-                if last_move_local is not None and i == last_move_local[1] // 8:
-                    if 7 != j == last_move_local[1] % 8 + 1:
-                        moves.append((-2, -1, h))
-                    elif 0 != j == last_move_local[1] % 8 - 1:
-                        moves.append((-2, 1, h))
+                            append((h, dest_square, promotion_piece * color_local))
+                    else:
+                        append((h, dest_square, piece))
+                if captures:
+                    for target_idx in ((dest_square + 1,) if j == 0 else (dest_square - 1,) if j == 7 else
+                                       (dest_square + 1, dest_square - 1)):
+                        if board_local[target_idx] * color_local < 0 and allowed[target_idx]:
+                            if promotes:
+                                for promotion_piece in promotion_pieces:
+                                    append((h, target_idx, promotion_piece * color_local))
+                            else:
+                                append((h, target_idx, piece))
+                if (pushes and i == (6 if color_local == 1 else 1) and
+                        board_local[dest_square - color_local * 8] == 0 and allowed[dest_square - color_local * 8]):
+                    append((h, dest_square - color_local * 8, piece))
+                # Left to filter_legal(), which plays it out, like every en passant
+                if captures and last_move_local is not None and i == last_move_local[1] // 8:
+                    if j == last_move_local[1] % 8 + 1:
+                        append((-2, -1, h))
+                    elif j == last_move_local[1] % 8 - 1:
+                        append((-2, 1, h))
+            elif piece_type == 2:
+                for target_idx in knight_targets[h]:
+                    if lowest <= board_local[target_idx] * color_local <= highest and allowed[target_idx]:
+                        append((h, target_idx, piece))
+            elif piece_type == 6:
+                if quiets and destinations is None:
+                    row_base: int = h - h % 8
+                    if ((self.white_king if color_local == 1 else self.black_king) and
+                            board_local[row_base + 7] == 4 * color_local and
+                            board_local[row_base + 5] == board_local[row_base + 6] == 0):
+                        append((-1, 1, h))
+                    if ((self.white_queen if color_local == 1 else self.black_queen) and
+                            board_local[row_base] == 4 * color_local and
+                            board_local[row_base + 1] == board_local[row_base + 2] == board_local[row_base + 3] == 0):
+                        append((-1, -1, h))
+                for target_idx in king_targets[h]:
+                    if lowest <= board_local[target_idx] * color_local <= highest:
+                        append((h, target_idx, piece))
+            else:
+                for lines in ((rook_rays[h],) if piece_type == 4 else (bishop_diagonals[h],) if piece_type == 3 else
+                              (rook_rays[h], bishop_diagonals[h])):
+                    for line in lines:
+                        for line_idx in line:
+                            target_type: int = board_local[line_idx] * color_local
+                            if target_type == 0:
+                                if quiets and allowed[line_idx]:
+                                    append((h, line_idx, piece))
+                                continue
+                            if captures and target_type < 0 and allowed[line_idx]:
+                                append((h, line_idx, piece))
+                            break
         return moves
 
     def are_captures(self) -> bool:
-        moves: list[tuple[int, int, int]] = self.get_moves()
-        board_local: tuple[int, ...] = self.board
-        empty_count: int = board_local.count(0)
-        for move in moves:
-            new_board: list[int] = self.move_only_board(move)
-            if new_board.count(0) != empty_count:
-                return True
-        return False
+        """ Whether the player to move has a legal capture, stopping at the first one found. """
+        return self.count_captures(1) > 0
+
+    def count_captures(self, limit: int = 1 << 30) -> int:
+        """
+        Count the legal captures, each promotion while taking counting once per piece. The captures of
+        generate_moves() are tested against the check info one at a time, so no legal move list is built unless
+        get_moves() already cached one.
+
+        Parameters
+        ----------
+        limit : int, optional
+            Stop counting once this many are found. Defaults to no limit.
+        """
+        if self.moves is not None:
+            return sum(1 for move in self.moves if self.is_capture(move))
+        check_info: CheckInfo | None = self.get_check_info()
+        count: int = 0
+        for move in self.generate_moves(True, False):
+            if check_info is None or self.filter_legal([move], check_info):
+                count += 1
+                if count >= limit:
+                    return count
+        return count
+
+    def pack_move(self, move: tuple[int, int, int]) -> int:
+        """ Pack a move of this state into the int encoding of game_states.move_encoding. """
+        move_0, move_1, move_2 = move
+        if move_0 == -1:  # Castle
+            return encode_move(move_2, move_2 + 2 * move_1, CASTLE)
+        if move_0 == -2:  # En Passant
+            return encode_move(move_2, move_2 - 8 * self.color + move_1, EN_PASSANT)
+        if self.board[move_0] * self.color == 1:
+            if move_2 * self.color != 1:
+                return encode_move(move_0, move_1, PROMOTION - 2 + abs(move_2))
+            if move_0 - move_1 == 16 * self.color:
+                return encode_move(move_0, move_1, DOUBLE_PUSH)
+        return encode_move(move_0, move_1)
+
+    def unpack_move(self, packed: int) -> tuple[int, int, int]:
+        """ Turn a packed move back into the tuple that get_moves() gives for this state. """
+        from_idx, to_idx, flag = decode_move(packed)
+        if flag == CASTLE:
+            return -1, 1 if to_idx > from_idx else -1, from_idx
+        if flag == EN_PASSANT:
+            return -2, to_idx - from_idx + 8 * self.color, from_idx
+        if flag >= PROMOTION:
+            return from_idx, to_idx, (flag - 2) * self.color
+        return from_idx, to_idx, self.board[from_idx]
+
+    def get_moves_packed(self) -> list[int]:
+        """ The legal moves of get_moves(), packed into ints. """
+        pack_move: Callable[[tuple[int, int, int]], int] = self.pack_move
+        return [pack_move(move) for move in self.get_moves()]
+
+    def move_packed(self, packed: int) -> 'GameStateV3':
+        """ Make a packed move, the same as move(unpack_move(packed)). """
+        return self.move(self.unpack_move(packed))
 
     def move(self, move: tuple[int, int, int]) -> 'GameStateV3':
         """
@@ -788,7 +947,14 @@ class GameStateV3(GameStateFormatV2):
         new_moves_since_pawn: int = self.moves_since_pawn + 1
 
         if not len(move):
-            return GameStateV3(board_local, turn=self.turn + 1, winner=self.winner)
+            return GameStateV3(board_local, turn=self.turn + 1, winner=self.winner, piece_counts=self.piece_counts)
+
+        # The Zobrist key without the side to move, castling rights and en passant file, updated piece by piece
+        last_move_local: tuple[int, int, int] | None = self.last_move
+        old_board_key: int = self.hash_state ^ state_key(self.color, white_queen, white_king, black_queen, black_king,
+                                                         -1 if last_move_local is None else last_move_local[1] % 8)
+        new_board_key: int = old_board_key
+        keys: tuple[tuple[int, ...], ...] = piece_square_keys
 
         move_0, move_1, move_2 = move  # type: int, int, int
         if move_0 == -1:  # Castle
@@ -799,19 +965,33 @@ class GameStateV3(GameStateFormatV2):
                 white_queen = False
                 white_king = False
 
+            rook_idx: int = move_2 + (3 if move_1 == 1 else -4)
+            rook: int = board_local[rook_idx]
+            king: int = board_local[move_2]
             new_board[move_2] = 0
-            new_board[move_2 + (3 if move_1 == 1 else -4)] = 0
-            new_board[move_2 + move_1] = board_local[move_2 + (3 if move_1 == 1 else -4)]
-            new_board[move_2 + 2 * move_1] = board_local[move_2]
+            new_board[rook_idx] = 0
+            new_board[move_2 + move_1] = rook
+            new_board[move_2 + 2 * move_1] = king
+            new_board_key ^= (keys[king + 6][move_2] ^ keys[king + 6][move_2 + 2 * move_1] ^
+                              keys[rook + 6][rook_idx] ^ keys[rook + 6][move_2 + move_1])
             return GameStateV3(tuple(new_board), white_queen, white_king, black_queen, black_king,
-                               color=-self.color, turn=self.turn + 1, moves_since_pawn=new_moves_since_pawn)
+                               color=-self.color, turn=self.turn + 1, moves_since_pawn=new_moves_since_pawn,
+                               hash_state=new_board_key ^ state_key(-self.color, white_queen, white_king,
+                                                                    black_queen, black_king),
+                               piece_counts=self.piece_counts)
 
         if move_0 == -2:  # En Passant
+            pawn_dest: int = move_2 - 8 * self.color + move_1
             new_board[move_2] = 0
-            new_board[move_2 - 8 * self.color + move_1] = self.color
+            new_board[pawn_dest] = self.color
             new_board[move_2 + move_1] = 0
+            new_board_key ^= (keys[self.color + 6][move_2] ^ keys[self.color + 6][pawn_dest] ^
+                              keys[6 - self.color][move_2 + move_1])
             return GameStateV3(tuple(new_board), white_queen, white_king, black_queen, black_king,
-                               color=-self.color, turn=self.turn + 1)
+                               color=-self.color, turn=self.turn + 1,
+                               hash_state=new_board_key ^ state_key(-self.color, white_queen, white_king,
+                                                                    black_queen, black_king),
+                               piece_counts=self.piece_counts - piece_deltas[6 - self.color])
 
         if (piece := abs(move_2)) == 6:
             if move_0 == 4:
@@ -834,18 +1014,145 @@ class GameStateV3(GameStateFormatV2):
 
         new_board[move_1] = move_2
         new_board[move_0] = 0
-        new_previous_position_count = dict(self.previous_position_count)
-        if (hash_state := hash(board_local)) in new_previous_position_count:
-            new_previous_position_count[hash_state] += 1
-            if new_previous_position_count[hash_state] >= 3:
-                return GameStateV3(tuple(new_board), winner=0)
-        else:
-            new_previous_position_count[hash_state] = 1
+        new_board_key ^= (keys[board_local[move_0] + 6][move_0] ^ keys[board_local[move_1] + 6][move_1] ^
+                          keys[move_2 + 6][move_1])
+        # The taken piece leaves the counts, and a promoting pawn turns into its new piece
+        new_piece_counts: int = (self.piece_counts - piece_deltas[board_local[move_1] + 6] +
+                                 piece_deltas[move_2 + 6] - piece_deltas[board_local[move_0] + 6])
+        if repetition_count(self.position_history, old_board_key, self.moves_since_pawn) >= 2:
+            return GameStateV3(tuple(new_board), winner=0, piece_counts=new_piece_counts)
         last_move: tuple[int, int, int] | None = move if (
                 piece == 1 and (move_0 == move_1 + self.color * 16)) else None
         return GameStateV3(tuple(new_board), white_queen, white_king, black_queen, black_king, last_move=last_move,
                            color=-self.color, turn=self.turn + 1, moves_since_pawn=new_moves_since_pawn,
-                           previous_position_count=new_previous_position_count)
+                           position_history=(old_board_key, self.position_history),
+                           hash_state=new_board_key ^ state_key(-self.color, white_queen, white_king, black_queen,
+                                                                black_king, -1 if last_move is None else move_1 % 8),
+                           piece_counts=new_piece_counts)
+
+    def make_move(self, move: tuple[int, int, int]) -> None:
+        """
+        Make a move on this state in place, for search that walks the tree on one object.
+
+        Does the same as move() without allocating a new state. Each call pushes an entry onto the undo stack, which
+        unmake_move pops to restore the state exactly as it was.
+
+        Parameters
+        ----------
+        move : tuple[int, int, int]
+            A move from get_moves() or get_moves_no_check() of this state.
+        """
+        board_local: tuple[int, ...] = self.board
+        white_queen: bool = self.white_queen
+        white_king: bool = self.white_king
+        black_queen: bool = self.black_queen
+        black_king: bool = self.black_king
+        color_local: int = self.color
+        last_move_local: tuple[int, int, int] | None = self.last_move
+        undo_stack: list[UndoEntry] | None = self.undo_stack
+        if undo_stack is None:
+            undo_stack = self.undo_stack = []
+
+        new_board: list[int] = list(board_local)
+        new_moves_since_pawn: int = self.moves_since_pawn + 1
+        new_last_move: tuple[int, int, int] | None = None
+        position_history: PositionHistory | None = self.position_history
+        new_position_history: PositionHistory | None = None
+        board_key: int = self.hash_state ^ state_key(color_local, white_queen, white_king, black_queen, black_king,
+                                                     -1 if last_move_local is None else last_move_local[1] % 8)
+        keys: tuple[tuple[int, ...], ...] = piece_square_keys
+        piece_counts: int = self.piece_counts
+
+        move_0, move_1, move_2 = move  # type: int, int, int
+        if move_0 == -1:  # Castle
+            if move_2 == 4:
+                black_queen = False
+                black_king = False
+            else:
+                white_queen = False
+                white_king = False
+            rook_idx: int = move_2 + (3 if move_1 == 1 else -4)
+            rook: int = board_local[rook_idx]
+            king: int = board_local[move_2]
+            new_board[move_2] = 0
+            new_board[rook_idx] = 0
+            new_board[move_2 + move_1] = rook
+            new_board[move_2 + 2 * move_1] = king
+            board_key ^= (keys[king + 6][move_2] ^ keys[king + 6][move_2 + 2 * move_1] ^
+                          keys[rook + 6][rook_idx] ^ keys[rook + 6][move_2 + move_1])
+        elif move_0 == -2:  # En Passant
+            pawn_dest: int = move_2 - 8 * color_local + move_1
+            new_board[move_2] = 0
+            new_board[pawn_dest] = color_local
+            new_board[move_2 + move_1] = 0
+            board_key ^= (keys[color_local + 6][move_2] ^ keys[color_local + 6][pawn_dest] ^
+                          keys[6 - color_local][move_2 + move_1])
+            new_moves_since_pawn = 0
+            piece_counts -= piece_deltas[6 - color_local]
+        else:
+            if (piece := abs(move_2)) == 6:
+                if move_0 == 4:
+                    black_queen = False
+                    black_king = False
+                elif move_0 == 60:
+                    white_queen = False
+                    white_king = False
+            elif piece == 4:
+                if move_0 == 56:
+                    white_queen = False
+                elif move_0 == 63:
+                    white_king = False
+                elif not move_0:
+                    black_queen = False
+                elif move_0 == 7:
+                    black_king = False
+            elif piece == 1:
+                new_moves_since_pawn = 0
+                if move_0 == move_1 + color_local * 16:
+                    new_last_move = move
+            new_board[move_1] = move_2
+            new_board[move_0] = 0
+            new_position_history = (board_key, position_history)
+            piece_counts += (piece_deltas[move_2 + 6] - piece_deltas[board_local[move_1] + 6] -
+                             piece_deltas[board_local[move_0] + 6])
+            board_key ^= (keys[board_local[move_0] + 6][move_0] ^ keys[board_local[move_1] + 6][move_1] ^
+                          keys[move_2 + 6][move_1])
+
+        undo_stack.append((board_local, self.white_queen, self.white_king, self.black_queen, self.black_king,
+                           last_move_local, self.moves_since_pawn, self.hash_state, self.winner, self.moves,
+                           position_history, self.piece_counts))
+        self.winner = None
+        if new_position_history is not None and repetition_count(position_history, new_position_history[0],
+                                                                 self.moves_since_pawn) >= 2:
+            self.winner = 0
+        self.board = tuple(new_board)
+        self.white_queen = white_queen
+        self.white_king = white_king
+        self.black_queen = black_queen
+        self.black_king = black_king
+        self.last_move = new_last_move
+        self.moves_since_pawn = new_moves_since_pawn
+        self.position_history = new_position_history
+        self.color = -color_local
+        self.turn += 1
+        self.moves = None
+        self.moves_and_states = None
+        self.checked = None
+        self.piece_counts = piece_counts
+        self.hash_state = board_key ^ state_key(-color_local, white_queen, white_king, black_queen, black_king,
+                                                -1 if new_last_move is None else move_1 % 8)
+
+    def unmake_move(self) -> None:
+        """ Take back the last move made with make_move. """
+        undo_stack: list[UndoEntry] | None = self.undo_stack
+        assert undo_stack, "unmake_move called without a move to take back"
+        (self.board, self.white_queen, self.white_king, self.black_queen, self.black_king, self.last_move,
+         self.moves_since_pawn, self.hash_state, self.winner, self.moves, self.position_history,
+         self.piece_counts) = undo_stack.pop()
+        self.color = -self.color
+        self.turn -= 1
+        self.moves_and_states = None
+        self.checked = None
 
     def move_only_board(self, move: tuple[int, int, int]) -> list[int]:
         """
@@ -929,16 +1236,13 @@ class GameStateV3(GameStateFormatV2):
         if self.moves_since_pawn >= 100:
             self.winner = 0
             return 0
-        white: bool = 6 in self.board
-        black: bool = -6 in self.board
+        white: bool = piece_count(self.piece_counts, 6) > 0
+        black: bool = piece_count(self.piece_counts, -6) > 0
         if white and not black:
             self.winner = 1
         elif black and not white:
             self.winner = -1
-        else:
-            for piece in self.board:
-                if 0 != piece != 6 and piece != -6:
-                    return None
+        elif only_kings(self.piece_counts):
             self.winner = 0
         return self.winner
 
@@ -947,7 +1251,7 @@ class GameStateV3(GameStateFormatV2):
           color={self.color},
           turn={self.turn},
           winner={self.winner},
-          previous_position_count={self.previous_position_count},
+          position_history={self.position_history},
           moves_since_pawn={self.moves_since_pawn},
           moves={self.moves},
           white_queen={self.white_queen},
@@ -0,0 +1,47 @@
+# What is on the board, kept as one int that move() updates with a single addition or subtraction per piece that
+# appears or disappears. Bits 0-51 hold a 4 bit count for each piece from -6 to 6 (the bits for 0 stay empty), which
+# together make a piece-count signature. Above them sit the game phase, the number of knights, bishops, rooks and
+# queens, and then the material of white and of black in pawns.
+PHASE_SHIFT: int = 52
+WHITE_MATERIAL_SHIFT: int = 58
+BLACK_MATERIAL_SHIFT: int = 66
+
+# Indexed by piece type, so the king is worth nothing
+material_values: tuple[int, ...] = (0, 1, 3, 3, 5, 9, 0)
+
+# piece_deltas[piece + 6] is what a piece adds to the counts when it is placed on the board
+piece_deltas: tuple[int, ...] = tuple(
+    0 if piece == 0 else (1 << 4 * (piece + 6) | (2 <= abs(piece) <= 5) << PHASE_SHIFT |
+                          material_values[abs(piece)] << (WHITE_MATERIAL_SHIFT if piece > 0 else BLACK_MATERIAL_SHIFT))
+    for piece in range(-6, 7))
+
+# The count bits of every piece but the kings
+non_king_mask: int = sum(15 << 4 * (piece + 6) for piece in range(-5, 6) if piece)
+
+
+def board_piece_counts(board: tuple[int, ...] | list[int]) -> int:
+    """ The piece counts of a 64 square board, for states that are not made from a parent's counts. """
+    piece_counts: int = 0
+    for piece in board:
+        piece_counts += piece_deltas[piece + 6]
+    return piece_counts
+
+
+def piece_count(piece_counts: int, piece: int) -> int:
+    """ How many of a piece, such as -2 for black knights, are on the board. """
+    return piece_counts >> 4 * (piece + 6) & 15
+
+
+def game_phase(piece_counts: int) -> int:
+    """ The number of knights, bishops, rooks and queens on the board, from 14 at the start down to 0. """
+    return piece_counts >> PHASE_SHIFT & 63
+
+
+def material(piece_counts: int, color: int) -> int:
+    """ The material of one side in pawns, not counting the king. """
+    return piece_counts >> (WHITE_MATERIAL_SHIFT if color == 1 else BLACK_MATERIAL_SHIFT) & 255
+
+
+def only_kings(piece_counts: int) -> bool:
+    """ Whether nothing but kings is left, the one material draw these games recognise. """
+    return not piece_counts & non_king_mask
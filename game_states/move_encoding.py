@@ -0,0 +1,46 @@
+# A move packed into one 16-bit int, the same for every engine: the from square in bits 0-5, the to square in bits
+# 6-11 and a flag in bits 12-15. Squares use the GameStateV3 index, h = 0 being a8. Castling moves the king two
+# squares, and en passant goes to the square the pawn lands on.
+NORMAL: int = 0
+DOUBLE_PUSH: int = 1
+CASTLE: int = 2
+EN_PASSANT: int = 3
+# PROMOTION + piece type - 2, so knight 4, bishop 5, rook 6 and queen 7
+PROMOTION: int = 4
+
+square_names: tuple[str, ...] = tuple(f'{"abcdefgh"[h % 8]}{8 - h // 8}' for h in range(64))
+promotion_letters: str = 'nbrq'
+
+
+def encode_move(from_idx: int, to_idx: int, flag: int = NORMAL) -> int:
+    return from_idx | to_idx << 6 | flag << 12
+
+
+def decode_move(packed: int) -> tuple[int, int, int]:
+    """ Split a packed move into its from square, to square and flag. """
+    return packed & 63, packed >> 6 & 63, packed >> 12
+
+
+def move_from(packed: int) -> int:
+    return packed & 63
+
+
+def move_to(packed: int) -> int:
+    return packed >> 6 & 63
+
+
+def move_flag(packed: int) -> int:
+    return packed >> 12
+
+
+def promotion_piece_type(packed: int) -> int:
+    """ The piece type a pawn promotes to, 2 (knight) to 5 (queen), or 0 if the move is not a promotion. """
+    flag: int = packed >> 12
+    return flag - 2 if flag >= PROMOTION else 0
+
+
+def move_name(packed: int) -> str:
+    """ The move in long algebraic notation, such as e2e4 or a7a8q. """
+    flag: int = packed >> 12
+    name: str = square_names[packed & 63] + square_names[packed >> 6 & 63]
+    return name + promotion_letters[flag - PROMOTION] if flag >= PROMOTION else name
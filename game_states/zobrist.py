@@ -0,0 +1,40 @@
+import random
+
+# Seeded so that every process, and every engine, gives a position the same key
+_rng: random.Random = random.Random(0x2B7E151628AED2A6)
+
+# piece_square_keys[piece + 6][h] for pieces -6..6, with the empty row (piece 0) left as zeros so captures of nothing
+# can be XORed in without a branch. Squares use the GameStateV3 index, h = 0 being a8.
+piece_square_keys: tuple[tuple[int, ...], ...] = tuple(
+    tuple(0 if piece == 0 else _rng.getrandbits(64) for _ in range(64)) for piece in range(-6, 7))
+side_key: int = _rng.getrandbits(64)
+# White queen side, white king side, black queen side, black king side
+castling_keys: tuple[int, int, int, int] = (_rng.getrandbits(64), _rng.getrandbits(64), _rng.getrandbits(64),
+                                            _rng.getrandbits(64))
+en_passant_keys: tuple[int, ...] = tuple(_rng.getrandbits(64) for _ in range(8))
+
+
+def state_key(color: int, white_queen: bool, white_king: bool, black_queen: bool, black_king: bool,
+              en_passant_file: int = -1) -> int:
+    """ The part of a Zobrist key that does not depend on where the pieces stand. """
+    key: int = side_key if color == -1 else 0
+    if white_queen:
+        key ^= castling_keys[0]
+    if white_king:
+        key ^= castling_keys[1]
+    if black_queen:
+        key ^= castling_keys[2]
+    if black_king:
+        key ^= castling_keys[3]
+    if en_passant_file != -1:
+        key ^= en_passant_keys[en_passant_file]
+    return key
+
+
+def board_key(board: tuple[int, ...] | list[int]) -> int:
+    """ The piece placement part of a Zobrist key for a 64 square board. """
+    key: int = 0
+    for h, piece in enumerate(board):
+        if piece:
+            key ^= piece_square_keys[piece + 6][h]
+    return key
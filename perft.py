@@ -0,0 +1,156 @@
+import argparse
+import multiprocessing
+import time
+from typing import Any, Callable
+
+from fen_utils import game_state_from_fen, game_state_from_line
+from game_states import GameState, GameStateBase
+from game_states.move_encoding import move_name
+
+# Use fork context on macOS to avoid spawn from non-main thread
+_ctx = multiprocessing.get_context('fork')
+
+# How each engine is made from the GameState that fen_utils reads
+engines: dict[str, Callable[[GameState], GameStateBase]] = {
+    'game': lambda game_state: game_state,
+    'v3': GameState.to_v3,
+    'bbv2': GameState.to_bitboards_v2,
+    'bbv3': GameState.to_bitboards_v3,
+}
+
+start_fen: str = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+
+def position_key(game_state: GameStateBase) -> Any:
+    """ The Zobrist key of engines that keep one, and the hashable state of those that do not. """
+    hash_state: int | None = getattr(game_state, 'hash_state', None)
+    return hash_state if hash_state is not None else game_state.get_hashable_state()
+
+
+def perft(game_state: GameStateBase, depth: int, cache: dict[tuple[Any, int], int] | None = None) -> int:
+    """
+    Count the leaf nodes of the legal move tree below a position.
+
+    Parameters
+    ----------
+    game_state : GameStateBase
+        The position to count from, in any engine.
+    depth : int
+        The number of plies to play out.
+    cache : dict[tuple[Any, int], int] | None, optional
+        Counts already worked out, keyed by position_key() and depth, so a transposition is only counted once.
+        Defaults to None, which counts every node.
+
+    Returns
+    -------
+    int
+        The number of positions reached after exactly depth plies.
+    """
+    if depth == 0:
+        return 1
+    moves: list = game_state.get_moves()
+    if depth == 1:
+        return len(moves)
+    if cache is not None:
+        key: tuple[Any, int] = (position_key(game_state), depth)
+        nodes: int | None = cache.get(key)
+        if nodes is not None:
+            return nodes
+    nodes = 0
+    for move in moves:
+        nodes += perft(game_state.move(move), depth - 1, cache)
+    if cache is not None:
+        cache[key] = nodes
+    return nodes
+
+
+def divide(game_state: GameStateBase, depth: int,
+           cache: dict[tuple[Any, int], int] | None = None) -> list[tuple[Any, int]]:
+    """ The perft count below each root move, in the order get_moves() gives them. """
+    return [(move, perft(game_state.move(move), depth - 1, cache)) for move in game_state.get_moves()]
+
+
+# The root position of a parallel divide, handed to each worker once instead of with every move
+_root_state: GameStateBase | None = None
+_use_cache: bool = False
+_worker_cache: dict[tuple[Any, int], int] = {}
+
+
+def _init_worker(game_state: GameStateBase, use_cache: bool) -> None:
+    global _root_state, _use_cache
+    _root_state = game_state
+    _use_cache = use_cache
+
+
+def _divide_worker(move_idx: int, depth: int) -> int:
+    # Each worker keeps its own cache, so transpositions are only shared between root moves of the same process
+    assert _root_state is not None
+    cache: dict[tuple[Any, int], int] | None = _worker_cache if _use_cache else None
+    return perft(_root_state.move(_root_state.get_moves()[move_idx]), depth - 1, cache)
+
+
+def parallel_divide(game_state: GameStateBase, depth: int, processes: int | None = None,
+                    use_cache: bool = False) -> list[tuple[Any, int]]:
+    """
+    divide(), with the root moves split across a pool of processes.
+
+    Parameters
+    ----------
+    game_state : GameStateBase
+        The position to count from, in any engine.
+    depth : int
+        The number of plies to play out, at least 1.
+    processes : int | None, optional
+        The size of the pool. Defaults to None, which uses every CPU.
+    use_cache : bool, optional
+        Whether each worker keeps a perft cache across the root moves it is given. Defaults to False.
+
+    Returns
+    -------
+    list[tuple[Any, int]]
+        Each root move with its count, in the order get_moves() gives them.
+    """
+    moves: list = game_state.get_moves()
+    with _ctx.Pool(processes, initializer=_init_worker, initargs=(game_state, use_cache)) as pool:
+        counts: list[int] = pool.starmap(_divide_worker, [(i, depth) for i in range(len(moves))], chunksize=1)
+    return list(zip(moves, counts))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Count the legal move tree of a position to check move generation.')
+    position = parser.add_mutually_exclusive_group()
+    position.add_argument('--fen', default=start_fen, help='The position to count from. Defaults to the start.')
+    position.add_argument('--line', type=int, help='Count from this (1-indexed) line of fens.txt instead.')
+    parser.add_argument('--depth', type=int, default=4, help='The number of plies. Defaults to 4.')
+    parser.add_argument('--engine', choices=engines, default='bbv3', help='The game state to count with.')
+    parser.add_argument('--divide', action='store_true', help='Print the count below each root move.')
+    parser.add_argument('--hash', action='store_true', help='Count each transposition only once.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Split the root moves across this many processes. Defaults to 1, 0 uses every CPU.')
+    args = parser.parse_args()
+
+    game_state: GameState = game_state_from_line(args.line) if args.line is not None else game_state_from_fen(args.fen)
+    root: GameStateBase = engines[args.engine](game_state)
+    t0 = time.perf_counter()
+    if args.processes != 1 and args.depth > 1:
+        counts = parallel_divide(root, args.depth, args.processes or None, args.hash)
+    elif args.divide:
+        counts = divide(root, args.depth, {} if args.hash else None)
+    else:
+        counts = [(None, perft(root, args.depth, {} if args.hash else None))]
+    elapsed = time.perf_counter() - t0
+    nodes = sum(count for _, count in counts)
+
+    if args.divide:
+        # The engines with packed moves can name them in long algebraic notation
+        pack_move: Callable[[Any], int] | None = getattr(root, 'pack_move', None)
+        for move, count in counts:
+            print(f'{move_name(pack_move(move)) if pack_move is not None else move}: {count:,}')
+        print()
+    print(f'Nodes: {nodes:,}')
+    print(f'Time (s): {elapsed:#.5g}')
+    print(f'Nodes/s: {nodes / elapsed if elapsed else 0:,.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ from math import log2
 from random import choice
 
 from game_states.game_bitboards_v3 import GameStateBitboardsV3 as GameStateTest
-from game_states import GameStateCorrect, GameState
+from game_states import GameStateCorrect, GameState, GameStateV3
 
 base_board: tuple[int, ...] = (
     0, 0, 0, 0, 6, 0, 0, 0,
@@ -17,6 +17,16 @@ base_board: tuple[int, ...] = (
 )
 
 
+def sorted_moves(game_state: GameStateTest) -> list[tuple[int, int, int]]:
+    """ The legal moves in packed order, so they pair up with those of correct_sorted_moves. """
+    return sorted(game_state.get_moves(), key=game_state.pack_move)
+
+
+def correct_sorted_moves(game_state: GameStateCorrect) -> list[tuple[int, int, int]]:
+    return sorted(game_state.get_moves(),
+                  key=GameStateV3(game_state.board, color=game_state.color).pack_move)
+
+
 def board_move_matches(board: tuple[int, ...], debug: bool = False,
                        castle: bool = False, **kwargs) -> None:
     game_state_test: GameStateTest = GameState(board, castle, castle, castle, castle, **kwargs).to_bitboards_v3()
@@ -58,7 +68,7 @@ def board_move_matches(board: tuple[int, ...], debug: bool = False,
         print(game_state_correct.get_moves())
         print()
     assert len(game_state_test.get_moves()) == len(game_state_correct.get_moves())
-    for move_test, move_correct in zip(game_state_test.get_moves(), game_state_correct.get_moves()):
+    for move_test, move_correct in zip(sorted_moves(game_state_test), correct_sorted_moves(game_state_correct)):
         game_state_test_2 = game_state_test.move(move_test)
         game_state_correct_2 = game_state_correct.move(move_correct)
         if (str(game_state_test) != str(game_state_correct) or
@@ -772,8 +782,8 @@ def test_random_games(debug: bool = False, n: int = 1) -> None:
         while game_state_test.get_winner() is None:
             move_idx = random.randint(0, len(game_state_test.get_moves()) - 1)
             game_state_last = game_state_correct
-            game_state_test = game_state_test.move(game_state_test.get_moves()[move_idx])
-            game_state_correct = game_state_correct.move(game_state_correct.get_moves()[move_idx])
+            game_state_test = game_state_test.move(sorted_moves(game_state_test)[move_idx])
+            game_state_correct = game_state_correct.move(correct_sorted_moves(game_state_correct)[move_idx])
             if (str(game_state_test) != str(game_state_correct) or
                     len(game_state_test.get_moves()) != len(game_state_correct.get_moves()) or
                     game_state_test.get_winner() != game_state_correct.get_winner() or not
@@ -852,8 +862,8 @@ def deep_test(game_state_test, game_state_correct, depth, debug) -> None:
         print(game_state_test.get_winner())
         print(game_state_correct.get_winner())
 
-    moves_test = game_state_test.get_moves()
-    moves_correct = game_state_correct.get_moves()
+    moves_test = sorted_moves(game_state_test)
+    moves_correct = correct_sorted_moves(game_state_correct)
     assert len(moves_test) == len(moves_correct)
     assert game_state_test.get_winner() == game_state_correct.get_winner()
 
@@ -862,6 +872,155 @@ def deep_test(game_state_test, game_state_correct, depth, debug) -> None:
             deep_test(game_state_test.move(move_test), game_state_correct.move(move_correct), depth - 1, debug)
 
 
+def test_hash_state_incremental(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None and game_state_test.get_moves():
+            game_state_test = game_state_test.move(choice(game_state_test.get_moves()))
+            rebuilt = GameStateTest(game_state_test.white_pieces, game_state_test.black_pieces, game_state_test.kings,
+                                    game_state_test.queens, game_state_test.rooks, game_state_test.bishops,
+                                    game_state_test.knights, game_state_test.pawns, game_state_test.white_queen,
+                                    game_state_test.white_king, game_state_test.black_queen,
+                                    game_state_test.black_king, game_state_test.last_move, game_state_test.color)
+            assert game_state_test.hash_state == rebuilt.hash_state
+            assert hash(game_state_test) == hash(rebuilt)
+
+
+def test_make_unmake(n: int = 5) -> None:
+    fields = ('white_pieces', 'black_pieces', 'kings', 'queens', 'rooks', 'bishops',
+              'knights', 'pawns', 'white_queen', 'white_king', 'black_queen', 'black_king', 'last_move', 'color',
+              'turn', 'moves_since_pawn', 'hash_state')
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        made = GameStateTest()
+        while game_state_test.get_winner() is None and game_state_test.get_moves():
+            move = choice(game_state_test.get_moves())
+            game_state_test = game_state_test.move(move)
+            made.make_move(move)
+            if game_state_test.winner == 0 and made.winner == 0:
+                break
+            assert [getattr(made, field) for field in fields] == [getattr(game_state_test, field) for field in fields]
+            assert made.get_moves() == game_state_test.get_moves()
+        while made.undo_stack:
+            made.unmake_move()
+        assert [getattr(made, field) for field in fields] == [getattr(GameStateTest(), field) for field in fields]
+        assert made.position_history is None
+
+
+def test_packed_moves(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        game_state_v3 = GameStateV3()
+        # The engines count repetitions from different keys, so stop as soon as either one ends the game
+        while game_state_test.get_winner() is None and game_state_v3.get_winner() is None and \
+                game_state_test.get_moves():
+            for move in game_state_test.get_moves():
+                assert game_state_test.unpack_move(game_state_test.pack_move(move)) == move
+            packed_moves = game_state_test.get_moves_packed()
+            assert sorted(packed_moves) == sorted(game_state_v3.get_moves_packed())
+            packed_move = choice(packed_moves)
+            game_state_test = game_state_test.move_packed(packed_move)
+            game_state_v3 = game_state_v3.move_packed(packed_move)
+            assert game_state_test.hash_state == game_state_v3.hash_state
+
+
+def test_iter_moves(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None:
+            # A pseudo-legal hint may leave the king in check, in which case it must not be yielded
+            hint = choice(game_state_test.get_moves_no_check())
+            staged_moves = list(game_state_test.iter_moves(hint))
+            moves = game_state_test.get_moves()
+            if not moves:
+                break
+            assert sorted(staged_moves) == sorted(moves)
+            assert (staged_moves[0] == hint) == (hint in moves)
+            is_capture = [game_state_test.is_capture(move) for move in staged_moves if move != hint]
+            assert is_capture == sorted(is_capture, reverse=True)
+            # Once get_moves() has cached the list, the stages are taken from it instead
+            cached_moves = list(game_state_test.iter_moves(hint))
+            assert sorted(cached_moves) == sorted(moves) and cached_moves[0] == staged_moves[0]
+            game_state_test = game_state_test.move(choice(moves))
+
+
+def test_captures_and_evasions(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None:
+            capture_count = game_state_test.count_captures()
+            are_captures = game_state_test.are_captures()
+            captures = game_state_test.get_captures()
+            evasions = game_state_test.get_evasions()
+            moves = game_state_test.get_moves()
+            if not moves:
+                break
+            assert sorted(captures) == sorted(move for move in moves if game_state_test.is_capture(move))
+            assert sorted(evasions) == sorted(moves)
+            assert capture_count == len(captures) and are_captures == bool(captures)
+            game_state_test = game_state_test.move(choice(moves))
+
+
+def test_in_check(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        game_state_v3 = GameStateV3()
+        while game_state_test.get_winner() is None and game_state_v3.get_winner() is None and \
+                game_state_test.get_moves():
+            assert game_state_test.in_check == game_state_v3.in_check
+            for h in range(64):
+                for color in (1, -1):
+                    assert game_state_test.is_square_attacked(h, color) == game_state_v3.is_square_attacked(h, color)
+            packed_move = choice(game_state_test.get_moves_packed())
+            game_state_test = game_state_test.move_packed(packed_move)
+            game_state_v3 = game_state_v3.move_packed(packed_move)
+
+
+def test_piece_counts(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        game_state_v3 = GameStateV3()
+        while game_state_test.get_winner() is None and game_state_v3.get_winner() is None and \
+                game_state_test.get_moves():
+            assert game_state_test.piece_counts == game_state_v3.piece_counts
+            assert game_state_test.phase == game_state_v3.phase
+            packed_move = choice(game_state_test.get_moves_packed())
+            game_state_test = game_state_test.move_packed(packed_move)
+            game_state_v3 = game_state_v3.move_packed(packed_move)
+
+
+def test_mailbox(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        game_state_test.track_pieces()
+        game_state_v3 = GameStateV3()
+        # The same game without a mailbox, which finds the pieces from the bitboards instead
+        game_state_plain = GameStateTest()
+        while game_state_test.get_winner() is None and game_state_v3.get_winner() is None and \
+                game_state_test.get_moves():
+            mailbox = game_state_test.mailbox
+            assert mailbox is not None
+            assert [piece - 6 for piece in mailbox] == list(game_state_v3.board)
+            assert game_state_test.get_hashable_state() == game_state_plain.get_hashable_state()
+            assert game_state_test.hash_state == game_state_plain.hash_state
+            assert game_state_test.get_winner() == game_state_plain.get_winner()
+            packed_move = choice(game_state_test.get_moves_packed())
+            move = game_state_test.unpack_move(packed_move)
+            assert game_state_test.move_only_board(move) == game_state_plain.move_only_board(move)
+            game_state_test.make_move(move)
+            game_state_plain.make_move(move)
+            assert game_state_test.get_hashable_state() == game_state_plain.get_hashable_state()
+            assert game_state_test.hash_state == game_state_plain.hash_state
+            assert game_state_test.moves_since_pawn == game_state_plain.moves_since_pawn
+            assert game_state_test.winner == game_state_plain.winner
+            game_state_test.unmake_move()
+            game_state_plain.unmake_move()
+            assert game_state_test.mailbox is mailbox
+            game_state_test = game_state_test.move_packed(packed_move)
+            game_state_plain = game_state_plain.move_packed(packed_move)
+            game_state_v3 = game_state_v3.move_packed(packed_move)
+
+
 def main() -> None:
     test_random_games(True, 10_000)
 
@@ -0,0 +1,47 @@
+from bots import BotV1, BotV5p4, EngineWorker
+from bots.engine_worker import pack_state, unpack_state
+from fen_utils import game_state_from_line
+from game_states.game_base import repetition_count
+
+
+def test_pack_state() -> None:
+    for line in range(1, 6):
+        game_state = game_state_from_line(line).to_v3()
+        # A few moves, so there is a repetition history and possibly an en passant square to carry over
+        for _ in range(4):
+            game_state = game_state.move(game_state.get_moves()[-1])
+        unpacked = unpack_state(pack_state(game_state))
+        assert unpacked.get_hashable_state() == game_state.get_hashable_state()
+        assert unpacked.hash_state == game_state.hash_state
+        assert unpacked.moves_since_pawn == game_state.moves_since_pawn
+        assert unpacked.get_moves() == game_state.get_moves()
+        for key in (game_state.hash_state, unpacked.position_history[0] if unpacked.position_history else 0):
+            assert (repetition_count(unpacked.position_history, key, 100) ==
+                    repetition_count(game_state.position_history, key, game_state.moves_since_pawn))
+
+
+def test_engine_worker() -> None:
+    game_state = game_state_from_line(3).to_v3()
+    expected = BotV5p4().minimax(game_state, 3, -(1 << 31), 1 << 31, game_state.color == 1)
+    worker = EngineWorker(BotV5p4(tt_size_mb=1))
+    try:
+        assert worker.generate_move(game_state, depth=3) == (expected, 3)
+        assert [depth for depth, _ in worker.depth_results] == [1, 2, 3]
+        (_, move), depth = worker.generate_move(game_state, .2)
+        assert move in game_state.get_moves() and depth == worker.depth_results[-1][0]
+        worker.clear_cache()
+        assert worker.generate_move(game_state, depth=2)[1] == 2
+    finally:
+        worker.close()
+    assert not worker.process.is_alive()
+
+
+def test_engine_worker_plain_bot() -> None:
+    # A bot without an in-process search still works behind the pipe, without per-depth results
+    game_state = game_state_from_line(4).to_v3()
+    worker = EngineWorker(BotV1())
+    try:
+        (_, move), _ = worker.generate_move(game_state, .1, depth=2)
+        assert move in game_state.get_moves() and not worker.depth_results
+    finally:
+        worker.close()
@@ -4,6 +4,9 @@ import pytest
 from game_states import GameStateV3 as GameStateTest
 # from game_states.game_v2 import GameStateV2 as GameStateTest
 from game_states import GameStateCorrect
+from game_states.material import board_piece_counts
+from game_states.move_encoding import move_name
+from fen_utils import game_state_from_fen
 
 base_board: tuple[int, ...] = (
     0, 0, 0, 0, 6, 0, 0, 0,
@@ -807,6 +810,131 @@ def deep_test(game_state_test, game_state_correct, depth, debug) -> None:
 
 
 
+def test_hash_state_incremental(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None and game_state_test.get_moves():
+            game_state_test = game_state_test.move(choice(game_state_test.get_moves()))
+            rebuilt = GameStateTest(game_state_test.board, game_state_test.white_queen, game_state_test.white_king,
+                                    game_state_test.black_queen, game_state_test.black_king,
+                                    game_state_test.last_move, game_state_test.color)
+            assert game_state_test.hash_state == rebuilt.hash_state
+            assert hash(game_state_test) == hash(rebuilt)
+
+
+def test_make_unmake(n: int = 5) -> None:
+    fields = ('board', 'white_queen', 'white_king', 'black_queen', 'black_king', 'last_move', 'color',
+              'turn', 'moves_since_pawn', 'hash_state')
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        made = GameStateTest()
+        while game_state_test.get_winner() is None and game_state_test.get_moves():
+            move = choice(game_state_test.get_moves())
+            game_state_test = game_state_test.move(move)
+            made.make_move(move)
+            if game_state_test.winner == 0 and made.winner == 0:
+                break
+            assert [getattr(made, field) for field in fields] == [getattr(game_state_test, field) for field in fields]
+            assert made.get_moves() == game_state_test.get_moves()
+        while made.undo_stack:
+            made.unmake_move()
+        assert [getattr(made, field) for field in fields] == [getattr(GameStateTest(), field) for field in fields]
+        assert made.position_history is None
+
+
+def test_packed_moves(n: int = 5) -> None:
+    assert sorted(move_name(move) for move in GameStateTest().get_moves_packed())[:4] == ['a2a3', 'a2a4', 'b1a3',
+                                                                                        'b1c3']
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None and game_state_test.get_moves():
+            for move in game_state_test.get_moves():
+                assert game_state_test.unpack_move(game_state_test.pack_move(move)) == move
+            packed_move = choice(game_state_test.get_moves_packed())
+            assert game_state_test.move_packed(packed_move).board == \
+                   game_state_test.move(game_state_test.unpack_move(packed_move)).board
+            game_state_test = game_state_test.move_packed(packed_move)
+
+
+def test_iter_moves(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None:
+            # A pseudo-legal hint may leave the king in check, in which case it must not be yielded
+            hint = choice(game_state_test.get_moves_no_check())
+            staged_moves = list(game_state_test.iter_moves(hint))
+            moves = game_state_test.get_moves()
+            if not moves:
+                break
+            assert sorted(staged_moves) == sorted(moves)
+            assert (staged_moves[0] == hint) == (hint in moves)
+            is_capture = [game_state_test.is_capture(move) for move in staged_moves if move != hint]
+            assert is_capture == sorted(is_capture, reverse=True)
+            # Once get_moves() has cached the list, the stages are taken from it instead
+            cached_moves = list(game_state_test.iter_moves(hint))
+            assert sorted(cached_moves) == sorted(moves) and cached_moves[0] == staged_moves[0]
+            game_state_test = game_state_test.move(choice(moves))
+
+
+def test_captures_and_evasions(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None:
+            capture_count = game_state_test.count_captures()
+            are_captures = game_state_test.are_captures()
+            captures = game_state_test.get_captures()
+            evasions = game_state_test.get_evasions()
+            moves = game_state_test.get_moves()
+            if not moves:
+                break
+            assert sorted(captures) == sorted(move for move in moves if game_state_test.is_capture(move))
+            assert sorted(evasions) == sorted(moves)
+            assert capture_count == len(captures) and are_captures == bool(captures)
+            game_state_test = game_state_test.move(choice(moves))
+
+
+@pytest.mark.parametrize('fen', [
+    '4k3/8/8/6Pp/6K1/8/8/8 w - h6 0 1',
+    '4k3/8/8/pP6/1K6/8/8/8 w - a6 0 1',
+    '4k3/8/8/7p/P5K1/8/8/8 w - h6 0 1',
+    '4k3/8/7P/p7/1K6/8/8/8 w - a6 0 1',
+    '4k3/8/8/6pP/7K/8/8/8 w - g6 0 1',
+    '4k3/8/8/Pp6/K7/8/8/8 w - b6 0 1',
+])
+def test_en_passant_evasions_on_edge_files(fen: str) -> None:
+    # Checks by a pawn that just moved two squares next to the edge, where only one side can capture and the squares
+    # past the edge belong to the next rank
+    game_state_test = game_state_from_fen(fen).to_v3()
+    assert game_state_test.in_check
+    assert sorted(game_state_test.get_evasions()) == sorted(game_state_test.get_moves())
+
+
+def test_in_check(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None and game_state_test.get_moves():
+            king_idx = game_state_test.board.index(6 * game_state_test.color)
+            flipped = GameStateTest(game_state_test.board, False, False, False, False, color=-game_state_test.color)
+            assert game_state_test.in_check == any(move[1] == king_idx for move in flipped.get_moves_no_check())
+            assert game_state_test.is_square_attacked(king_idx, -game_state_test.color) == game_state_test.in_check
+            game_state_test = game_state_test.move(choice(game_state_test.get_moves()))
+
+
+def test_piece_counts(n: int = 5) -> None:
+    for _ in range(n):
+        game_state_test = GameStateTest()
+        while game_state_test.get_winner() is None and game_state_test.get_moves():
+            assert game_state_test.piece_counts == board_piece_counts(game_state_test.board)
+            assert game_state_test.phase == sum(1 for piece in game_state_test.board if 2 <= abs(piece) <= 5)
+            move = choice(game_state_test.get_moves())
+            made = GameStateTest(game_state_test.board, game_state_test.white_queen, game_state_test.white_king,
+                                 game_state_test.black_queen, game_state_test.black_king, game_state_test.last_move,
+                                 game_state_test.color)
+            made.make_move(move)
+            game_state_test = game_state_test.move(move)
+            assert made.piece_counts == game_state_test.piece_counts
+
+
 def main() -> None:
     test_random_games(True, 10_000)
 
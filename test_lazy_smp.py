@@ -0,0 +1,70 @@
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+
+from bots import BotV5p4, LazySMP
+from bots.lazy_smp import gil_enabled
+from bots.transposition_table import TranspositionTable, EXACT, table_bytes
+from fen_utils import game_state_from_line
+
+
+def test_shared_table() -> None:
+    shared_memory = SharedMemory(create=True, size=table_bytes(1))
+    tt = TranspositionTable(1, shared_memory.buf)
+    try:
+        process = multiprocessing.get_context('fork').Process(target=tt.store, args=(12345, 4, EXACT, 7, 0x1234))
+        process.start()
+        process.join()
+        assert tt.probe(12345) == (7, 4, EXACT, 0x1234)
+        # A slot whose data changed under its key, as a half-finished write from another process leaves it, is a miss
+        index = (12345 & tt.bucket_mask) * 4
+        tt.words[index + 1] ^= 1 << 40
+        assert tt.probe(12345) is None
+        tt.store(12345, 4, EXACT, 7, 0x1234)
+        tt.clear()
+        assert tt.probe(12345) is None
+    finally:
+        assert isinstance(tt.words, memoryview)
+        tt.words.release()
+        shared_memory.close()
+        shared_memory.unlink()
+
+
+def test_lazy_smp() -> None:
+    game_state = game_state_from_line(2).to_v3()
+    bot = LazySMP(BotV5p4(), workers=2, tt_size_mb=1)
+    try:
+        (_, move), depth = bot.generate_move(game_state, .2)
+        assert depth >= 1 and move in game_state.get_moves()
+        (_, move), depth = bot.generate_move(game_state, depth=3)
+        assert depth >= 3 and move in game_state.get_moves()
+        bot.clear_cache()
+        assert bot.generate_move(game_state, depth=2)[1] >= 2
+    finally:
+        bot.close()
+
+
+def test_lazy_smp_threads() -> None:
+    game_state = game_state_from_line(2).to_v3()
+    bot = LazySMP(BotV5p4(), workers=2, tt_size_mb=1, threads=True)
+    try:
+        assert isinstance(bot.helpers[0], BotV5p4) and bot.helpers[0].tt is bot.tt
+        assert isinstance(bot.helpers[1], BotV5p4) and isinstance(bot.bot, BotV5p4)
+        assert bot.helpers[1].eval_lookup is bot.bot.eval_lookup
+        (_, move), depth = bot.generate_move(game_state, .2)
+        assert depth >= 1 and move in game_state.get_moves()
+        (_, move), depth = bot.generate_move(game_state, depth=3)
+        assert depth >= 3 and move in game_state.get_moves()
+        bot.clear_cache()
+        assert bot.tt.probe(game_state.hash_state) is None
+        assert bot.generate_move(game_state, depth=2)[1] >= 2
+    finally:
+        bot.close()
+
+
+def test_gil_selects_workers() -> None:
+    bot = LazySMP(BotV5p4(), workers=1, tt_size_mb=1)
+    try:
+        assert bot.threads == (not gil_enabled())
+        assert bool(bot.workers) != bool(bot.helpers)
+    finally:
+        bot.close()
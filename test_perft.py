@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from fen_utils import game_state_from_fen
+from perft import perft, divide, parallel_divide, engines, start_fen
+
+kiwipete_fen: str = 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1'
+
+# The standard perft positions and the tricky ones for castling, en passant, promotion and stalemate, with the known
+# node counts from depth 1 down
+perft_positions: tuple[tuple[str, str, tuple[int, ...]], ...] = (
+    ('start', start_fen, (20, 400, 8_902, 197_281, 4_865_609)),
+    ('kiwipete', kiwipete_fen, (48, 2_039, 97_862, 4_085_603, 193_690_690)),
+    ('rook pins', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', (14, 191, 2_812, 43_238, 674_624)),
+    ('promotions', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+     (6, 264, 9_467, 422_333, 15_833_292)),
+    ('promotion captures', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+     (44, 1_486, 62_379, 2_103_487, 89_941_194)),
+    ('middle game', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+     (46, 2_079, 89_890, 3_894_594, 164_075_551)),
+    ('en passant rank pin', '3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1', (18, 92, 1_670, 10_138, 185_429, 1_134_888)),
+    ('en passant diagonal pin', '8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1', (13, 102, 1_266, 10_276, 135_655, 1_015_133)),
+    ('en passant out of check', '8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1', (15, 126, 1_928, 13_931, 206_379, 1_440_467)),
+    ('king side castle check', '5k2/8/8/8/8/8/8/4K2R w K - 0 1', (15, 66, 1_198, 6_399, 120_330, 661_072)),
+    ('queen side castle check', '3k4/8/8/8/8/8/8/R3K3 w Q - 0 1', (16, 71, 1_286, 7_418, 141_077, 803_711)),
+    ('castling rights', 'r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1', (26, 1_141, 27_826, 1_274_206)),
+    ('castle through check', 'r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1', (44, 1_494, 50_509, 1_720_476)),
+    ('promote out of check', '2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1', (11, 133, 1_442, 19_174, 266_199, 3_821_001)),
+    ('discovered check', '8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1', (29, 165, 5_160, 31_961, 1_004_658)),
+    ('promote to check', '4k3/1P6/8/8/8/8/K7/8 w - - 0 1', (9, 40, 472, 2_661, 38_983, 217_342)),
+    ('underpromote to check', '8/P1k5/K7/8/8/8/8/8 w - - 0 1', (6, 27, 273, 1_329, 18_135, 92_683)),
+    ('self stalemate', 'K1k5/8/P7/8/8/8/8/8 w - - 0 1', (2, 6, 13, 63, 382, 2_217)),
+    ('stalemate and checkmate', '8/k1P5/8/1K6/8/8/8/8 w - - 0 1', (10, 25, 268, 926, 10_857, 43_261, 567_584)),
+    ('knight and queen mates', '8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1', (37, 183, 6_559, 23_527)),
+)
+
+# The largest count each engine is asked for in the fast tier, and in the slow tier that only runs when PERFT_SLOW is
+# set. GameStateBitboardsV2 plays out every reply to check legality, so it gets far fewer nodes.
+fast_nodes: dict[str, int] = {'v3': 10_000, 'bbv2': 1_000, 'bbv3': 10_000}
+slow_nodes: dict[str, int] = {'v3': 5_000_000, 'bbv2': 50_000, 'bbv3': 5_000_000}
+slow = pytest.mark.skipif(not os.environ.get('PERFT_SLOW'), reason='set PERFT_SLOW=1 to run the deep perft counts')
+
+
+def perft_matches(engine: str, fen: str, counts: tuple[int, ...], min_nodes: int, max_nodes: int,
+                  hashed: bool = False) -> None:
+    for depth, expected in enumerate(counts, 1):
+        if expected > max_nodes:
+            break
+        if expected > min_nodes:
+            game_state = engines[engine](game_state_from_fen(fen))
+            assert perft(game_state, depth, {} if hashed else None) == expected, f'depth {depth}'
+
+
+@pytest.mark.parametrize('engine', ['v3', 'bbv2', 'bbv3'])
+@pytest.mark.parametrize('fen, counts', [position[1:] for position in perft_positions],
+                         ids=[position[0] for position in perft_positions])
+def test_perft_fast(engine: str, fen: str, counts: tuple[int, ...]) -> None:
+    perft_matches(engine, fen, counts, 0, fast_nodes[engine])
+
+
+@slow
+@pytest.mark.parametrize('engine', ['v3', 'bbv2', 'bbv3'])
+@pytest.mark.parametrize('fen, counts', [position[1:] for position in perft_positions],
+                         ids=[position[0] for position in perft_positions])
+def test_perft_slow(engine: str, fen: str, counts: tuple[int, ...]) -> None:
+    perft_matches(engine, fen, counts, fast_nodes[engine], slow_nodes[engine], hashed=True)
+
+
+def test_perft_cache() -> None:
+    game_state = game_state_from_fen(kiwipete_fen).to_bitboards_v3()
+    cache: dict = {}
+    assert perft(game_state, 3, cache) == perft(game_state, 3) == 97_862
+    assert cache
+    assert perft(game_state, 3, cache) == 97_862
+
+
+def test_divide() -> None:
+    game_state = game_state_from_fen(kiwipete_fen).to_v3()
+    counts = divide(game_state, 2)
+    assert [move for move, _ in counts] == game_state.get_moves()
+    assert sum(count for _, count in counts) == 2_039
+    assert parallel_divide(game_state, 2, processes=2) == counts
+    assert parallel_divide(game_state, 2, processes=2, use_cache=True) == counts
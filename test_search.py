@@ -0,0 +1,63 @@
+import threading
+import time
+
+from bots import BotV5p4
+from bots.bot_v5_4 import _init_split_worker, _search_root_move
+from bots.engine_worker import pack_state
+from fen_utils import game_state_from_line
+
+
+def test_search_fixed_depth() -> None:
+    for line in range(1, 4):
+        game_state = game_state_from_line(line).to_v3()
+        expected = BotV5p4().minimax(game_state, 3, -(1 << 31), 1 << 31, game_state.color == 1)
+        result, depth = BotV5p4(tt_size_mb=1).search(game_state, game_state.color == 1, depth=3)
+        assert depth == 3 and result[0] == expected[0] and result[1] in game_state.get_moves()
+
+
+def test_search_stops() -> None:
+    game_state = game_state_from_line(1).to_v3()
+    bot = BotV5p4(tt_size_mb=1)
+    stop_event = threading.Event()
+    stop_event.set()
+    # A set flag ends the search within a few hundred nodes, keeping the depths already finished
+    result, depth = bot.search(game_state, game_state.color == 1, allotted_time=60, stop_event=stop_event)
+    assert 1 <= depth <= 3 and result[1] in game_state.get_moves()
+    assert bot.stop_event is None and bot.deadline == float('inf')
+
+    t0 = time.time()
+    result, depth = bot.search(game_state, game_state.color == 1, allotted_time=.3)
+    assert time.time() - t0 < 1 and depth >= 1 and result[1] in game_state.get_moves()
+
+
+def test_in_process_generate_move() -> None:
+    game_state = game_state_from_line(2).to_v3()
+    bot = BotV5p4(in_process=True)
+    (_, move), depth = bot.generate_move(game_state, .2)
+    assert depth >= 1 and move in game_state.get_moves()
+    # The table from the last move is kept, so the same time reaches at least as deep
+    assert bot.transposition_table
+    assert bot.generate_move(game_state, .2)[1] >= depth
+
+
+def test_root_split_matches_minimax() -> None:
+    bot = BotV5p4(processes=2)
+    try:
+        for line in range(1, 9):
+            game_state = game_state_from_line(line).to_v3()
+            expected = BotV5p4().minimax(game_state, 3, -(1 << 31), 1 << 31, game_state.color == 1)
+            # Only the same tables give the same result, so every search starts from empty ones
+            bot.clear_cache()
+            assert bot.generate_move(game_state, depth=3) == (expected, 3)
+    finally:
+        bot.close()
+
+
+def test_root_move_takes_search_age() -> None:
+    game_state = game_state_from_line(1).to_v3()
+    bot = BotV5p4(tt_size_mb=1)
+    _init_split_worker(bot)
+    assert bot.tt is not None
+    # The table in the pool only ever gives way to a newer search if the task brings the age along
+    _search_root_move(pack_state(game_state), game_state.get_moves()[0], 1, -(1 << 31), 1 << 31, False, 5)
+    assert bot.tt.age == 5
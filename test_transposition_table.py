@@ -0,0 +1,70 @@
+from bots import BotV5p4
+from bots.transposition_table import TranspositionTable, EXACT, LOWER, UPPER
+from fen_utils import game_state_from_line
+
+
+def test_store_and_probe() -> None:
+    tt = TranspositionTable(1)
+    assert tt.probe(12345) is None
+    tt.store(12345, 4, EXACT, -(1 << 31), 0x1234)
+    assert tt.probe(12345) == (-(1 << 31), 4, EXACT, 0x1234)
+    tt.store(-12345, 2, LOWER, 1 << 31)
+    assert tt.probe(-12345) == (1 << 31, 2, LOWER, 0)
+    # A result without a move keeps the move already stored
+    tt.store(12345, 5, UPPER, 7)
+    assert tt.probe(12345) == (7, 5, UPPER, 0x1234)
+    tt.clear()
+    assert tt.probe(12345) is None
+
+
+def test_lookup_bounds() -> None:
+    tt = TranspositionTable(1)
+    tt.store_result(1, 3, -10, 10, 50, 1)
+    tt.store_result(2, 3, -10, 10, -50, 2)
+    tt.store_result(3, 3, -10, 10, 5, 3)
+    assert [entry[2] if (entry := tt.probe(key)) is not None else None for key in (1, 2, 3)] == [LOWER, UPPER, EXACT]
+    assert tt.lookup(1, 3, -10, 40) == (50, 1)
+    assert tt.lookup(1, 3, -10, 60) is None
+    assert tt.lookup(2, 3, -40, 10) == (-50, 2)
+    assert tt.lookup(2, 3, -60, 10) is None
+    assert tt.lookup(3, 3, -100, 100) == (5, 3)
+    # A deeper result answers a shallower search, but not the other way round
+    assert tt.lookup(3, 2, -100, 100) == (5, 3)
+    assert tt.lookup(3, 4, -100, 100) is None
+    tt.store(3, 1, EXACT, 9)
+    assert tt.probe(3) == (5, 3, EXACT, 3)
+
+
+def test_replacement() -> None:
+    tt = TranspositionTable(1)
+    buckets = tt.bucket_mask + 1
+    tt.store(1, 8, EXACT, 1)
+    # A shallower result for another position in the bucket goes to the always-replace slot
+    tt.store(1 + buckets, 2, EXACT, 2)
+    tt.store(1 + 2 * buckets, 3, EXACT, 3)
+    assert tt.probe(1) is not None and tt.probe(1 + buckets) is None and tt.probe(1 + 2 * buckets) is not None
+    # Once a new search starts, the deep entry can be replaced
+    tt.new_search()
+    tt.store(1 + buckets, 2, EXACT, 2)
+    assert tt.probe(1) is None and tt.probe(1 + buckets) is not None
+
+
+def test_bot_matches_without_table() -> None:
+    class NoStore(dict):
+        def __setitem__(self, key, value) -> None:
+            pass
+
+    bots = [BotV5p4(tt_size_mb=1), BotV5p4()]
+    for line in range(1, 6):
+        game_state = game_state_from_line(line).to_v3()
+        plain = BotV5p4(transposition_table=NoStore())
+        expected = plain.minimax(game_state, 3, -(1 << 31), 1 << 31, game_state.color == 1)
+        for bot in bots:
+            if bot.tt is not None:
+                bot.tt.new_search()
+            # The shallower searches leave hash moves for the deeper ones to try first
+            for depth in range(1, 4):
+                result = bot.minimax(game_state, depth, -(1 << 31), 1 << 31, game_state.color == 1)
+            assert result[0] == expected[0]
+            assert result[1] in game_state.get_moves()
+            assert bot.minimax(game_state, 3, -(1 << 31), 1 << 31, game_state.color == 1)[0] == expected[0]